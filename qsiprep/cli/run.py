@@ -289,6 +289,21 @@ def get_parser():
         type=int,
         default=2,
         help='number of SHORELine iterations. (default: 2)')
+    g_moco.add_argument(
+        '--shoreline_tolerance', '--shoreline-tolerance',
+        action='store',
+        nargs=2,
+        type=float,
+        metavar=('MM', 'DEGREES'),
+        help='stop SHORELine before --shoreline-iters once no volume moved more than '
+        'MM millimeters and rotated more than DEGREES degrees since the previous '
+        'iteration. By default all the iterations are run.')
+    g_moco.add_argument(
+        '--shoreline_use_ants', '--shoreline-use-ants',
+        action='store_true',
+        default=False,
+        help='register the volumes to their SHORELine predictions with antsRegistration '
+        'instead of the in-process registration.')
     g_moco.add_argument(
         '--impute-slice-threshold', '--impute_slice_threshold',
         action='store',
@@ -501,6 +516,11 @@ license file at several paths, in this order: 1) command line argument ``--fs-li
     if qsiprep_wf is None:
         sys.exit(1)
 
+    # Share the SHORE matrices and resampled atlases computed by different
+    # nodes through the work dir
+    os.environ.setdefault('QSIPREP_SHORE_CACHE', str(Path(work_dir) / 'shore_cache'))
+    os.environ.setdefault('QSIPREP_ATLAS_CACHE', str(Path(work_dir) / 'atlas_cache'))
+
     if opts.write_graph:
         qsiprep_wf.write_graph(
             graph2use="colored", format='svg', simple_form=True)
@@ -605,11 +625,10 @@ def build_qsiprep_workflow(opts, retval):
     """
     from subprocess import check_call, CalledProcessError, TimeoutExpired
     from pkg_resources import resource_filename as pkgrf
-    from bids import BIDSLayout
     from nipype import logging, config as ncfg
     from ..__about__ import __version__
     from ..workflows.base import init_qsiprep_wf
-    from ..utils.bids import collect_participants
+    from ..utils.bids import collect_participants, load_bids_index
     from ..viz.reports import generate_reports
 
     logger = logging.getLogger('nipype.workflow')
@@ -643,8 +662,10 @@ def build_qsiprep_workflow(opts, retval):
     run_uuid = '%s_%s' % (strftime('%Y%m%d-%H%M%S'), uuid.uuid4())
     retval['run_uuid'] = run_uuid
 
-    # First check that bids_dir looks like a BIDS folder
-    layout = BIDSLayout(str(bids_dir), validate=False)
+    # First check that bids_dir looks like a BIDS folder. Its index is kept in
+    # the work dir and reused by the subject workflows
+    os.environ.setdefault('QSIPREP_BIDS_INDEX', str(work_dir / 'bids_index'))
+    layout = load_bids_index(bids_dir, validate=False)
     subject_list = collect_participants(
         layout, participant_label=opts.participant_label)
     retval['subject_list'] = subject_list
@@ -783,6 +804,8 @@ def build_qsiprep_workflow(opts, retval):
         hmc_model=opts.hmc_model,
         eddy_config=opts.eddy_config,
         shoreline_iters=opts.shoreline_iters,
+        shoreline_tolerance=opts.shoreline_tolerance,
+        shoreline_use_ants=opts.shoreline_use_ants,
         impute_slice_threshold=opts.impute_slice_threshold,
         b0_to_t1w_transform=opts.b0_to_t1w_transform,
         intramodal_template_iters=opts.intramodal_template_iters,
@@ -865,6 +888,8 @@ def build_recon_workflow(opts, retval):
 
     # First check that bids_dir looks like a BIDS folder
     bids_dir = os.path.abspath(opts.bids_dir)
+    os.environ.setdefault('QSIPREP_BIDS_INDEX',
+                          op.join(op.abspath(opts.work_dir or 'work'), 'bids_index'))
     subject_list = collect_participants(
         bids_dir, participant_label=opts.participant_label, bids_validate=False)
 
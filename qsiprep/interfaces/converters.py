@@ -6,6 +6,7 @@ import gzip
 import re
 import os
 import os.path as op
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import nibabel as nb
 try:
@@ -16,10 +17,11 @@ from nipype.interfaces.base import (BaseInterfaceInputSpec, TraitedSpec, File, S
                                     traits, isdefined)
 from nipype.utils.filemanip import fname_presuffix
 from dipy.core.geometry import cart2sphere
-from dipy.direction import peak_directions
-from dipy.core.sphere import HemiSphere
+from dipy.core.sphere import Sphere
 from scipy.io.matlab import loadmat, savemat
 from pkg_resources import resource_filename as pkgr
+from ..utils.mif import write_voxelwise_mif
+from ..utils.shm import max_order_for_directions, sh_to_sf_matrix
 
 
 LOGGER = logging.getLogger('nipype.workflow')
@@ -33,6 +35,7 @@ class FODtoFIBGZInputSpec(BaseInterfaceInputSpec):
     num_fibers = traits.Int(5, usedefault=True)
     unit_odf = traits.Bool(False, usedefault=True)
     fib_file = File()
+    num_threads = traits.Int(1, usedefault=True, nohash=True)
 
 
 class FODtoFIBGZOutputSpec(TraitedSpec):
@@ -80,7 +83,8 @@ class FODtoFIBGZ(SimpleInterface):
         self._results['fib_file'] = output_fib_file
         amplitudes_to_fibgz(amplitudes_img, verts, faces, output_fib_file, mask_img,
                             num_fibers=self.inputs.num_fibers,
-                            unit_odf=self.inputs.unit_odf)
+                            unit_odf=self.inputs.unit_odf,
+                            num_threads=self.inputs.num_threads)
         os.remove("amplitudes.nii")
         return runtime
 
@@ -135,20 +139,7 @@ class FIBGZtoFOD(SimpleInterface):
         real_img = nb.load(self.inputs.ref_image)
         odf4d = np.stack(odfs_3d, -1)
         odf4d_img = nb.Nifti1Image(odf4d, real_img.affine, real_img.header)
-        odf_values_file = op.join(runtime.cwd, "odf_values.nii")
-        odf4d_img.to_filename(odf_values_file)
-
-        num_dirs, _ = directions.shape
-        hemisphere = num_dirs // 2
-        x, y, z = directions[:hemisphere].T
-        _, theta, phi = cart2sphere(-x, -y, z)
-        dirs_txt = op.join(runtime.cwd, "ras+directions.txt")
-        np.savetxt(dirs_txt, np.column_stack([phi, theta]))
-
-        popen_run(["amp2sh", "-quiet", "-force", "-directions", dirs_txt, "odf_values.nii",
-                   output_mif_file])
-        os.remove(odf_values_file)
-        os.remove(dirs_txt)
+        amplitudes_to_sh_mif(odf4d_img, directions, output_mif_file)
         self._results['mif_file'] = output_mif_file
         return runtime
 
@@ -169,8 +160,115 @@ def popen_run(arg_list):
     LOGGER.info(err)
 
 
+def odf_edges(odf_faces, num_vertices):
+    """Edges between the vertices of a hemisphere, from the faces of the full sphere.
+
+    The second half of the sphere's vertices are the antipodes of the first
+    half, so vertex ``i`` of the sphere is vertex ``i % num_vertices`` of the
+    hemisphere.
+    """
+    faces = np.asarray(odf_faces) % num_vertices
+    edges = np.row_stack([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [0, 2]]])
+    edges = np.sort(edges[edges[:, 0] != edges[:, 1]], axis=1)
+    return np.unique(edges, axis=0)
+
+
+def _neighbor_table(edges, num_vertices):
+    """(num_vertices, max_degree) array of the neighbors of each vertex.
+
+    Rows of vertices with fewer neighbors are padded by repeating their first
+    neighbor, which changes neither the largest nor the smallest neighbor.
+    """
+    source = np.concatenate([edges[:, 0], edges[:, 1]])
+    target = np.concatenate([edges[:, 1], edges[:, 0]])
+    order = np.argsort(source, kind='stable')
+    source, target = source[order], target[order]
+    counts = np.bincount(source, minlength=num_vertices)
+    if np.any(counts == 0):
+        raise ValueError("Every vertex needs at least one neighbor")
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    columns = np.arange(counts.max())
+    positions = starts[:, np.newaxis] + np.where(columns < counts[:, np.newaxis], columns, 0)
+    return target[positions]
+
+
+def find_peaks(odfs, vertices, edges, num_fibers=5, relative_peak_threshold=0.5,
+               min_separation_angle=25):
+    """Find the ODF peaks of many voxels at once.
+
+    This gives the same peaks as dipy's ``peak_directions``: local maxima on
+    the sphere, sorted by value, above ``relative_peak_threshold`` of the
+    largest peak (after subtracting the ODF minimum) and at least
+    ``min_separation_angle`` degrees from a larger peak.
+
+    Parameters
+    ----------
+    odfs : (N, M) array
+        nonnegative ODF amplitudes on the ``M`` hemisphere vertices
+    vertices : (M, 3) array
+        hemisphere vertices
+    edges : (E, 2) array
+        neighboring vertices, from ``odf_edges``
+    num_fibers : int
+        maximum number of peaks per ODF
+
+    Returns
+    -------
+    peak_vals : (N, num_fibers) float32 array
+    peak_indices : (N, num_fibers) int16 array
+        zeros where there are fewer than ``num_fibers`` peaks
+    """
+    num_odfs, num_vertices = odfs.shape
+    neighbors = _neighbor_table(edges, num_vertices)
+    peak_vals = np.zeros((num_odfs, num_fibers), dtype=np.float32)
+    peak_indices = np.zeros((num_odfs, num_fibers), dtype=np.int16)
+    if not num_odfs:
+        return peak_vals, peak_indices
+
+    # A vertex is a local maximum if none of its neighbors is larger and at
+    # least one is smaller
+    neighbor_max = odfs[:, neighbors[:, 0]]
+    neighbor_min = neighbor_max.copy()
+    for column in range(1, neighbors.shape[1]):
+        neighbor_odfs = odfs[:, neighbors[:, column]]
+        np.maximum(neighbor_max, neighbor_odfs, out=neighbor_max)
+        np.minimum(neighbor_min, neighbor_odfs, out=neighbor_min)
+    is_maximum = (odfs >= neighbor_max) & (odfs > neighbor_min)
+    candidates = np.where(is_maximum, odfs, -np.inf)
+    # Sorted by decreasing value, ties by increasing vertex index
+    order = np.argsort(-candidates, axis=1, kind='stable')
+    values = np.take_along_axis(candidates, order, axis=1)
+
+    # Only the peaks above the relative threshold are candidates
+    odf_min = np.maximum(odfs.min(1), 0)[:, np.newaxis]
+    values_norm = values - odf_min
+    valid = values_norm >= relative_peak_threshold * values_norm[:, :1]
+    valid &= np.isfinite(values) & (values[:, :1] >= 0)
+    num_candidates = int(valid.sum(1).max())
+    order, values, valid = order[:, :num_candidates], values[:, :num_candidates], \
+        valid[:, :num_candidates]
+
+    # Greedily drop peaks close to a larger one, for all voxels at once
+    directions = vertices[order]
+    cos_similarity = np.cos(np.deg2rad(min_separation_angle))
+    kept = np.zeros_like(valid)
+    for peak_num in range(num_candidates):
+        similarity = np.abs(np.einsum('nkd,nd->nk', directions[:, :peak_num],
+                                      directions[:, peak_num]))
+        too_close = np.any(kept[:, :peak_num] & (similarity > cos_similarity), axis=1)
+        kept[:, peak_num] = valid[:, peak_num] & ~too_close
+
+    # Move the kept peaks to the front
+    rank = np.cumsum(kept, axis=1) - 1
+    voxels, peak_nums = np.nonzero(kept & (rank < num_fibers))
+    peak_vals[voxels, rank[voxels, peak_nums]] = values[voxels, peak_nums]
+    peak_indices[voxels, rank[voxels, peak_nums]] = order[voxels, peak_nums]
+    return peak_vals, peak_indices
+
+
 def amplitudes_to_fibgz(amplitudes_img, odf_dirs, odf_faces, output_file,
-                        mask_img, num_fibers=5, unit_odf=False):
+                        mask_img, num_fibers=5, unit_odf=False, num_threads=1,
+                        chunk_size=4096):
     """Convert a NiftiImage of ODF amplitudes to a DSI Studio fib file.
 
     Parameters:
@@ -191,6 +289,10 @@ def amplitudes_to_fibgz(amplitudes_img, odf_dirs, odf_faces, output_file,
         3d Image that is nonzero where voxels contain brain.
     num_fibers: int
         The maximum number of fibers/fixels stored in each voxel.
+    num_threads: int
+        Number of threads used to find the peaks.
+    chunk_size: int
+        Number of voxels whose peaks are found together.
 
     Returns:
     ========
@@ -201,8 +303,6 @@ def amplitudes_to_fibgz(amplitudes_img, odf_dirs, odf_faces, output_file,
     """
     num_dirs, _ = odf_dirs.shape
     hemisphere = num_dirs // 2
-    x, y, z = odf_dirs[:hemisphere].T
-    hs = HemiSphere(x=x, y=y, z=z)
 
     if not np.allclose(mask_img.affine, amplitudes_img.affine):
         raise ValueError("Differing orientation between mask and amplitudes")
@@ -210,24 +310,24 @@ def amplitudes_to_fibgz(amplitudes_img, odf_dirs, odf_faces, output_file,
         raise ValueError("Differing grid between mask and amplitudes")
 
     # Get the flat mask
-    ampl_data = amplitudes_img.get_data()
-    flat_mask = mask_img.get_data().flatten(order="F") > 0
-    odf_array = ampl_data.reshape(-1, ampl_data.shape[3], order='F')
+    flat_mask = np.asanyarray(mask_img.dataobj).flatten(order="F") > 0
+    ampl_data = np.asanyarray(amplitudes_img.dataobj)
+    masked_odfs = ampl_data.reshape(-1, ampl_data.shape[3], order='F')[flat_mask, :]
     del ampl_data
-    masked_odfs = odf_array[flat_mask, :]
+    masked_odfs = masked_odfs.astype(np.float32)
     z0 = np.nanmax(masked_odfs)
-    masked_odfs = masked_odfs / z0
+    masked_odfs /= z0
     masked_odfs[masked_odfs < 0] = 0
-    masked_odfs = np.nan_to_num(masked_odfs).astype(np.float)
+    masked_odfs = np.nan_to_num(masked_odfs, copy=False)
 
     if unit_odf:
         sums = masked_odfs.sum(1)
         sums[sums == 0] = 1
-        masked_odfs = np.masked_odfs / sums[:, np.newaxis]
+        masked_odfs /= sums[:, np.newaxis]
 
     n_odfs = masked_odfs.shape[0]
-    peak_indices = np.zeros((n_odfs, num_fibers))
-    peak_vals = np.zeros((n_odfs, num_fibers))
+    peak_indices = np.zeros((n_odfs, num_fibers), dtype=np.int16)
+    peak_vals = np.zeros((n_odfs, num_fibers), dtype=np.float32)
 
     dsi_mat = {}
     # Create matfile that can be read by dsi Studio
@@ -235,33 +335,40 @@ def amplitudes_to_fibgz(amplitudes_img, odf_dirs, odf_faces, output_file,
     dsi_mat['voxel_size'] = np.array(amplitudes_img.header.get_zooms()[:3])
     n_voxels = int(np.prod(dsi_mat['dimension']))
     LOGGER.info("Detecting Peaks")
-    for odfnum in range(n_odfs):
-        dirs, vals, indices = peak_directions(masked_odfs[odfnum], hs)
-        for dirnum, (val, idx) in enumerate(zip(vals, indices)):
-            if dirnum == num_fibers:
-                break
-            peak_indices[odfnum, dirnum] = idx
-            peak_vals[odfnum, dirnum] = val
+    vertices = odf_dirs[:hemisphere]
+    edges = odf_edges(odf_faces, hemisphere)
+    chunks = [slice(start, start + chunk_size) for start in range(0, n_odfs, chunk_size)]
+
+    def find_chunk_peaks(chunk):
+        peak_vals[chunk], peak_indices[chunk] = find_peaks(
+            masked_odfs[chunk, :hemisphere], vertices, edges, num_fibers)
+
+    if num_threads == 1:
+        for chunk in chunks:
+            find_chunk_peaks(chunk)
+    else:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            list(executor.map(find_chunk_peaks, chunks))
 
     # ensure that fa0 > 0 for all odf values
     peak_vals[np.abs(peak_vals[:, 0]) < MIN_NONZERO, 0] = MIN_NONZERO
     for nfib in range(num_fibers):
         # fill in the "fa" values
-        fa_n = np.zeros(n_voxels)
+        fa_n = np.zeros(n_voxels, dtype=np.float32)
         fa_n[flat_mask] = peak_vals[:, nfib]
-        dsi_mat['fa%d' % nfib] = fa_n.astype(np.float32)
+        dsi_mat['fa%d' % nfib] = fa_n
 
         # Fill in the index values
-        index_n = np.zeros(n_voxels)
+        index_n = np.zeros(n_voxels, dtype=np.int16)
         index_n[flat_mask] = peak_indices[:, nfib]
-        dsi_mat['index%d' % nfib] = index_n.astype(np.int16)
+        dsi_mat['index%d' % nfib] = index_n
 
     # Add in the ODFs
     num_odf_matrices = n_odfs // ODF_COLS
     split_indices = (np.arange(num_odf_matrices) + 1) * ODF_COLS
     odf_splits = np.array_split(masked_odfs, split_indices, axis=0)
     for splitnum, odfs in enumerate(odf_splits):
-        dsi_mat['odf%d' % splitnum] = odfs.T.astype(np.float32)
+        dsi_mat['odf%d' % splitnum] = odfs.T
 
     dsi_mat['odf_vertices'] = odf_dirs.T
     dsi_mat['odf_faces'] = odf_faces.T
@@ -269,9 +376,14 @@ def amplitudes_to_fibgz(amplitudes_img, odf_dirs, odf_faces, output_file,
     savemat(output_file, dsi_mat, format='4', appendmat=False)
 
 
-def amplitudes_to_sh_mif(amplitudes_img, odf_dirs, output_file, working_dir):
+def amplitudes_to_sh_mif(amplitudes_img, odf_dirs, output_file, mask_img=None,
+                         sh_order=None, chunk_size=2**16):
     """Convert an image of ODF amplitudes to a MRtrix sh mif file.
 
+    The SH coefficients are fit in MRtrix's basis with the same least squares
+    fit as ``amp2sh``, a chunk of voxels at a time, and written directly to
+    ``output_file``.
+
     Parameters:
     ============
 
@@ -286,8 +398,14 @@ def amplitudes_to_sh_mif(amplitudes_img, odf_dirs, output_file, working_dir):
         same amplitudes.
     output_file: str
         Path where the output ``.mif`` file will be written.
-    working_dir: str
-        Path where temp files will be written to
+    mask_img: nb.Nifti1Image
+        3d Image that is nonzero where voxels contain brain. By default the
+        voxels with any nonzero amplitude.
+    sh_order: int
+        Maximum SH order. By default the largest order the directions
+        support, up to 8, as in ``amp2sh``.
+    chunk_size: int
+        Number of voxels fit at once.
 
     Returns:
     ========
@@ -295,20 +413,36 @@ def amplitudes_to_sh_mif(amplitudes_img, odf_dirs, output_file, working_dir):
     None
 
     """
-    temp_nii = op.join(working_dir, "odf_values.nii")
-    amplitudes_img.to_filename(temp_nii)
-
     num_dirs, _ = odf_dirs.shape
     hemisphere = num_dirs // 2
     x, y, z = odf_dirs[:hemisphere].T
-    _, theta, phi = cart2sphere(-x, -y, z)
-    dirs_txt = op.join(working_dir, "ras+directions.txt")
-    np.savetxt(dirs_txt, np.column_stack([phi, theta]))
-
-    popen_run(["amp2sh", "-quiet", "-force", "-directions", dirs_txt, "odf_values.nii",
-               output_file])
-    os.remove(temp_nii)
-    os.remove(dirs_txt)
+    # DSI Studio directions are LPS, MRtrix's are RAS
+    ras_sphere = Sphere(xyz=np.column_stack([-x, -y, z]))
+    if sh_order is None:
+        sh_order = max_order_for_directions(hemisphere)
+    _, fit_matrix = sh_to_sf_matrix(ras_sphere, sh_order, basis_type="mrtrix3")
+    num_coeffs = fit_matrix.shape[1]
+
+    ampl_data = np.asanyarray(amplitudes_img.dataobj)
+    shape = ampl_data.shape[:3]
+    odf_array = ampl_data.reshape(-1, ampl_data.shape[3], order='F')
+    if mask_img is not None:
+        flat_mask = np.asanyarray(mask_img.dataobj).flatten(order="F") > 0
+    else:
+        flat_mask = None
+
+    def fit_chunks():
+        for start in range(0, odf_array.shape[0], chunk_size):
+            odfs = odf_array[start:start + chunk_size, :hemisphere]
+            chunk_mask = np.any(odfs != 0, axis=1)
+            if flat_mask is not None:
+                chunk_mask &= flat_mask[start:start + chunk_size]
+            coeffs = np.zeros((len(odfs), num_coeffs), dtype=np.float32)
+            coeffs[chunk_mask] = np.dot(odfs[chunk_mask], fit_matrix)
+            yield coeffs
+
+    write_voxelwise_mif(output_file, shape + (num_coeffs,), amplitudes_img.affine,
+                        fit_chunks())
 
 
 def fast_load_fibgz(fib_file):
@@ -25,7 +25,7 @@ from nipype.interfaces.base import (
 )
 
 from .converters import get_dsi_studio_ODF_geometry, amplitudes_to_fibgz, amplitudes_to_sh_mif
-from ..utils.brainsuite_shore import BrainSuiteShoreModel, brainsuite_shore_basis
+from ..utils.brainsuite_shore import BrainSuiteShoreModel, cached_shore_basis
 from ..interfaces.mrtrix import _convert_fsl_to_mrtrix
 
 LOGGER = logging.getLogger('nipype.interface')
@@ -135,6 +135,8 @@ class DipyReconInputSpec(BaseInterfaceInputSpec):
     write_mif = traits.Bool(True)
     # To extrapolate
     extrapolate_scheme = traits.Enum('HCP', 'ABCD')
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc='number of threads for fitting and fib file peaks')
 
 
 class DipyReconOutputSpec(TraitedSpec):
@@ -200,14 +202,14 @@ class DipyReconInterface(SimpleInterface):
                                               newpath=runtime.cwd, use_ext=False)
             LOGGER.info("Writing DSI Studio fib file %s", output_fib_file)
             amplitudes_to_fibgz(odf_amplitudes, verts, faces, output_fib_file, mask_img,
-                                num_fibers=5)
+                                num_fibers=5, num_threads=self.inputs.num_threads)
             self._results['fibgz'] = output_fib_file
 
         if self.inputs.write_mif:
             output_mif_file = fname_presuffix(self.inputs.dwi_file, suffix=suffix+".mif",
                                               newpath=runtime.cwd, use_ext=False)
             LOGGER.info("Writing sh mif file %s", output_mif_file)
-            amplitudes_to_sh_mif(odf_amplitudes, verts, output_mif_file, runtime.cwd)
+            amplitudes_to_sh_mif(odf_amplitudes, verts, output_mif_file, mask_img)
             self._results['fod_sh_mif'] = output_mif_file
 
     def _extrapolate_scheme(self, scheme_name, runtime, fit_obj, mask_img):
@@ -410,8 +412,8 @@ class BrainSuiteShoreReconstruction(DipyReconInterface):
         self._results['extrapolated_b'] = output_b_file
 
         prediction_gtab = self._get_gtab(external_bvals=bval_file, external_bvecs=bvec_file)
-        prediction_shore = brainsuite_shore_basis(fit_obj.model.radial_order, fit_obj.model.zeta,
-                                                  prediction_gtab, fit_obj.model.tau)
+        prediction_shore = cached_shore_basis(fit_obj.model.radial_order, fit_obj.model.zeta,
+                                              prediction_gtab, fit_obj.model.tau)
 
         shore_array = fit_obj._shore_coef[mask_array]
         output_data = np.zeros(mask_array.shape + (len(prediction_gtab.bvals),))
@@ -462,6 +464,7 @@ class BrainSuiteShoreReconstruction(DipyReconInterface):
             l1_maxiter=self.inputs.l1_maxiter,
             l1_verbose=self.inputs.l1_verbose,
             l1_alpha=self.inputs.l1_alpha,
+            l1_num_threads=self.inputs.num_threads,
             # For EAP
             pos_grid=self.inputs.pos_grid
             )
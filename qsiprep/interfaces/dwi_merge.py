@@ -1,11 +1,11 @@
 """Handle merging and spliting of DSI files."""
 import numpy as np
-from nipype.interfaces import afni
 import os.path as op
 from nipype.interfaces.base import (BaseInterfaceInputSpec, TraitedSpec, File, SimpleInterface,
                                     InputMultiObject, traits)
 from nipype.utils.filemanip import fname_presuffix
 import nibabel as nb
+from ..utils.nifti import concat_niftis
 
 
 class MergeDWIsInputSpec(BaseInterfaceInputSpec):
@@ -17,6 +17,9 @@ class MergeDWIsInputSpec(BaseInterfaceInputSpec):
         File(exists=True), mandatory=True, desc='list of bval files')
     bvec_files = InputMultiObject(
         File(exists=True), mandatory=True, desc='list of bvec files')
+    compress = traits.Bool(True, usedefault=True, desc='Use gzip compression on .nii output')
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc='number of threads for parallel gzip (pigz)')
 
 
 class MergeDWIsOutputSpec(TraitedSpec):
@@ -41,9 +44,11 @@ class MergeDWIs(SimpleInterface):
             return shape[3]
 
         if len(self.inputs.dwi_files) > 1:
-            dwimrg = afni.TCat(in_files=self.inputs.dwi_files, outputtype='NIFTI_GZ')
-            merged_fname = dwimrg.run().outputs.out_file
-            self._results['out_dwi'] = merged_fname
+            ext = '.nii.gz' if self.inputs.compress else '.nii'
+            merged_fname = fname_presuffix(self.inputs.dwi_files[0], suffix='_tcat' + ext,
+                                           newpath=runtime.cwd, use_ext=False)
+            self._results['out_dwi'] = concat_niftis(self.inputs.dwi_files, merged_fname,
+                                                     num_threads=self.inputs.num_threads)
             out_bvec = fname_presuffix(merged_fname, suffix=".bvec", use_ext=False,
                                        newpath=runtime.cwd)
             out_bval = fname_presuffix(merged_fname, suffix=".bval", use_ext=False,
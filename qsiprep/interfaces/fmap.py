@@ -137,8 +137,12 @@ class FieldEnhanceInputSpec(BaseInterfaceInputSpec):
     unwrap = traits.Bool(False, usedefault=True, desc='run phase unwrap')
     despike = traits.Bool(True, usedefault=True, desc='run despike filter')
     bspline_smooth = traits.Bool(True, usedefault=True, desc='run 3D bspline smoother')
+    bspline_damping = traits.Float(0.0, usedefault=True,
+                                   desc='Tikhonov damping of the bspline least-squares fits')
     mask_erode = traits.Int(1, usedefault=True, desc='mask erosion iterations')
     despike_threshold = traits.Float(0.2, usedefault=True, desc='mask erosion iterations')
+    despike_3d = traits.Bool(False, usedefault=True,
+                             desc='despike using a 3D instead of an in-plane neighbourhood')
     num_threads = traits.Int(1, usedefault=True, nohash=True, desc='number of jobs')
 
 
@@ -163,7 +167,10 @@ class FieldEnhance(SimpleInterface):
 
         # Despike / denoise (no-mask)
         if self.inputs.despike:
-            data = _despike2d(data, self.inputs.despike_threshold)
+            if self.inputs.despike_3d:
+                data = _despike3d(data, self.inputs.despike_threshold)
+            else:
+                data = _despike2d(data, self.inputs.despike_threshold)
 
         mask = None
         if isdefined(self.inputs.in_mask):
@@ -198,7 +205,8 @@ class FieldEnhance(SimpleInterface):
 
             # Fit BSplines (coarse)
             bspobj = fbsp.BSplineFieldmap(datanii, weights=mask,
-                                          njobs=self.inputs.num_threads)
+                                          njobs=self.inputs.num_threads,
+                                          damping=self.inputs.bspline_damping)
             bspobj.fit()
             smoothed1 = bspobj.get_smoothed()
 
@@ -224,7 +232,8 @@ class FieldEnhance(SimpleInterface):
                     datanii.affine, datanii.header)
 
                 bspobj2 = fbsp.BSplineFieldmap(diffmapnii, knots_zooms=[24., 24., 4.],
-                                               njobs=self.inputs.num_threads)
+                                               njobs=self.inputs.num_threads,
+                                               damping=self.inputs.bspline_damping)
                 bspobj2.fit()
                 smoothed2 = bspobj2.get_smoothed().get_data()
 
@@ -403,35 +412,95 @@ def phases2fmap(phase_files, metadatas, newpath=None):
 def _despike2d(data, thres, neigh=None):
     """
     despiking as done in FSL fugue
+
+    Each slice is visited in raster order and updated in place, so every
+    window sees the already despiked values of the voxels before it. Offsets
+    below zero wrap around to the opposite edge, and offsets past the last
+    row or column are dropped. Rows are processed one at a time, vectorized
+    over columns and slices. Within a row, the left neighbours are resolved
+    by repeating the row update until it no longer changes.
+    """
+
+    if neigh is None:
+        neigh = [-1, 0, 1]
+    nrows, ncols = data.shape[:2]
+    cols = np.arange(ncols)
+
+    for i in range(nrows):
+        original = data[i].astype(np.result_type(data.dtype, np.float32))
+
+        # The other rows do not change while this row is processed
+        other_rows = []
+        for ii in neigh:
+            if ii == 0:
+                continue
+            if -nrows <= i + ii < nrows:
+                row = data[i + ii]
+                other_rows += [_shift_columns(row, cols + jj) for jj in neigh]
+
+        estimate = original
+        for _ in range(ncols + 1):
+            this_row = []
+            for jj in neigh:
+                shifted = _shift_columns(original, cols + jj)
+                visited = (cols + jj >= 0) & (cols + jj < cols)
+                shifted[visited] = estimate[(cols + jj)[visited]]
+                this_row.append(shifted)
+            despiked = _despike_window(original, np.stack(other_rows + this_row), thres)
+            if np.array_equal(despiked, estimate):
+                break
+            estimate = despiked
+        data[i] = despiked
+    return data
+
+
+def _despike3d(data, thres, neigh=None):
+    """
+    despiking with a 3D neighbourhood
+
+    Unlike :func:`_despike2d`, all voxels are compared against the input
+    data, and neighbours outside the volume are dropped instead of wrapping.
     """
 
     if neigh is None:
         neigh = [-1, 0, 1]
-    nslices = data.shape[-1]
-
-    for k in range(nslices):
-        data2d = data[..., k]
-
-        for i in range(data2d.shape[0]):
-            for j in range(data2d.shape[1]):
-                vals = []
-                thisval = data2d[i, j]
-                for ii in neigh:
-                    for jj in neigh:
-                        try:
-                            vals.append(data2d[i + ii, j + jj])
-                        except IndexError:
-                            pass
-                vals = np.array(vals)
-                patch_range = vals.max() - vals.min()
-                patch_med = np.median(vals)
-
-                if (patch_range > 1e-6 and
-                        (abs(thisval - patch_med) / patch_range) > thres):
-                    data[i, j, k] = patch_med
+    neigh = np.array(neigh)
+    original = data.astype(np.result_type(data.dtype, np.float32))
+    pad = int(np.abs(neigh).max())
+    padded = np.pad(original, pad, mode='constant', constant_values=np.nan)
+    nx, ny = data.shape[:2]
+
+    for k in range(data.shape[2]):
+        window = np.stack([
+            padded[pad + ii:pad + ii + nx, pad + jj:pad + jj + ny, pad + k + kk]
+            for ii in neigh for jj in neigh for kk in neigh])
+        data[..., k] = _despike_window(original[..., k], window, thres)
     return data
 
 
+def _shift_columns(values, indices):
+    """Rows ``indices`` of ``values``, NaN where they fall outside of it"""
+    shifted = np.full((len(indices),) + values.shape[1:], np.nan,
+                      dtype=np.result_type(values.dtype, np.float32))
+    valid = (indices >= -len(values)) & (indices < len(values))
+    shifted[valid] = values[indices[valid]]
+    return shifted
+
+
+def _despike_window(values, window, thres):
+    """Replace ``values`` by the median of ``window`` (NaN-padded) where they are spikes"""
+    window = np.sort(window, axis=0)  # NaNs sort last
+    nvalid = np.sum(~np.isnan(window), axis=0)
+    lower = np.take_along_axis(window, ((nvalid - 1) // 2)[np.newaxis], axis=0)[0]
+    upper = np.take_along_axis(window, (nvalid // 2)[np.newaxis], axis=0)[0]
+    patch_med = (lower + upper) / 2
+    patch_range = np.take_along_axis(window, (nvalid - 1)[np.newaxis], axis=0)[0] - window[0]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        spikes = (patch_range > 1e-6) & (np.abs(values - patch_med) / patch_range > thres)
+    return np.where(spikes, patch_med, values)
+
+
 def _unwrap(fmap_data, mag_file, mask=None):
     from math import pi
     from nipype.interfaces.fsl import PRELUDE
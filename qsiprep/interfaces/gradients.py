@@ -2,7 +2,6 @@
 """Handle merging and spliting of DSI files."""
 import os
 import logging
-from subprocess import Popen, PIPE
 import nibabel as nb
 import numpy as np
 import pandas as pd
@@ -11,22 +10,16 @@ from nipype.interfaces.base import (BaseInterfaceInputSpec, TraitedSpec, File, S
 from nipype.interfaces import afni, ants
 from nipype.utils.filemanip import fname_presuffix
 from nipype.interfaces.ants.resampling import ApplyTransformsInputSpec
-from dipy.sims.voxel import all_tensor_evecs
-from dipy.reconst.dti import decompose_tensor
-from dipy.core.geometry import normalized_vector
-from sklearn.metrics.regression import r2_score
+from scipy.spatial import cKDTree
 
 from .itk import disassemble_transform
+from ..utils.nifti import extract_volumes
+from ..utils.transforms import (read_itk_affine, write_itk_affine, compose_affines,
+                                compose_displacement_field, is_itk_affine, fsl_motion_params)
 
 LOGGER = logging.getLogger('nipype.interface')
-tensor_index = {
-    "xx": (0, 0),
-    "xy": (0, 1),
-    "xz": (0, 2),
-    "yy": (1, 1),
-    "yz": (1, 2),
-    "zz": (2, 2)
-}
+# ITK displacement fields and points are in LPS, NIfTI affines in RAS
+RAS_TO_LPS = np.diag([-1., -1., 1.])
 
 
 class RemoveDuplicatesInputSpec(BaseInterfaceInputSpec):
@@ -55,37 +48,18 @@ class RemoveDuplicates(SimpleInterface):
         orig_bvals = bvals.copy()
         bvals = np.sqrt(bvals-bvals.min())
         bvals = bvals/bvals.max() * 100
-        original_image = nb.load(self.inputs.dwi_file)
         cutoff = self.inputs.distance_cutoff
 
         scaled_bvecs = bvals[:, np.newaxis] * bvecs
-        ok_vecs = []
-        seen_vecs = []
-
-        def is_unique_sample(vec):
-            if len(seen_vecs) == 0:
-                return True
-            vec_array = np.row_stack(seen_vecs)
-            distances = np.linalg.norm(vec_array - vec, axis=1)
-            distances_flip = np.linalg.norm(vec_array + vec, axis=1)
-            return np.all(distances > cutoff) and np.all(distances_flip > cutoff)
-
-        for vec_num, vec in enumerate(scaled_bvecs):
-            magnitude = np.linalg.norm(vec)
-            # Is it a b0?
-            if magnitude < cutoff:
-                ok_vecs.append(vec_num)
-            else:
-                if is_unique_sample(vec):
-                    ok_vecs.append(vec_num)
-                    seen_vecs.append(vec)
+        ok_vecs = unique_qspace_samples(scaled_bvecs, cutoff)
+        num_unique = np.sum(np.linalg.norm(scaled_bvecs[ok_vecs], axis=1) >= cutoff)
 
         # If an expected number of directions was specified, check that it's there
         expected = self.inputs.expected_directions
         if isdefined(expected):
-            if not len(seen_vecs) == expected:
+            if not num_unique == expected:
                 raise Exception("Expected %d unique samples but found %d",
-                                expected, len(seen_vecs))
+                                expected, num_unique)
 
         # Are all the directions unique?
         if len(ok_vecs) == len(bvals):
@@ -108,16 +82,58 @@ class RemoveDuplicates(SimpleInterface):
         np.savetxt(output_bval, unique_bvals, fmt='%d', newline=' ')
         unique_bvecs = bvecs[unique_indices]
         np.savetxt(output_bvec, unique_bvecs.T, fmt='%.8f')
-        unique_data = original_image.get_data()[..., unique_indices]
-        nb.Nifti1Image(unique_data, original_image.affine, original_image.header
-                       ).to_filename(output_nii)
+        extract_volumes(self.inputs.dwi_file, unique_indices, output_nii)
         self._results['bval_file'] = output_bval
         self._results['bvec_file'] = output_bvec
         self._results['dwi_file'] = output_nii
-        # TODO: support local bvecs
+        if isdefined(self.inputs.local_bvec_file):
+            output_local_bvec = fname_presuffix(self.inputs.local_bvec_file,
+                                                newpath=runtime.cwd, suffix="_unique")
+            extract_volumes(self.inputs.local_bvec_file, unique_indices, output_local_bvec)
+            self._results['local_bvec_file'] = output_local_bvec
         return runtime
 
 
+def unique_qspace_samples(scaled_bvecs, cutoff):
+    """Find the samples that are not repeats of an earlier sample in q-space.
+
+    Samples closer than ``cutoff`` to the origin (b=0) are always kept. Any
+    other sample is kept if no sample kept before it is within ``cutoff`` of
+    it or of its antipode. The neighbors of all samples are found at once
+    with a KD-tree over the samples and their antipodes.
+
+    Parameters
+    ----------
+    scaled_bvecs : (N, 3) array
+        gradient directions scaled by their q-space radius
+    cutoff : float
+        distance under which two samples are considered the same
+
+    Returns
+    -------
+    ok_vecs : list of int
+        indices of the samples to keep, in their original order
+    """
+    is_b0 = np.linalg.norm(scaled_bvecs, axis=1) < cutoff
+    dw_indices = np.flatnonzero(~is_b0)
+    if not len(dw_indices):
+        return list(range(len(scaled_bvecs)))
+    dw_vecs = scaled_bvecs[dw_indices]
+    tree = cKDTree(np.row_stack([dw_vecs, -dw_vecs]))
+    neighbors = tree.query_ball_point(dw_vecs, r=cutoff)
+
+    keep = is_b0.copy()
+    repeated = np.zeros(len(dw_indices), dtype=bool)
+    for dw_num in range(len(dw_indices)):
+        if repeated[dw_num]:
+            continue
+        keep[dw_indices[dw_num]] = True
+        # Everything close to a kept sample (or its antipode) is a repeat
+        close = np.array(neighbors[dw_num], dtype=int) % len(dw_indices)
+        repeated[close[close > dw_num]] = True
+    return np.flatnonzero(keep).tolist()
+
+
 class SliceQCInputSpec(BaseInterfaceInputSpec):
     uncorrected_dwi_files = InputMultiObject(File(exists=True), desc='uncorrected dwi files')
     ideal_image_files = InputMultiObject(File(exists=True), desc='model-based images')
@@ -142,8 +158,6 @@ class SliceQC(SimpleInterface):
         uncorrected_image_files = self.inputs.uncorrected_dwi_files
 
         self._results['imputed_images'] = self.inputs.uncorrected_dwi_files
-        if threshold > 0:
-            LOGGER.warning("Imputation is not implemented yet")
 
         output_npz = os.path.join(runtime.cwd, "slice_stats.npz")
         mask_img = nb.load(self.inputs.mask_image)
@@ -157,56 +171,135 @@ class SliceQC(SimpleInterface):
             masked_slices[masked_slices == small_slice] = 0
         valid_slices = slice_nums[slice_counts > min_size]
         valid_slices = valid_slices[valid_slices > 0]
-        slice_scores = []
-        wb_xcorrs = []
-        wb_r2s = []
+        imputed_slices = np.zeros((len(uncorrected_image_files), len(valid_slices)), dtype=bool)
         # If impute slice threshold==0 or hmc_model=="none"
         if isdefined(ideal_image_files):
-            for ideal_image, input_image in zip(ideal_image_files,
-                                                uncorrected_image_files):
-                slices, wb_xcorr, wb_r2 = _score_slices(ideal_image, input_image,
-                                                        masked_slices, valid_slices)
-                slice_scores.append(slices)
-                wb_xcorrs.append(wb_xcorr)
-                wb_r2s.append(wb_r2)
+            slice_scores, wb_xcorrs, wb_r2s = _score_slices(
+                ideal_image_files, uncorrected_image_files, masked_slices, valid_slices)
+            if threshold > 0:
+                imputed_slices = _find_outlier_slices(slice_scores, threshold)
+                self._results['imputed_images'] = _impute_slices(
+                    ideal_image_files, uncorrected_image_files, masked_slices, valid_slices,
+                    imputed_slices, runtime.cwd)
         else:
             num_trs = len(uncorrected_image_files)
             num_slices = mask_img.shape[2]
             wb_xcorrs = np.zeros(num_trs)
             wb_r2s = np.zeros(num_trs)
             slice_scores = np.zeros((num_slices, num_trs))
+            if threshold > 0:
+                LOGGER.warning("No model-based images to impute slices from")
 
         np.savez(output_npz, slice_scores=slice_scores, wb_r2s=np.array(wb_r2s),
                  wb_xcorrs=np.array(wb_xcorrs), valid_slices=valid_slices,
-                 masked_slices=masked_slices, slice_nums=slice_nums, slice_counts=slice_counts)
+                 masked_slices=masked_slices, slice_nums=slice_nums, slice_counts=slice_counts,
+                 imputed_slices=imputed_slices)
         self._results['slice_stats'] = output_npz
         return runtime
 
 
-def _score_slices(ideal_image, input_image, masked_slices, valid_slices):
-    """Compute similarity metrics on a pair of images."""
-    def crosscor(vec1, vec2):
-        v1bar = vec1 - vec1.mean()
-        v2bar = vec2 - vec2.mean()
-        return np.inner(v1bar, v2bar)**2 / (np.inner(v1bar, v1bar) * np.inner(v2bar, v2bar))
-
-    slice_scores = np.zeros(valid_slices.shape)
-    ideal_data = nb.load(ideal_image).get_fdata()
-    input_data = nb.load(input_image).get_fdata()
-    for nslice, slicenum in enumerate(valid_slices):
-        slice_mask = masked_slices == slicenum
-        ideal_slice = ideal_data[slice_mask]
-        data_slice = input_data[slice_mask]
-        slice_scores[nslice] = crosscor(ideal_slice, data_slice)
+def _load_slice_voxels(image_files, voxel_mask):
+    """Load the masked voxels of a series of 3D images, ordered by slice.
 
+    Returns a (voxels, volumes) array. Each image is read once and only its
+    masked voxels are kept.
+    """
+    slice_major_mask = np.moveaxis(voxel_mask, 2, 0)
+    series = np.zeros((slice_major_mask.sum(), len(image_files)))
+    for volume_num, image_file in enumerate(image_files):
+        volume = np.asanyarray(nb.load(image_file).dataobj)
+        series[:, volume_num] = np.moveaxis(volume, 2, 0)[slice_major_mask]
+    return series
+
+
+def _grouped_xcorr(ideal, observed, starts, counts):
+    """Squared correlation within each group of rows, for every column."""
+    def centered(data):
+        means = np.add.reduceat(data, starts, axis=0) / counts[:, np.newaxis]
+        return data - np.repeat(means, counts, axis=0)
+
+    ideal_bar = centered(ideal)
+    observed_bar = centered(observed)
+    covariance = np.add.reduceat(ideal_bar * observed_bar, starts, axis=0)
+    ideal_var = np.add.reduceat(ideal_bar ** 2, starts, axis=0)
+    observed_var = np.add.reduceat(observed_bar ** 2, starts, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return covariance ** 2 / (ideal_var * observed_var)
+
+
+def _score_slices(ideal_images, input_images, masked_slices, valid_slices):
+    """Compute similarity metrics between model-based and observed images.
+
+    All slices of all volumes are scored at once: the voxels are sorted by
+    slice and the sums are computed per slice with ``np.add.reduceat``.
+
+    Returns
+    -------
+    slice_scores : (volumes, valid slices) array
+        squared correlation between the model and the data in each slice
+    global_xcorr : (volumes,) array
+        squared correlation in the whole mask
+    global_r2 : (volumes,) array
+        r^2 of the model in the whole mask
+    """
     global_mask = masked_slices > 0
-    wb_ideal = ideal_data[global_mask]
-    wb_input = input_data[global_mask]
-    global_xcorr = crosscor(wb_input, wb_ideal)
-    global_r2 = r2_score(wb_input, wb_ideal)
+    ideal_data = _load_slice_voxels(ideal_images, global_mask)
+    input_data = _load_slice_voxels(input_images, global_mask)
+
+    # Voxels are ordered by slice, so each slice is a contiguous block of rows
+    slice_nums, slice_counts = np.unique(masked_slices[global_mask], return_counts=True)
+    starts = np.concatenate([[0], np.cumsum(slice_counts)[:-1]])
+    all_scores = _grouped_xcorr(ideal_data, input_data, starts, slice_counts)
+    slice_scores = all_scores[np.searchsorted(slice_nums, valid_slices)].T
+
+    num_voxels = np.array([input_data.shape[0]])
+    global_xcorr = _grouped_xcorr(input_data, ideal_data, np.array([0]), num_voxels)[0]
+    residuals = ((input_data - ideal_data) ** 2).sum(0)
+    variance = ((input_data - input_data.mean(0)) ** 2).sum(0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        global_r2 = 1 - residuals / variance
     return slice_scores, global_xcorr, global_r2
 
 
+def _find_outlier_slices(slice_scores, threshold):
+    """Find slices whose score is more than ``threshold`` SDs below expected.
+
+    The expected score of a slice and its SD are the median and the scaled
+    median absolute deviation of that slice's scores over all volumes.
+    """
+    expected = np.median(slice_scores, axis=0)
+    spread = 1.4826 * np.median(np.abs(slice_scores - expected), axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_scores = (expected - slice_scores) / spread
+    return np.nan_to_num(z_scores) > threshold
+
+
+def _impute_slices(ideal_images, input_images, masked_slices, valid_slices, imputed_slices,
+                   newpath):
+    """Replace the masked voxels of outlier slices with their model-based values.
+
+    Volumes without an outlier slice are passed through.
+    """
+    output_images = []
+    for ideal_image, input_image, bad_slices in zip(ideal_images, input_images,
+                                                    imputed_slices):
+        if not bad_slices.any():
+            output_images.append(input_image)
+            continue
+        input_img = nb.load(input_image)
+        input_data = input_img.get_fdata()
+        ideal_data = np.asanyarray(nb.load(ideal_image).dataobj)
+        impute_mask = np.isin(masked_slices, valid_slices[bad_slices])
+        input_data[impute_mask] = ideal_data[impute_mask]
+        output_image = fname_presuffix(input_image, suffix='_imputed', newpath=newpath)
+        nb.Nifti1Image(input_data, input_img.affine, input_img.header).to_filename(output_image)
+        LOGGER.info("Imputed slices %s of %s", valid_slices[bad_slices].tolist(), input_image)
+        output_images.append(output_image)
+    LOGGER.info("Imputed %d slices in %d volumes", imputed_slices.sum(),
+                imputed_slices.any(1).sum())
+    return output_images
+
+
 class CombineMotionsInputSpec(BaseInterfaceInputSpec):
     transform_files = InputMultiObject(File(exists=True), mandatory=True,
                                        desc='transform files from hmc')
@@ -225,16 +318,10 @@ class CombineMotions(SimpleInterface):
     output_spec = CombineMotionsOututSpec
 
     def _run_interface(self, runtime):
-        collected_motion = []
         output_fname = os.path.join(runtime.cwd, "motion_params.csv")
         output_spm_fname = os.path.join(runtime.cwd, "spm_movpar.txt")
-        ref_file = self.inputs.ref_file
-        for motion_file, src_file in zip(self.inputs.transform_files,
-                                         self.inputs.source_files):
-            collected_motion.append(
-                get_fsl_motion_params(motion_file, src_file, ref_file, runtime.cwd))
-
-        final_motion = np.row_stack(collected_motion)
+        final_motion = fsl_motion_params(self.inputs.transform_files, self.inputs.source_files,
+                                         self.inputs.ref_file)
         cols = ["scaleX", "scaleY", "scaleZ", "shearXY", "shearXZ",
                 "shearYZ", "rotateX", "rotateY", "rotateZ", "shiftX", "shiftY",
                 "shiftZ"]
@@ -361,8 +448,12 @@ class ComposeTransformsInputSpec(ApplyTransformsInputSpec):
 
 
 class ComposeTransformsOutputSpec(TraitedSpec):
-    out_warps = OutputMultiObject(File(exists=True),
-                                  desc='composed all transforms to output_grid')
+    out_warps = OutputMultiObject(
+        File(exists=True),
+        desc='displacement field of the transforms up to the last warp, one per image. '
+        'Images that share these transforms share the same file')
+    volume_affines = OutputMultiObject(
+        File(exists=True), desc='affine applied after out_warps, one per image')
     out_affines = OutputMultiObject(File(exists=True),
                                     desc='composed affine-only transforms to output_grid')
     transform_lists = OutputMultiObject(traits.List(File(exists=True)),
@@ -453,9 +544,9 @@ class ComposeTransforms(SimpleInterface):
 
         # If there is just a coreg transform, then we have everything
         if image_transform_names == ['b=0 to T1w']:
-            self._results['out_warps'] = image_transforms[0]
+            self._results['volume_affines'] = image_transforms[0]
             self._results['out_affines'] = image_transforms[0]
-            self._results['transform_lists'] = image_transforms
+            self._results['transform_lists'] = [[xfm] for xfm in image_transforms[0]]
             return runtime
 
         # Reverse the order for ANTs
@@ -488,32 +579,59 @@ class ComposeTransforms(SimpleInterface):
 
         # In qsiprep the transforms have already been merged
         assert len(xfms_list) == num_dwis
-        self._results['transform_lists'] = xfms_list
+
+        # Everything up to the last warp (fieldwarp, intramodal and MNI warps) is
+        # usually the same for all images: compose it once per distinct chain.
+        # The trailing affines (head motion) are kept separate for each image.
+        warp_chains = []
+        tail_affines = []
+        for in_xfm in xfms_list:
+            num_warped = max([position + 1 for position, xfm in enumerate(in_xfm)
+                              if not is_itk_affine(xfm)] + [0])
+            warp_chains.append(tuple(in_xfm[:num_warped]))
+            tail_affines.append(in_xfm[num_warped:])
+        # out_warps must line up with dwi_files, so either every image has a
+        # warp or none does
+        if any(warp_chains) and not all(warp_chains):
+            raise ValueError('Some images have warps and others do not: %s' % ', '.join(
+                dwi_file for dwi_file, chain in zip(dwi_files, warp_chains) if not chain))
+        distinct_chains = [chain for chain in
+                           sorted(set(warp_chains), key=warp_chains.index) if chain]
+        LOGGER.info("Composing %d distinct warp(s) for %d images",
+                    len(distinct_chains), num_dwis)
 
         # Inputs are ready to run in parallel
         if num_threads < 1:
             num_threads = None
 
-        if num_threads == 1:
-            out_files = [_compose_tfms((in_file, in_xfm, ifargs, i, runtime.cwd))
-                         for i, (in_file, in_xfm) in enumerate(zip(dwi_files, xfms_list))]
+        warp_args = [(dwi_files[warp_chains.index(chain)], list(chain), ifargs, index,
+                      runtime.cwd) for index, chain in enumerate(distinct_chains)]
+        if num_threads == 1 or len(warp_args) < 2:
+            out_files = [_compose_warp(args) for args in warp_args]
         else:
             from concurrent.futures import ThreadPoolExecutor
             with ThreadPoolExecutor(max_workers=num_threads) as pool:
-                mapper = pool.map(_compose_tfms, [
-                    (in_file, in_xfm, ifargs, i, runtime.cwd)
-                    for i, (in_file, in_xfm) in enumerate(zip(dwi_files, xfms_list))])
-                out_files = list(mapper)
-
-        # Collect output file names, after sorting by index
-        self._results['out_warps'] = [el[0] for el in out_files]
-        self._results['out_affines'] = [el[2] for el in out_files]
+                out_files = list(pool.map(_compose_warp, warp_args))
+        composed_warps = dict(zip(distinct_chains, [el[0] for el in out_files]))
+
+        volume_affines = _volume_affines(dwi_files, tail_affines, runtime.cwd)
+        out_affines = _compose_affine_series(dwi_files, xfms_list, ifargs['reference_image'],
+                                             runtime.cwd)
+
+        # Collect output file names
+        if any(warp_chains):
+            self._results['out_warps'] = [composed_warps[chain] for chain in warp_chains]
+        self._results['volume_affines'] = [el[0] for el in volume_affines]
+        self._results['out_affines'] = [el[0] for el in out_affines]
+        self._results['transform_lists'] = [
+            ([composed_warps[chain]] if chain else []) + [volume_affine[0]]
+            for chain, volume_affine in zip(warp_chains, volume_affines)]
 
         if save_cmd:
             self._results['log_cmdline'] = os.path.join(runtime.cwd, 'command.txt')
             with open(self._results['log_cmdline'], 'w') as cmdfile:
                 print('\n-------\n'.join(
-                      ['\n-------\n'.join([el[1], el[3]]) for el in out_files]),
+                      [el[1] for el in out_files + volume_affines + out_affines]),
                       file=cmdfile)
         return runtime
 
@@ -522,6 +640,9 @@ class GradientRotationInputSpec(BaseInterfaceInputSpec):
     affine_transforms = InputMultiObject(File(exists=True), desc='ITK affine transforms')
     bvec_files = InputMultiObject(File(exists=True), desc='list of split bvec files')
     bval_files = InputMultiObject(File(exists=True), desc='list of split bval files')
+    check_with_ants = traits.Bool(
+        False, usedefault=True,
+        desc='also rotate with antsApplyTransformsToPoints and compare the results')
 
 
 class GradientRotationOutputSpec(TraitedSpec):
@@ -548,7 +669,7 @@ class GradientRotation(SimpleInterface):
         original_bvecs = concatenate_bvecs(self.inputs.bvec_files)
         bvec_fname = out_root + ".bvec"
         commands = bvec_rotation(original_bvecs, self.inputs.affine_transforms, bvec_fname,
-                                 runtime)
+                                 runtime, check_with_ants=self.inputs.check_with_ants)
         self._results['bvecs'] = bvec_fname
 
         self._results['log_cmdline'] = os.path.join(runtime.cwd, 'command.txt')
@@ -559,8 +680,13 @@ class GradientRotation(SimpleInterface):
 
 class LocalGradientRotationInputSpec(GradientRotationInputSpec):
     warp_transforms = InputMultiObject(File(exists=True), desc='Warps')
+    affine_transforms = InputMultiObject(File(exists=True),
+                                         desc='ITK affines applied after each warp')
     mask_image = File(exists=True, desc='brain mask in the output space')
     bvec_files = InputMultiObject(File(exists=True), desc='list of split bvec files')
+    reorientation = traits.Enum(
+        'PPD', 'FS', usedefault=True,
+        desc='preservation of principal direction or finite strain reorientation')
 
 
 class LocalGradientRotationOutputSpec(TraitedSpec):
@@ -578,43 +704,19 @@ class LocalGradientRotation(SimpleInterface):
         local_bvec_fname = out_root + "_local_bvecs.nii.gz"
         self._results['local_bvecs'] = local_bvec_fname
         original_bvecs = concatenate_bvecs(self.inputs.bvec_files)
-        commands = local_bvec_rotation(original_bvecs, self.inputs.warp_transforms,
-                                       self.inputs.mask_image, runtime, local_bvec_fname)
+        warp_transforms = self.inputs.warp_transforms
+        affine_transforms = self.inputs.affine_transforms
+        commands = local_bvec_rotation(
+            original_bvecs, warp_transforms if isdefined(warp_transforms) else None,
+            self.inputs.mask_image, runtime, local_bvec_fname,
+            reorientation=self.inputs.reorientation,
+            affine_transforms=affine_transforms if isdefined(affine_transforms) else None)
         self._results['log_cmdline'] = os.path.join(runtime.cwd, 'command.txt')
         with open(self._results['log_cmdline'], 'w') as cmdfile:
-            print('\n-------\n'.join(commands[1]), file=cmdfile)
+            print('\n-------\n'.join(commands), file=cmdfile)
         return runtime
 
 
-def get_fsl_motion_params(itk_file, src_file, ref_file, working_dir):
-    tmp_fsl_file = fname_presuffix(itk_file, newpath=working_dir,
-                                   suffix='_FSL.xfm', use_ext=False)
-    fsl_convert_cmd = "c3d_affine_tool " \
-        "-ref {ref_file} " \
-        "-src {src_file} " \
-        "-itk {itk_file} " \
-        "-ras2fsl -o {fsl_file}".format(
-            src_file=src_file, ref_file=ref_file, itk_file=itk_file,
-            fsl_file=tmp_fsl_file)
-    os.system(fsl_convert_cmd)
-    proc = Popen(['avscale', '--allparams', tmp_fsl_file, src_file], stdout=PIPE,
-                 stderr=PIPE)
-    stdout, _ = proc.communicate()
-
-    def get_measures(line):
-        line = line.strip().split()
-        return np.array([float(num) for num in line[-3:]])
-
-    lines = stdout.decode("utf-8").split("\n")
-    flip = np.array([1, -1, -1])
-    rotation = get_measures(lines[6]) * flip
-    translation = get_measures(lines[8]) * flip
-    scale = get_measures(lines[10])
-    shear = get_measures(lines[12])
-
-    return np.concatenate([scale, shear, rotation, translation])
-
-
 def match_transforms(dwi_files, transforms, b0_indices):
     original_b0_indices = np.array(b0_indices)
     num_dwis = len(dwi_files)
@@ -662,15 +764,35 @@ def concatenate_bvecs(input_files):
     return stacked
 
 
-def bvec_rotation(original_bvecs, transforms, output_file, runtime):
-    """Rotate bvecs using antsApplyTransformsToPoints and antsTransformInfo."""
-    aattp_rotated = []
-    commands = []
-    for bvec, transform in zip(original_bvecs, transforms):
-        vec, cmd = aattp_rotate_vec(bvec, transform, runtime)
-        aattp_rotated.append(vec)
-        commands.append(cmd)
-    rotated_vecs = np.row_stack(aattp_rotated)
+def bvec_rotation(original_bvecs, transforms, output_file, runtime, check_with_ants=False):
+    """Rotate bvecs by the inverse of the linear part of their ITK transforms.
+
+    This is what ``antsApplyTransformsToPoints`` does to the end points of the
+    vectors, but all the bvecs are rotated at once. If ``check_with_ants`` is
+    True the vectors are also rotated with ANTs and the largest difference is
+    logged.
+    """
+    matrices = np.array([read_itk_affine(transform)[:3, :3] for transform in transforms])
+    rotated_vecs = np.linalg.solve(matrices, original_bvecs[..., np.newaxis])[..., 0]
+    norms = np.linalg.norm(rotated_vecs, axis=1)
+    nonzero = (original_bvecs ** 2).sum(1) > 0
+    rotated_vecs[nonzero] /= norms[nonzero, np.newaxis]
+    rotated_vecs[~nonzero] = original_bvecs[~nonzero]
+    commands = ["%s: rotated by the inverse of %s" % (bvec, transform)
+                for bvec, transform in zip(original_bvecs, transforms)]
+
+    if check_with_ants:
+        aattp_rotated = []
+        commands = []
+        for bvec, transform in zip(original_bvecs, transforms):
+            vec, cmd = aattp_rotate_vec(bvec, transform, runtime)
+            aattp_rotated.append(vec)
+            commands.append(cmd)
+        max_difference = np.abs(np.row_stack(aattp_rotated) - rotated_vecs).max()
+        LOGGER.info("Largest difference from antsApplyTransformsToPoints: %g", max_difference)
+        if max_difference > 1e-4:
+            LOGGER.warning("bvecs rotated with ANTs differ by up to %g", max_difference)
+
     np.savetxt(output_file, rotated_vecs.T, fmt=str("%.8f"))
     return commands
 
@@ -725,16 +847,79 @@ def _compose_tfms(args):
     nii.set_data_dtype(np.dtype('float32'))
     nii.to_filename(out_file)
 
-    # Get just the affine Transforms
-    affines = [transform for transform in in_xform if '.nii' not in transform]
-    out_affine = fname_presuffix(in_file, suffix='_affine_xform-%05d.mat' % index,
-                                 newpath=newpath, use_ext=False)
-    affine_file, affine_cmd = compose_affines(ifargs['reference_image'], affines, out_affine)
+    return (out_file, runtime.cmdline)
+
 
-    return (out_file, runtime.cmdline, affine_file, affine_cmd)
+def _compose_warp(args):
+    """Compose a chain of transforms into one displacement field.
 
+    Chains of ITK affines and NIfTI displacement fields are composed natively
+    on the output grid, anything else (e.g. h5 composites) with ANTs.
+    """
+    in_file, in_xform, ifargs, index, newpath = args
+    if not all(is_itk_affine(xfm) or '.nii' in xfm for xfm in in_xform):
+        return _compose_tfms(args)
+    out_file = fname_presuffix(in_file, suffix='_warp-%02d.nii.gz' % index,
+                               newpath=newpath, use_ext=False)
+    compose_displacement_field(in_xform, ifargs['reference_image'], out_file)
+    return (out_file, "Composed %s into %s" % (" ".join(in_xform), out_file))
+
+
+def _volume_affines(in_files, affine_lists, newpath):
+    """One affine per image from the transforms that follow its warp.
+
+    A single transform is used as it is, longer (or empty) lists are composed.
+    """
+    results = []
+    for index, (in_file, affines) in enumerate(zip(in_files, affine_lists)):
+        if len(affines) == 1:
+            results.append((affines[0], "%s applied after the warp" % affines[0]))
+            continue
+        out_affine = fname_presuffix(in_file, suffix='_volume_xform-%05d.mat' % index,
+                                     newpath=newpath, use_ext=False)
+        matrix = compose_affines([read_itk_affine(affine) for affine in affines]) \
+            if affines else np.eye(4)
+        results.append((write_itk_affine(matrix, out_affine),
+                        "Composed %s into %s" % (" ".join(affines), out_affine)))
+    return results
 
-def compose_affines(reference_image, affine_list, output_file):
+
+def _compose_affine_series(in_files, xfms_list, reference_image, newpath):
+    """Compose the affine transforms of every image in one call.
+
+    Each distinct affine file is read once and the per-image lists are
+    composed as stacks of matrices. If any transform is not an ITK affine
+    (e.g. an h5 composite), antsApplyTransforms is used instead.
+    """
+    affine_lists = [[transform for transform in in_xform if '.nii' not in transform]
+                    for in_xform in xfms_list]
+    if len(affine_lists) != len(in_files):
+        raise ValueError('Got %d transform lists for %d images' % (len(affine_lists),
+                                                                   len(in_files)))
+    num_affines = sorted(set(len(affines) for affines in affine_lists))
+    if len(num_affines) > 1:
+        raise ValueError('Every image needs the same number of affines, got %s' % num_affines)
+    out_affines = [fname_presuffix(in_file, suffix='_affine_xform-%05d.mat' % index,
+                                   newpath=newpath, use_ext=False)
+                   for index, in_file in enumerate(in_files)]
+    affine_files = set(sum(affine_lists, []))
+    if not all(affine_file.endswith(('.mat', '.txt', '.tfm')) for affine_file in affine_files):
+        return [_ants_compose_affines(reference_image, affines, out_affine)
+                for affines, out_affine in zip(affine_lists, out_affines)]
+
+    matrices = {affine_file: read_itk_affine(affine_file) for affine_file in affine_files}
+    composed = np.broadcast_to(compose_affines([
+        np.array([matrices[affines[position]] for affines in affine_lists])
+        for position in range(num_affines[0] if num_affines else 0)]),
+        (len(affine_lists), 4, 4))
+    results = []
+    for affines, out_affine, matrix in zip(affine_lists, out_affines, composed):
+        results.append((write_itk_affine(matrix, out_affine),
+                        "Composed %s into %s" % (" ".join(affines), out_affine)))
+    return results
+
+
+def _ants_compose_affines(reference_image, affine_list, output_file):
     """Use antsApplyTransforms to get a single affine from multiple affines."""
     cmd = "antsApplyTransforms -d 3 -r %s -o Linear[%s] " % (
         reference_image, output_file)
@@ -747,117 +932,99 @@ def compose_affines(reference_image, affine_list, output_file):
     return output_file, cmd
 
 
-def create_tensor_image(mask_img, direction, prefix):
-    """set intent as NIFTI_INTENT_SYMMATRIX (1005),
-    [dxx, dxy, dyy, dxz, dyz, dzz] are the components
-    info from here
-    https://github.com/ANTsX/ANTs/wiki/Importing-diffusion-tensor-data-from-other-software
+def warp_jacobian(warp_file, mask=None):
+    """Jacobian of the mapping defined by an ITK displacement field.
+
+    The displacement field maps each output voxel to its position in the
+    input image, ``x -> x + u(x)``, in LPS physical coordinates. Its Jacobian
+    ``I + du/dx`` is computed with central differences and returned for the
+    voxels in ``mask`` (all voxels if None) as an (n_voxels, 3, 3) array.
     """
-    out_fname = prefix + "_tensor.nii"
-    evecs = all_tensor_evecs(direction)
-    evals = np.diag([1.0, 0.5, 0.05])
-    tensor = np.linalg.multi_dot([evecs, evals, evecs.T])
-
-    temp_components = []
-    for direction in ['xx', 'xy', 'xz', 'yy', 'yz', 'zz']:
-        this_component = prefix + '_temp_dtiComp_%s.nii.gz' % direction
-        LOGGER.info("writing %s", this_component)
-        nb.Nifti1Image(mask_img.get_data()*tensor[tensor_index[direction]], mask_img.affine,
-                       mask_img.header).to_filename(this_component)
-        temp_components.append(this_component)
-
-    compose_cmd = 'ImageMath 3 %s ComponentTo3DTensor %s' % (
-        out_fname, prefix + '_temp_dtiComp_')
-    LOGGER.info(compose_cmd)
-    os.system(compose_cmd)
-    for temp_component in temp_components:
-        os.remove(temp_component)
-
-    return out_fname
-
-
-def reorient_tensor_image(tensor_image, warp_file, mask_img, prefix, output_fname):
-    cmds = []
-    to_remove = []
-    reoriented_tensor_fname = prefix + "reoriented_tensor.nii"
-    reorient_cmd = "ReorientTensorImage 3 %s %s %s" % (tensor_image,
-                                                       reoriented_tensor_fname,
-                                                       warp_file)
-    LOGGER.info(reorient_cmd)
-    os.system(reorient_cmd)
-    cmds.append(reorient_cmd)
-    to_remove.append(reoriented_tensor_fname)
-
-    # Load the reoriented tensor and get the principal directions out
-    reoriented_dt_img = nb.load(reoriented_tensor_fname)
-    reoriented_tensor_data = reoriented_dt_img.get_data().squeeze()
+    warp_img = nb.load(warp_file)
+    displacements = np.asarray(warp_img.dataobj, dtype=np.float32).reshape(
+        warp_img.shape[:3] + (3,))
+    if mask is None:
+        mask = np.ones(warp_img.shape[:3], dtype=bool)
+    elif mask.shape != warp_img.shape[:3]:
+        raise ValueError("%s does not match the shape of the mask" % warp_file)
+
+    # d(voxel index)/d(LPS coordinate)
+    index_per_mm = np.linalg.inv(RAS_TO_LPS.dot(warp_img.affine[:3, :3]))
+    jacobian = np.zeros((mask.sum(), 3, 3))
+    for axis in range(3):
+        # derivative of every displacement component along one voxel axis
+        derivative = np.gradient(displacements, axis=axis)[mask]
+        jacobian += derivative[:, :, np.newaxis] * index_per_mm[axis][np.newaxis, np.newaxis]
+    jacobian += np.eye(3)
+    return jacobian
+
+
+def rotate_vector_field(jacobian, bvec, reorientation='PPD'):
+    """Reorient a bvec in every voxel, given the Jacobians of the warp.
+
+    With ``PPD`` the vector is mapped by the inverse Jacobian and normalized,
+    as the global rotation maps it by the inverse affine. With ``FS`` only
+    the rotation part of the inverse Jacobian (from its polar decomposition)
+    is applied.
+    """
+    if reorientation == 'FS':
+        left, _, right = np.linalg.svd(np.linalg.inv(jacobian))
+        return np.einsum('nij,nj->ni', np.matmul(left, right), np.tile(bvec, (len(jacobian), 1)))
+    rotated = np.linalg.solve(jacobian, np.tile(bvec, (len(jacobian), 1))[..., np.newaxis])[..., 0]
+    return rotated / np.linalg.norm(rotated, axis=1)[:, np.newaxis]
+
+
+def local_bvec_rotation(original_bvecs, warp_transforms, mask_image, runtime, output_fname,
+                        reorientation='PPD', affine_transforms=None):
+    """Create a vector in each voxel that accounts for nonlinear warps.
+
+    Each volume is warped by its displacement field and then by its affine
+    (either can be None). Consecutive volumes usually share the same warp, so
+    its Jacobian is only recomputed when the warp changes. The rotated vectors
+    are written to ``output_fname`` one volume at a time so only one volume is
+    in memory.
+    """
+    from nibabel.openers import ImageOpener
 
-    mask_data = mask_img.get_data() > 0
-    output_data = np.zeros(mask_img.shape + (3,))
-
-    reoriented_tensors = reoriented_tensor_data[mask_data]
-    reoriented_vectors = np.zeros((reoriented_tensors.shape[0], 3))
-
-    def tensor_from_vec(vec):
-        """[dxx, dxy, dyy, dxz, dyz, dzz]."""
-        return np.array([
-            [vec[0], vec[1], vec[3]],
-            [vec[1], vec[2], vec[4]],
-            [vec[3], vec[4], vec[5]]
-        ])
-
-    for nrow, row in enumerate(reoriented_tensors):
-        row_tensor = tensor_from_vec(row)
-        evals, evecs = decompose_tensor(row_tensor)
-        reoriented_vectors[nrow] = evecs[:, 0]
-
-    output_data[mask_data] = normalized_vector(reoriented_vectors)
-    vector_data = get_vector_nii(output_data, mask_img.affine, mask_img.header)
-    vector_data.to_filename(output_fname)
-    os.remove(reoriented_tensor_fname)
-    os.remove(tensor_image)
-    return output_fname, reorient_cmd
-
-
-def get_vector_nii(data, affine, header):
-    hdr = header.copy()
-    hdr.set_data_dtype(np.dtype('<f4'))
-    hdr.set_intent('vector', (), '')
-    return nb.Nifti1Image(data[:, :, :, np.newaxis, :].astype(
-                          np.dtype('<f4')), affine, hdr)
-
-
-def local_bvec_rotation(original_bvecs, warp_transforms, mask_image, runtime, output_fname):
-    """Create a vector in each voxel that accounts for nonlinear warps."""
-    prefix = os.path.join(runtime.cwd, "local_bvec_")
     mask_img = nb.load(mask_image)
-    mask_data = mask_img.get_data()
-    b0_image = get_vector_nii(np.stack([np.zeros_like(mask_data)] * 3, -1), mask_img.affine,
-                              mask_img.header)
-    commands = []
-    rotated_vec_files = []
-    for vecnum, (original_bvec, warp_file) in enumerate(zip(original_bvecs, warp_transforms)):
-        num_prefix = prefix + "%03d_" % vecnum
-        out_fname = num_prefix + "rotated.nii.gz"
-        # if it's a b0, no rotation needed
-        if np.sum(original_bvec**2) == 0:
-            b0_image.to_filename(out_fname)
-            rotated_vec_files.append(out_fname)
-            commands.append("B0: No rotation")
-            continue
+    mask_data = mask_img.get_data() > 0
+    out_shape = mask_img.shape[:3] + (1, 3, len(original_bvecs))
+    if warp_transforms is None:
+        warp_transforms = [None] * len(original_bvecs)
+    if affine_transforms is None:
+        affine_transforms = [None] * len(original_bvecs)
+
+    out_hdr = mask_img.header.copy()
+    out_hdr.set_data_shape(out_shape)
+    out_hdr.set_data_dtype(np.dtype('<f4'))
+    out_hdr.set_slope_inter(np.nan, np.nan)
+    out_hdr.set_qform(mask_img.affine)
+    out_hdr.set_sform(mask_img.affine)
 
-        # otherwise, rotate it
-        tensor_fname = create_tensor_image(mask_img, original_bvec, num_prefix)
-        rotated_vector_fname, rotate_cmd = reorient_tensor_image(tensor_fname,
-                                                                 warp_file,
-                                                                 mask_img,
-                                                                 num_prefix,
-                                                                 out_fname)
-        commands.append(rotate_cmd)
-        rotated_vec_files.append(out_fname)
-    concatenated = np.stack(
-        [nb.load(img, mmap=False).get_data().astype("<f4") for img in rotated_vec_files], -1)
-    nb.Nifti1Image(concatenated, mask_img.affine, mask_img.header).to_filename(output_fname)
-    for temp_file in rotated_vec_files:
-        os.remove(temp_file)
-    return rotated_vec_files, commands
+    commands = []
+    warp_file, warp_jac = False, None
+    with ImageOpener(output_fname, 'wb') as out_file:
+        out_hdr.write_to(out_file)
+        out_file.write(b'\x00' * (out_hdr.get_data_offset() - out_file.tell()))
+        for original_bvec, volume_warp, volume_affine in zip(
+                original_bvecs, warp_transforms, affine_transforms):
+            output_data = np.zeros(mask_img.shape[:3] + (1, 3), dtype=np.float32)
+            # if it's a b0, no rotation needed
+            if np.sum(original_bvec**2) == 0:
+                commands.append("B0: No rotation")
+            else:
+                if volume_warp != warp_file:
+                    warp_file = volume_warp
+                    warp_jac = np.tile(np.eye(3), (mask_data.sum(), 1, 1)) \
+                        if warp_file is None else warp_jacobian(warp_file, mask_data)
+                jacobian = warp_jac
+                if volume_affine is not None:
+                    jacobian = np.matmul(read_itk_affine(volume_affine)[:3, :3], jacobian)
+                output_data[mask_data, 0] = rotate_vector_field(jacobian, original_bvec,
+                                                                reorientation)
+                commands.append("%s: %s reorientation by the Jacobian of %s" % (
+                    original_bvec, reorientation,
+                    " -> ".join([str(xfm) for xfm in (volume_warp, volume_affine)
+                                 if xfm is not None])))
+            out_file.write(output_data.astype('<f4').tobytes(order='F'))
+    return commands
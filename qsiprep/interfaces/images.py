@@ -24,6 +24,7 @@ from nipype.interfaces import fsl
 #    nii_ones_like, extract_wm, SignalExtraction, MatchHeader,
 #    FilledImageLike, DemeanImage, TemplateDimensions)
 from ..niworkflows.interfaces.images import ValidateImageInputSpec
+from ..utils.series import split_volumes
 
 LOGGER = logging.getLogger('nipype.interface')
 
@@ -46,12 +47,17 @@ class SplitDWIsOutputSpec(TraitedSpec):
 
 
 class SplitDWIs(SimpleInterface):
+    """Split a DWI series into single-volume files and one-line gradient files.
+
+    The volumes are named like ``fslsplit`` names them. The series is read
+    once, memory-mapped when it is uncompressed, and written one volume at a
+    time.
+    """
     input_spec = SplitDWIsInputSpec
     output_spec = SplitDWIsOutputSpec
 
     def _run_interface(self, runtime):
-        split = fsl.Split(dimension='t', in_file=self.inputs.dwi_file)
-        split_dwi_files = split.run().outputs.out_files
+        split_dwi_files = split_volumes(self.inputs.dwi_file, runtime.cwd)
 
         split_bval_files, split_bvec_files = split_bvals_bvecs(
             self.inputs.bval_file, self.inputs.bvec_file, runtime)
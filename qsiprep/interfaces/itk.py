@@ -20,10 +20,20 @@ from nipype import logging
 from nipype.utils.filemanip import fname_presuffix
 from nipype.interfaces.base import (
     traits, TraitedSpec, BaseInterfaceInputSpec, File, InputMultiPath, OutputMultiPath,
-    OutputMultiObject, SimpleInterface)
+    InputMultiObject, OutputMultiObject, SimpleInterface, isdefined)
 from nipype.interfaces.ants.resampling import ApplyTransformsInputSpec
+from ..utils.transforms import LPS_TO_RAS, apply_affine, map_points
+from ..utils.series import DWISeries, is_series
 LOGGER = logging.getLogger('nipype.interface')
 
+# Spline orders used by map_coordinates in place of the ANTs interpolators
+SPLINE_ORDERS = {
+    'LanczosWindowedSinc': 3,
+    'BSpline': 3,
+    'Linear': 1,
+    'NearestNeighbor': 0,
+}
+
 
 class DisassembleTransformInputSpec(BaseInterfaceInputSpec):
     in_file = File(exists=True, mandatory=True, desc='ANTs composite transform (h5)')
@@ -123,6 +133,103 @@ class MultiApplyTransforms(SimpleInterface):
         return runtime
 
 
+class MultiVolumeResampleInputSpec(BaseInterfaceInputSpec):
+    input_images = InputMultiObject(File(exists=True), mandatory=True,
+                                    desc='3D volumes of the series to resample, or a single '
+                                         '4D series')
+    transforms = InputMultiObject(traits.List(File(exists=True)), mandatory=True,
+                                  desc='for each volume, its transforms in ANTs order')
+    reference_image = File(exists=True, mandatory=True, desc='output grid')
+    interpolation = traits.Enum('LanczosWindowedSinc', 'BSpline', 'Linear', 'NearestNeighbor',
+                                usedefault=True, desc='interpolation method')
+    header_source = File(exists=True, desc='a Nifti file from which the header should be copied')
+    compress = traits.Bool(True, usedefault=True, desc='Use gzip compression on .nii output')
+    is_dwi = traits.Bool(True, usedefault=True, desc='if True, negative values are set to zero')
+
+
+class MultiVolumeResampleOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='resampled 4D series')
+
+
+class MultiVolumeResample(SimpleInterface):
+    """
+    Resample a series of volumes to a reference grid in a single process.
+
+    The leading transforms that all volumes share (e.g. coregistration, SDC and
+    normalization) are evaluated once on the output grid. The remaining
+    per-volume transforms (the head motion affines) are applied on top of
+    those coordinates, and every volume is interpolated straight into a
+    preallocated 4D image. The ANTs interpolators are approximated with spline
+    interpolation (cubic for LanczosWindowedSinc and BSpline).
+
+    The volumes are interpolated one after the other: ``map_coordinates``
+    holds the GIL, so threads would not run in parallel. The node only needs
+    one CPU.
+    """
+    input_spec = MultiVolumeResampleInputSpec
+    output_spec = MultiVolumeResampleOutputSpec
+
+    def _run_interface(self, runtime):
+        from scipy.ndimage import map_coordinates
+
+        input_images = self.inputs.input_images
+        series = DWISeries(input_images[0]) if is_series(input_images) else None
+        num_volumes = len(series) if series is not None else len(input_images)
+        transforms = [list(volume_transforms) for volume_transforms in self.inputs.transforms]
+        if not len(transforms) == num_volumes:
+            raise ValueError('Number of transform lists does not match number of images')
+
+        # Transforms that every volume starts with
+        num_shared = 0
+        while all(len(volume_transforms) > num_shared for volume_transforms in transforms) and \
+                len(set(volume_transforms[num_shared]
+                        for volume_transforms in transforms)) == 1:
+            num_shared += 1
+
+        ref_img = nb.load(self.inputs.reference_image)
+        ref_shape = ref_img.shape[:3]
+        ref_ijk = np.indices(ref_shape, dtype=np.float32).reshape(3, -1)
+        base_points = apply_affine(LPS_TO_RAS.dot(ref_img.affine), ref_ijk)
+        LOGGER.info('Mapping %d output voxels through %d shared transforms',
+                    base_points.shape[1], num_shared)
+        base_points = map_points(base_points, transforms[0][:num_shared])
+
+        order = SPLINE_ORDERS[self.inputs.interpolation]
+        resampled = np.zeros(ref_shape + (num_volumes,), dtype=np.float32)
+
+        for index in range(num_volumes):
+            if series is not None:
+                # A view into the memory-mapped series
+                in_affine = series.affine
+                in_data = np.asarray(series.volume(index), dtype=np.float32)
+            else:
+                in_img = nb.load(input_images[index])
+                in_affine = in_img.affine
+                in_data = np.asanyarray(in_img.dataobj, dtype=np.float32).reshape(
+                    in_img.shape[:3])
+            points = map_points(base_points, transforms[index][num_shared:])
+            ijk = apply_affine(np.linalg.inv(LPS_TO_RAS.dot(in_affine)), points)
+            resampled[..., index] = map_coordinates(
+                in_data, ijk, order=order, mode='constant', cval=0.,
+                prefilter=order > 1).reshape(ref_shape)
+
+        if self.inputs.is_dwi:
+            np.abs(resampled, out=resampled)
+        out_img = nb.Nifti1Image(resampled, ref_img.affine, ref_img.header)
+        out_img.set_data_dtype(np.float32)
+        if isdefined(self.inputs.header_source):
+            src_hdr = nb.load(self.inputs.header_source).header
+            out_img.header.set_xyzt_units(t=src_hdr.get_xyzt_units()[-1])
+            out_img.header.set_zooms(list(out_img.header.get_zooms()[:3]) +
+                                     [src_hdr.get_zooms()[3]])
+
+        ext = '.nii.gz' if self.inputs.compress else '.nii'
+        self._results['out_file'] = fname_presuffix(
+            input_images[0], suffix='_resampled' + ext, newpath=runtime.cwd, use_ext=False)
+        out_img.to_filename(self._results['out_file'])
+        return runtime
+
+
 def _applytfms(args):
     """
     Applies ANTs' antsApplyTransforms to the input image.
@@ -223,16 +330,6 @@ def disassemble_transform(transform_file, cwd):
     return [affine_out, warp_out]
 
 
-def compose_affines(reference_image, affine_list, output_file):
-    """Use antsApplyTransforms to get a single affine from multiple affines."""
-    cmd = "antsApplyTransforms -d 3 -r %s -o Linear[%s, 1] " % (
-        reference_image, output_file)
-    cmd += " ".join(["--transform %s" % trf for trf in affine_list])
-    os.system(cmd)
-    assert os.path.exists(output_file)
-    return output_file
-
-
 def rotation_matrix_from_transform(transform):
     """Get the rotation matrix from an itk transform."""
     cmd = "antsTransformInfo " + transform
@@ -14,7 +14,6 @@ from skimage import morphology as sim
 from scipy.ndimage.morphology import binary_fill_holes
 
 from nilearn.masking import compute_epi_mask
-from nilearn.image import concat_imgs
 
 from nipype import logging
 from nipype.utils.filemanip import fname_presuffix
@@ -22,6 +21,7 @@ from nipype.interfaces.base import (
     traits, isdefined, TraitedSpec, BaseInterfaceInputSpec,
     File, InputMultiPath, SimpleInterface
 )
+from ..utils.nifti import concat_niftis
 
 LOGGER = logging.getLogger('nipype.interface')
 
@@ -110,6 +110,8 @@ class MergeInputSpec(BaseInterfaceInputSpec):
     header_source = File(exists=True, desc='a Nifti file from which the header should be copied')
     compress = traits.Bool(True, usedefault=True, desc='Use gzip compression on .nii output')
     is_dwi = traits.Bool(True, usedefault=True, desc='if True, negative values are set to zero')
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc='number of threads for parallel gzip (pigz)')
 
 
 class MergeOutputSpec(TraitedSpec):
@@ -117,6 +119,7 @@ class MergeOutputSpec(TraitedSpec):
 
 
 class Merge(SimpleInterface):
+    """Concatenate images into a 4D series, streaming one volume at a time."""
     input_spec = MergeInputSpec
     output_spec = MergeOutputSpec
 
@@ -124,18 +127,11 @@ class Merge(SimpleInterface):
         ext = '.nii.gz' if self.inputs.compress else '.nii'
         self._results['out_file'] = fname_presuffix(
             self.inputs.in_files[0], suffix='_merged' + ext, newpath=runtime.cwd, use_ext=False)
-        new_nii = concat_imgs(self.inputs.in_files, dtype=self.inputs.dtype)
-
-        if isdefined(self.inputs.header_source):
-            src_hdr = nb.load(self.inputs.header_source).header
-            new_nii.header.set_xyzt_units(t=src_hdr.get_xyzt_units()[-1])
-            new_nii.header.set_zooms(list(new_nii.header.get_zooms()[:3]) +
-                                     [src_hdr.get_zooms()[3]])
-        if self.inputs.is_dwi:
-            new_nii = nb.Nifti1Image(np.abs(new_nii.get_data()), new_nii.affine, new_nii.header)
-
-        new_nii.to_filename(self._results['out_file'])
-
+        header_source = self.inputs.header_source
+        concat_niftis(self.inputs.in_files, self._results['out_file'],
+                      dtype=np.dtype(self.inputs.dtype),
+                      header_source=header_source if isdefined(header_source) else None,
+                      abs_values=self.inputs.is_dwi, num_threads=self.inputs.num_threads)
         return runtime
 
 
@@ -12,20 +12,28 @@ import os.path as op
 import nibabel as nb
 import numpy as np
 import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import pandas as pd
+from pkg_resources import resource_filename as pkgrf
 from skimage import measure
 import imageio
 from nipype import logging
+from nipype.interfaces import ants
 from nipype.interfaces.base import (
     traits, TraitedSpec, BaseInterfaceInputSpec, File, SimpleInterface, InputMultiObject,
     OutputMultiObject, isdefined
 )
-from .gradients import concatenate_bvecs, concatenate_bvals
+from .gradients import concatenate_bvecs, concatenate_bvals, CombineMotions, GradientRotation
 from dipy.core.gradients import gradient_table
-from ..utils.brainsuite_shore import BrainSuiteShoreModel, brainsuite_shore_basis
+from ..utils.brainsuite_shore import BrainSuiteShoreModel, cached_shore_basis
+from ..utils.registration import REGISTRATION_ERRORS, registration_stages, register_to_file
+from ..utils.series import load_volumes, iter_image_volumes
 from .reports import SummaryInterface, SummaryOutputSpec
 import seaborn as sns
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 LOGGER = logging.getLogger('nipype.interface')
 
@@ -79,8 +87,35 @@ def _nonoverlapping_qspace_samples(prediction_bval, prediction_bvec,
     return ok_samples
 
 
+class RunningMoments(object):
+    """Running mean and variance of a stream of equally shaped arrays.
+
+    Uses Welford's updates, which stay accurate in float32 because the
+    squared deviations are taken from the current mean rather than
+    accumulated as raw sums of squares.
+    """
+
+    def __init__(self, shape, dtype=np.float32):
+        self.count = 0
+        self.mean = np.zeros(shape, dtype=dtype)
+        self.m2 = np.zeros(shape, dtype=dtype)
+
+    def update(self, values):
+        self.count += 1
+        delta = values - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (values - self.mean)
+
+    @property
+    def variance(self):
+        """Population variance (``ddof=0``, like ``np.var``)."""
+        return self.m2 / self.count
+
+
 class B0MeanInputSpec(BaseInterfaceInputSpec):
     b0_images = InputMultiObject(File(exists=True), mandatory=True)
+    accumulate_float64 = traits.Bool(False, usedefault=True,
+                                     desc='accumulate the mean in float64 instead of float32')
 
 
 class B0MeanOutputSpec(TraitedSpec):
@@ -88,14 +123,18 @@ class B0MeanOutputSpec(TraitedSpec):
 
 
 class B0Mean(SimpleInterface):
+    """Average the b=0 images, reading one volume at a time."""
     input_spec = B0MeanInputSpec
     output_spec = B0MeanOutputSpec
 
     def _run_interface(self, runtime):
-        b0_images = [nb.load(fname) for fname in self.inputs.b0_images]
-        b0_mean = np.stack([img.get_fdata() for img in b0_images], -1).mean(3)
+        first_img = nb.load(self.inputs.b0_images[0])
+        dtype = np.float64 if self.inputs.accumulate_float64 else np.float32
+        b0_mean = RunningMoments(first_img.shape[:3], dtype)
+        for volume in iter_image_volumes(self.inputs.b0_images):
+            b0_mean.update(volume.astype(dtype))
         mean_file = op.join(runtime.cwd, "b0_mean.nii.gz")
-        nb.Nifti1Image(b0_mean, b0_images[0].affine, b0_images[0].header
+        nb.Nifti1Image(b0_mean.mean, first_img.affine, first_img.header
                        ).to_filename(mean_file)
         self._results['average_image'] = mean_file
         return runtime
@@ -139,12 +178,8 @@ class ExtractDWIsForModel(SimpleInterface):
 
 
 def quick_load_images(image_list, dtype=np.float32):
-    example_img = nb.load(image_list[0])
-    num_images = len(image_list)
-    output_matrix = np.zeros(tuple(example_img.shape) + (num_images,), dtype=dtype)
-    for image_num, image_path in enumerate(image_list):
-        output_matrix[..., image_num] = nb.load(image_path).get_fdata(dtype=dtype)
-    return output_matrix
+    """Load 3D images, or a single 4D series, into a 4D array."""
+    return load_volumes(image_list, dtype=dtype)
 
 
 class SignalPredictionInputSpec(BaseInterfaceInputSpec):
@@ -191,7 +226,8 @@ class SignalPrediction(SimpleInterface):
         training_mask = _nonoverlapping_qspace_samples(
             pred_val, pred_vec, all_bvals, all_bvecs, self.inputs.minimal_q_distance)
         training_indices = np.flatnonzero(training_mask[1:])
-        training_image_paths = [self.inputs.aligned_b0_mean] + [
+        # The b=0 mean is excluded too when predicting a b=0 image
+        training_image_paths = [self.inputs.aligned_b0_mean] * int(training_mask[0]) + [
             all_images[idx] for idx in training_indices]
         training_bvecs = all_bvecs[training_mask]
         training_bvals = all_bvals[training_mask]
@@ -211,29 +247,172 @@ class SignalPrediction(SimpleInterface):
         prediction_bvals = np.ones(10) * pred_val
         prediction_bvals[9] = 0  # prevent warning
         prediction_gtab = gradient_table(bvals=prediction_bvals, bvecs=prediction_bvecs)
-        prediction_shore = brainsuite_shore_basis(shore_model.radial_order, shore_model.zeta,
-                                                  prediction_gtab, shore_model.tau)
+        prediction_shore = cached_shore_basis(shore_model.radial_order, shore_model.zeta,
+                                              prediction_gtab, shore_model.tau)
         prediction_dir = prediction_shore[0]
 
         # Calculate the signal prediction, reshape to 3D and save
         shore_array = shore_fit._shore_coef[mask_array]
-        output_data = np.zeros(mask_array.shape)
+        output_data = np.zeros(mask_array.shape, dtype=np.float32)
         output_data[mask_array] = np.dot(shore_array, prediction_dir)
         prediction_file = op.join(
             runtime.cwd,
             "predicted_b%d_%.2f_%.2f_%.2f.nii.gz" % (
                 (pred_val,) + tuple(np.round(pred_vec, decimals=2))))
-        nb.Nifti1Image(output_data, mask_img.affine, mask_img.header
+        nb.Nifti1Image(output_data, mask_img.affine, _float_header(mask_img)
                        ).to_filename(prediction_file)
         self._results['predicted_image'] = prediction_file
 
         return runtime
 
 
+class SignalPredictionAllInputSpec(BaseInterfaceInputSpec):
+    aligned_dwis = InputMultiObject(File(exists=True))
+    aligned_bvecs = traits.Either(InputMultiObject(File(exists=True)), traits.Array)
+    bvals = traits.Either(InputMultiObject(File(exists=True)), traits.Array)
+    aligned_mask = File(exists=True, mandatory=True)
+    aligned_b0_mean = File(exists=True, mandatory=True)
+    minimal_q_distance = traits.Float(2.0, usedefault=True)
+    model = traits.Str('3dSHORE', usedefault=True)
+
+
+class SignalPredictionAllOutputSpec(TraitedSpec):
+    predicted_images = OutputMultiObject(File(exists=True))
+
+
+class SignalPredictionAll(SimpleInterface):
+    """Leave-one-out signal prediction for every volume in ``aligned_dwis``.
+
+    Produces the same images as running :class:`SignalPrediction` once per volume,
+    but the aligned series is loaded once and the SHORE basis is built once. Each
+    held-out fit is obtained by downdating the regularized normal equations of the
+    full fit by the rows excluded by ``_nonoverlapping_qspace_samples``.
+    """
+    input_spec = SignalPredictionAllInputSpec
+    output_spec = SignalPredictionAllOutputSpec
+
+    def _run_interface(self, runtime):
+        # Load the mask image:
+        mask_img = nb.load(self.inputs.aligned_mask)
+        mask_array = mask_img.get_data() > 1e-6
+        all_images = self.inputs.aligned_dwis
+        if isinstance(self.inputs.aligned_bvecs, np.ndarray):
+            bvecs = self.inputs.aligned_bvecs
+        else:
+            bvecs = concatenate_bvecs(self.inputs.aligned_bvecs)
+        all_bvecs = np.row_stack([np.zeros(3)] + bvecs.tolist())
+        if isinstance(self.inputs.bvals, np.ndarray):
+            bvals = self.inputs.bvals
+        else:
+            bvals = concatenate_bvals(self.inputs.bvals, None)
+        all_bvals = np.array([0.] + bvals.tolist())
+
+        # Load the masked voxels from every image, b=0 mean first
+        masked_data = quick_load_masked_images(
+            [self.inputs.aligned_b0_mean] + list(all_images), mask_array)
+
+        all_gtab = gradient_table(bvals=all_bvals, bvecs=all_bvecs)
+        if self.inputs.model == '3dSHORE':
+            shore_model = BrainSuiteShoreModel(all_gtab, regularization="L2")
+        else:
+            raise NotImplementedError('Unsupported model: ' + self.inputs.model)
+        predictions = _shore_leave_out_predictions(
+            shore_model, masked_data, all_bvals, all_bvecs, self.inputs.minimal_q_distance)
+
+        predicted_images = []
+        out_hdr = _float_header(mask_img)
+        output_data = np.zeros(mask_array.shape, dtype=np.float32)
+        for image_num, (pred_val, pred_vec) in enumerate(zip(all_bvals[1:], all_bvecs[1:])):
+            output_data[mask_array] = predictions[:, image_num]
+            prediction_file = op.join(
+                runtime.cwd,
+                "predicted_%05d_b%d_%.2f_%.2f_%.2f.nii.gz" % (
+                    (image_num, pred_val) + tuple(np.round(pred_vec, decimals=2))))
+            nb.Nifti1Image(output_data, mask_img.affine, out_hdr).to_filename(prediction_file)
+            predicted_images.append(prediction_file)
+        self._results['predicted_images'] = predicted_images
+
+        return runtime
+
+
+def _float_header(mask_img):
+    """A copy of the header of a mask for float32 data.
+
+    Masks are usually stored as integers, which would quantize predictions.
+    """
+    out_hdr = mask_img.header.copy()
+    out_hdr.set_data_dtype(np.float32)
+    return out_hdr
+
+
+def quick_load_masked_images(image_list, mask_array, dtype=np.float32):
+    """Load the in-mask voxels of each image into a (voxels, images) matrix.
+
+    ``image_list`` can also be a single 4D series, which is memory-mapped.
+    """
+    return load_volumes(image_list, mask=mask_array, dtype=dtype)
+
+
+def _shore_leave_out_predictions(shore_model, masked_data, all_bvals, all_bvecs, cutoff):
+    """Predict each non-b0 sample from an L2 SHORE fit that excludes its q-space neighbors.
+
+    The fit for a training subset ``t`` is ``(M_t'M_t + R)^-1 M_t'y``. Both terms are
+    computed from the full fit by subtracting the contribution of the excluded rows,
+    so each prediction costs a small solve and two products against the data.
+    Volumes that share an exclusion pattern share a single solve.
+
+    Parameters
+    ----------
+    shore_model : BrainSuiteShoreModel
+        model built on the full gradient table (b=0 mean first)
+    masked_data : ndarray, shape (n_voxels, n_samples)
+        signal for every sample in the gradient table
+    all_bvals : ndarray, shape (n_samples,)
+    all_bvecs : ndarray, shape (n_samples, 3)
+    cutoff : float
+        minimal q-space distance between a prediction and its training samples
+
+    Returns
+    -------
+    predictions : ndarray, shape (n_voxels, n_samples - 1)
+    """
+    M = shore_model._shore_basis()
+    gram = np.dot(M.T, M) + shore_model.lambdaN * shore_model.Nshore + \
+        shore_model.lambdaL * shore_model.Lshore
+    # Projection of the full data onto the basis, (n_coefs, n_voxels)
+    full_projection = np.dot(M.T, masked_data.T)
+
+    # Group the volumes to predict by which samples they exclude
+    exclusion_patterns = {}
+    for sample_num in range(1, len(all_bvals)):
+        training_mask = _nonoverlapping_qspace_samples(
+            all_bvals[sample_num], all_bvecs[sample_num], all_bvals, all_bvecs, cutoff)
+        exclusion_patterns.setdefault(training_mask.tobytes(), (training_mask, []))[1].append(
+            sample_num)
+
+    LOGGER.info("Predicting %d samples from %d distinct training sets",
+                len(all_bvals) - 1, len(exclusion_patterns))
+    predictions = np.zeros((masked_data.shape[0], len(all_bvals) - 1), dtype=np.float32)
+    for training_mask, sample_nums in exclusion_patterns.values():
+        excluded = np.flatnonzero(~training_mask)
+        M_excluded = M[excluded]
+        # Weights mapping the training data onto each prediction direction
+        weights = np.linalg.solve(
+            gram - np.dot(M_excluded.T, M_excluded), M[sample_nums].T)
+        predicted = np.dot(weights.T, full_projection) - np.dot(
+            np.dot(weights.T, M_excluded.T), masked_data[:, excluded].T)
+        predictions[:, np.array(sample_nums) - 1] = predicted.T
+
+    return predictions
+
+
 class CalculateCNRInputSpec(BaseInterfaceInputSpec):
     hmc_warped_images = InputMultiObject(File(exists=True))
     predicted_images = InputMultiObject(File(exists=True))
     mask_image = File(exists=True)
+    accumulate_float64 = traits.Bool(False, usedefault=True,
+                                     desc='accumulate the variances in float64 instead of '
+                                          'float32')
 
 
 class CalculateCNROutputSpec(TraitedSpec):
@@ -241,26 +420,39 @@ class CalculateCNROutputSpec(TraitedSpec):
 
 
 class CalculateCNR(SimpleInterface):
+    """Ratio of the variance of the model signal to the variance of its residuals.
+
+    Both are normalized by the first predicted image (the b=0) and computed
+    over the masked voxels, one volume at a time.
+    """
     input_spec = CalculateCNRInputSpec
     output_spec = CalculateCNROutputSpec
 
     def _run_interface(self, runtime):
         cnr_file = op.join(runtime.cwd, "SHORELine_CNR.nii.gz")
-        model_images = quick_load_images(self.inputs.predicted_images)
-        observed_images = quick_load_images(self.inputs.hmc_warped_images)
         mask_image = nb.load(self.inputs.mask_image)
         mask = mask_image.get_data() > 1e-6
-        signal_vals = model_images[mask]
-        b0 = signal_vals[:, 0][:, np.newaxis]
-        signal_vals = signal_vals / b0
-        signal_var = np.var(signal_vals, 1)
-        observed_vals = observed_images[mask] / b0
-        noise_var = np.var(signal_vals - observed_vals, 1)
-        snr = np.nan_to_num(signal_var / noise_var)
-        out_mat = np.zeros(mask_image.shape)
+        dtype = np.float64 if self.inputs.accumulate_float64 else np.float32
+        signal = RunningMoments(mask.sum(), dtype)
+        noise = RunningMoments(mask.sum(), dtype)
+        b0 = None
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for model_volume, observed_volume in zip(
+                    iter_image_volumes(self.inputs.predicted_images),
+                    iter_image_volumes(self.inputs.hmc_warped_images)):
+                model_vals = model_volume[mask].astype(dtype)
+                if b0 is None:
+                    b0 = model_vals
+                signal_vals = model_vals / b0
+                signal.update(signal_vals)
+                noise.update(signal_vals - observed_volume[mask].astype(dtype) / b0)
+            snr = np.nan_to_num(signal.variance / noise.variance)
+        out_mat = np.zeros(mask_image.shape, dtype=np.float32)
         out_mat[mask] = snr
-        nb.Nifti1Image(out_mat, mask_image.affine,
-                       header=mask_image.header).to_filename(cnr_file)
+        # The mask is usually stored as integers, which would quantize the CNR
+        out_hdr = mask_image.header.copy()
+        out_hdr.set_data_dtype(np.float32)
+        nb.Nifti1Image(out_mat, mask_image.affine, header=out_hdr).to_filename(cnr_file)
         self._results['cnr_image'] = cnr_file
         return runtime
 
@@ -317,6 +509,242 @@ class ReorderOutputs(SimpleInterface):
         return runtime
 
 
+def motion_deltas(previous_motion_file, motion_file):
+    """Per-volume change in the motion estimates between two SHORELine iterations.
+
+    Parameters
+    ----------
+    previous_motion_file, motion_file : str
+        ``motion_params.csv`` files written by :class:`CombineMotions`
+
+    Returns
+    -------
+    shift_deltas : array
+        largest absolute change in translation (mm) of each volume
+    rotate_deltas : array
+        largest absolute change in rotation (degrees) of each volume
+    """
+    previous = pd.read_csv(previous_motion_file)
+    current = pd.read_csv(motion_file)
+    shift_cols = ['shiftX', 'shiftY', 'shiftZ']
+    rotate_cols = ['rotateX', 'rotateY', 'rotateZ']
+    shift_deltas = np.abs(current[shift_cols].values - previous[shift_cols].values).max(1)
+    rotate_deltas = np.abs(current[rotate_cols].values - previous[rotate_cols].values).max(1)
+    return shift_deltas, np.rad2deg(rotate_deltas)
+
+
+def _ants_register(moving_image, fixed_image, mask_image, ants_settings, reg_dir):
+    """Register one volume to its prediction with antsRegistration.
+
+    Output paths are absolute so that several registrations can run in
+    threads without changing the working directory.
+    """
+    reg = ants.Registration(from_file=ants_settings, fixed_image=fixed_image,
+                            moving_image=moving_image, fixed_image_masks=mask_image,
+                            output_transform_prefix=op.join(reg_dir, 'transform'),
+                            output_warped_image=op.join(reg_dir, 'transform_Warped.nii.gz'))
+    reg.terminal_output = 'allatonce'
+    reg.resource_monitor = False
+    result = reg.run()
+    return result.outputs.forward_transforms, result.outputs.warped_image
+
+
+class RegisterToPredictedInputSpec(BaseInterfaceInputSpec):
+    moving_images = InputMultiObject(File(exists=True), mandatory=True,
+                                     desc='dwi volumes before motion correction')
+    fixed_images = InputMultiObject(File(exists=True), mandatory=True,
+                                    desc='model predictions, one per moving image')
+    fixed_image_mask = File(exists=True, mandatory=True,
+                            desc='mask on the grid of the predictions')
+    ants_settings = File(exists=True, mandatory=True,
+                         desc='antsRegistration json, also used for the in-process stages')
+    use_ants = traits.Bool(False, usedefault=True,
+                           desc='run antsRegistration for every volume')
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc='number of volumes registered in parallel')
+
+
+class RegisterToPredictedOutputSpec(TraitedSpec):
+    forward_transforms = traits.List(desc='ITK affine of each volume, as a one-item list')
+    warped_images = OutputMultiObject(File(exists=True))
+
+
+class RegisterToPredicted(SimpleInterface):
+    """Register every volume to its model prediction in a single process.
+
+    The settings and the mask are read once and the volume/prediction pairs
+    are registered on a pool of ``num_threads`` threads with the Mattes mutual
+    information optimizer of :mod:`qsiprep.utils.registration`, following the
+    stages and pyramid levels of ``ants_settings``. A volume whose in-process
+    registration fails is registered with antsRegistration instead. The
+    transforms and warped images have the same names as those written by
+    antsRegistration (``transform0GenericAffine.mat`` and
+    ``transform_Warped.nii.gz``), in one directory per volume.
+    """
+    input_spec = RegisterToPredictedInputSpec
+    output_spec = RegisterToPredictedOutputSpec
+
+    def _run_interface(self, runtime):
+        moving_images = self.inputs.moving_images
+        fixed_images = self.inputs.fixed_images
+        if not len(moving_images) == len(fixed_images):
+            raise ValueError('Number of moving images does not match number of fixed images')
+
+        mask_img = nb.load(self.inputs.fixed_image_mask)
+        fixed_mask = (np.asanyarray(mask_img.dataobj) > 0).astype(np.int32)
+        stages, interpolation = registration_stages(self.inputs.ants_settings,
+                                                    mask_img.header.get_zooms()[:3])
+
+        def _register_volume(index):
+            reg_dir = op.join(runtime.cwd, '_register%04d' % index)
+            os.makedirs(reg_dir, exist_ok=True)
+            if not self.inputs.use_ants:
+                try:
+                    transform_file, warped_file = register_to_file(
+                        fixed_images[index], moving_images[index], stages,
+                        op.join(reg_dir, 'transform0GenericAffine.mat'),
+                        op.join(reg_dir, 'transform_Warped.nii.gz'),
+                        fixed_mask=fixed_mask, interpolation=interpolation)
+                    return [transform_file], warped_file
+                except REGISTRATION_ERRORS as err:
+                    LOGGER.warning('In-process registration of %s failed (%s), using '
+                                   'antsRegistration', moving_images[index], err)
+            return _ants_register(moving_images[index], fixed_images[index],
+                                  self.inputs.fixed_image_mask, self.inputs.ants_settings,
+                                  reg_dir)
+
+        num_threads = self.inputs.num_threads
+        if num_threads < 1:
+            num_threads = None
+        if num_threads == 1:
+            registrations = [_register_volume(index) for index in range(len(moving_images))]
+        else:
+            with ThreadPoolExecutor(max_workers=num_threads) as pool:
+                registrations = list(pool.map(_register_volume, range(len(moving_images))))
+
+        self._results['forward_transforms'] = [transforms for transforms, _ in registrations]
+        self._results['warped_images'] = [warped for _, warped in registrations]
+        return runtime
+
+
+class SHORELineInputSpec(BaseInterfaceInputSpec):
+    original_dwi_files = InputMultiObject(File(exists=True), mandatory=True,
+                                          desc='dwi volumes (no b0s) before motion correction')
+    original_bvecs = InputMultiObject(File(exists=True), mandatory=True)
+    bvals = InputMultiObject(File(exists=True), mandatory=True)
+    approx_aligned_dwi_files = InputMultiObject(File(exists=True), mandatory=True,
+                                                desc='dwi volumes aligned by the b0 transforms')
+    approx_aligned_bvecs = traits.Either(InputMultiObject(File(exists=True)), traits.Array,
+                                         mandatory=True)
+    b0_mask = File(exists=True, mandatory=True)
+    b0_mean = File(exists=True, mandatory=True)
+    model = traits.Str('3dSHORE', usedefault=True)
+    transform = traits.Enum('Rigid', 'Affine', usedefault=True)
+    num_iterations = traits.Range(low=1, value=2, usedefault=True,
+                                  desc='maximum number of iterations')
+    translation_tolerance = traits.Float(
+        0., usedefault=True,
+        desc='stop when no volume moved more than this (mm) since the previous iteration')
+    rotation_tolerance = traits.Float(
+        0., usedefault=True,
+        desc='stop when no volume rotated more than this (degrees) since the previous '
+             'iteration')
+    use_ants = traits.Bool(False, usedefault=True,
+                           desc='register the volumes with antsRegistration')
+    num_threads = traits.Int(1, usedefault=True, nohash=True)
+
+
+class SHORELineOutputSpec(TraitedSpec):
+    hmc_transforms = traits.List()
+    aligned_dwis = OutputMultiObject(File(exists=True))
+    aligned_bvecs = File(exists=True)
+    predicted_dwis = OutputMultiObject(File(exists=True))
+    motion_files = OutputMultiObject(File(exists=True))
+    num_iterations = traits.Int()
+
+
+class SHORELine(SimpleInterface):
+    """Iterate SHORELine until the motion estimates stop changing.
+
+    Each iteration predicts every volume from the others with
+    :class:`SignalPredictionAll`, registers the original volumes to their
+    predictions and rotates the bvecs. The first iteration uses the coarse
+    registration settings and the later ones the precise settings. After the
+    second iteration, the loop stops early once no volume has moved more than
+    ``translation_tolerance`` and rotated more than ``rotation_tolerance``
+    since the previous iteration. Tolerances of 0 run all ``num_iterations``.
+
+    The registrations of an iteration run in parallel on ``num_threads`` threads,
+    with :class:`RegisterToPredicted`.
+    """
+    input_spec = SHORELineInputSpec
+    output_spec = SHORELineOutputSpec
+
+    def _run_interface(self, runtime):
+        aligned_dwis = self.inputs.approx_aligned_dwi_files
+        aligned_bvecs = self.inputs.approx_aligned_bvecs
+        original_dwis = self.inputs.original_dwi_files
+        num_threads = self.inputs.num_threads
+        motion_files = []
+
+        for iter_num in range(self.inputs.num_iterations):
+            iter_dir = op.join(runtime.cwd, 'shoreline_iteration%03d' % iter_num)
+            precision = 'coarse' if iter_num == 0 else 'precise'
+            ants_settings = pkgrf(
+                'qsiprep', 'data/shoreline_{precision}_{transform}.json'.format(
+                    precision=precision, transform=self.inputs.transform))
+
+            predict_dir = op.join(iter_dir, 'predict_dwis')
+            os.makedirs(predict_dir, exist_ok=True)
+            predict_dwis = SignalPredictionAll(
+                aligned_dwis=aligned_dwis, aligned_bvecs=aligned_bvecs, bvals=self.inputs.bvals,
+                aligned_mask=self.inputs.b0_mask, aligned_b0_mean=self.inputs.b0_mean,
+                model=self.inputs.model)
+            predicted_dwis = predict_dwis.run(cwd=predict_dir).outputs.predicted_images
+
+            reg_dir = op.join(iter_dir, 'register_to_predicted')
+            os.makedirs(reg_dir, exist_ok=True)
+            register_to_predicted = RegisterToPredicted(
+                moving_images=original_dwis, fixed_images=predicted_dwis,
+                fixed_image_mask=self.inputs.b0_mask, ants_settings=ants_settings,
+                use_ants=self.inputs.use_ants, num_threads=num_threads
+            ).run(cwd=reg_dir).outputs
+            hmc_transforms = register_to_predicted.forward_transforms
+            transform_files = [forward_transforms[0] for forward_transforms in hmc_transforms]
+
+            motion_dir = op.join(iter_dir, 'calculate_motion')
+            os.makedirs(motion_dir, exist_ok=True)
+            motion_file = CombineMotions(
+                transform_files=transform_files, source_files=original_dwis,
+                ref_file=self.inputs.b0_mean).run(cwd=motion_dir).outputs.motion_file
+
+            bvec_dir = op.join(iter_dir, 'post_bvec_transforms')
+            os.makedirs(bvec_dir, exist_ok=True)
+            aligned_bvecs = GradientRotation(
+                affine_transforms=transform_files, bvec_files=self.inputs.original_bvecs,
+                bval_files=self.inputs.bvals).run(cwd=bvec_dir).outputs.bvecs
+            aligned_dwis = register_to_predicted.warped_images
+
+            motion_files.append(motion_file)
+            if iter_num == 0:
+                continue
+            shift_deltas, rotate_deltas = motion_deltas(motion_files[-2], motion_file)
+            LOGGER.info('SHORELine iteration %d: largest change %.3f mm, %.3f degrees',
+                        iter_num, shift_deltas.max(), rotate_deltas.max())
+            if shift_deltas.max() < self.inputs.translation_tolerance and \
+                    rotate_deltas.max() < self.inputs.rotation_tolerance:
+                LOGGER.info('SHORELine converged after %d iterations', iter_num + 1)
+                break
+
+        self._results['hmc_transforms'] = hmc_transforms
+        self._results['aligned_dwis'] = aligned_dwis
+        self._results['aligned_bvecs'] = aligned_bvecs
+        self._results['predicted_dwis'] = predicted_dwis
+        self._results['motion_files'] = motion_files
+        self._results['num_iterations'] = len(motion_files)
+        return runtime
+
+
 class IterationSummaryInputSpec(BaseInterfaceInputSpec):
     collected_motion_files = InputMultiObject(File(exists=True))
 
@@ -344,8 +772,15 @@ class IterationSummary(SummaryInterface):
             path_parts = fname.split(os.sep)
             itername = '' if 'iter' not in path_parts[-3] else path_parts[-3]
             df['iter_name'] = itername
+            if fnum == 0:
+                df['shift_delta'] = np.nan
+                df['rotate_delta'] = np.nan
+            else:
+                df['shift_delta'], df['rotate_delta'] = motion_deltas(motion_files[fnum - 1],
+                                                                      fname)
             all_iters.append(df)
         combined = pd.concat(all_iters, axis=0, ignore_index=True)
+        combined['num_iterations'] = len(motion_files)
 
         combined.to_csv(output_fname, index=False)
         self._results['iteration_summary_file'] = output_fname
@@ -362,6 +797,12 @@ class SHORELineReportInputSpec(BaseInterfaceInputSpec):
     registered_images = InputMultiObject(File(exists=True))
     original_images = InputMultiObject(File(exists=True))
     model_predicted_images = InputMultiObject(File(exists=True))
+    max_volumes = traits.Int(0, usedefault=True,
+                             desc='if > 0, animate at most this many evenly spaced volumes')
+    out_format = traits.Enum('gif', 'mp4', usedefault=True,
+                             desc='animation format, mp4 requires imageio-ffmpeg')
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc='number of processes drawing frames')
 
 
 class SHORELineReportOutputSpec(SummaryOutputSpec):
@@ -369,32 +810,94 @@ class SHORELineReportOutputSpec(SummaryOutputSpec):
 
 
 class SHORELineReport(SummaryInterface):
+    """Animate the volumes before and after SHORELine.
+
+    The projections of all the volumes are computed first, then the frames
+    are drawn in ``num_threads`` processes and appended to the animation as
+    they come back, so the frames are never all held in memory.
+    """
     input_spec = SHORELineReportInputSpec
     output_spec = SHORELineReportOutputSpec
 
     def _run_interface(self, runtime):
-        images = []
-        for imagenum, (orig_file, aligned_file, model_file) in enumerate(zip(
-                self.inputs.original_images, self.inputs.registered_images,
-                self.inputs.model_predicted_images)):
-
-            images.extend(before_after_images(orig_file, aligned_file, model_file, imagenum))
-
-        out_file = op.join(runtime.cwd, "shoreline_reg.gif")
-        imageio.mimsave(out_file, images, fps=1)
+        num_volumes = series_length(self.inputs.original_images)
+        volume_nums = np.arange(num_volumes)
+        if 0 < self.inputs.max_volumes < num_volumes:
+            volume_nums = np.unique(
+                np.linspace(0, num_volumes - 1, self.inputs.max_volumes).round().astype(int))
+
+        orig_mips, aligned_mips, target_mips = scaled_mips(
+            series_mips(self.inputs.original_images, volume_nums),
+            series_mips(self.inputs.registered_images, volume_nums),
+            series_mips(self.inputs.model_predicted_images, volume_nums))
+        frame_args = list(zip(orig_mips, aligned_mips, target_mips, volume_nums))
+
+        out_file = op.join(runtime.cwd, "shoreline_reg." + self.inputs.out_format)
+        with imageio.get_writer(out_file, fps=1) as writer:
+            for frames in _render_frames(frame_args, self.inputs.num_threads):
+                for frame in frames:
+                    writer.append_data(frame)
         self._results['plot_file'] = out_file
         return runtime
 
 
-def scaled_mip(img1, img2, img3, axis):
-    mip1 = img1.max(axis=axis).T
-    mip2 = img2.max(axis=axis).T
-    mip3 = img3.max(axis=axis).T
-    max_obs = max(mip1.max(), mip2.max(), mip3.max())
-    vmax = 0.98 * max_obs
-    return (np.clip(mip1, 0, vmax) / vmax,
-            np.clip(mip2, 0, vmax) / vmax,
-            np.clip(mip3, 0, vmax) / vmax)
+def _render_frames(frame_args, num_threads):
+    """Yield the before/after frames of each volume, in order."""
+    num_done = 0
+    if num_threads > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=num_threads) as pool:
+                for frames in pool.map(_before_after_frames, frame_args):
+                    yield frames
+                    num_done += 1
+            return
+        except (AssertionError, OSError, BrokenProcessPool) as err:
+            # e.g. when running inside a daemonic nipype worker
+            LOGGER.warning('Unable to draw frames in parallel (%s), drawing them serially',
+                           err)
+    for args in frame_args[num_done:]:
+        yield _before_after_frames(args)
+
+
+def _before_after_frames(args):
+    return before_after_images(*args)
+
+
+def series_length(image_files):
+    """Number of volumes in a list of 3D volumes or in a single 4D series."""
+    img = nb.load(image_files[0])
+    if len(image_files) == 1 and len(img.shape) == 4:
+        return img.shape[3]
+    return len(image_files)
+
+
+def series_mips(image_files, volume_nums=None, axis=0):
+    """Maximum intensity projections of 3D volumes or of a single 4D series.
+
+    Uncompressed 4D series are memory-mapped and projected in one pass.
+
+    Returns
+    -------
+    mips : array
+        (volumes, rows, columns) projections, transposed for display
+    """
+    img = nb.load(image_files[0])
+    if len(image_files) == 1 and len(img.shape) == 4:
+        data = np.asanyarray(img.dataobj)
+        if volume_nums is not None:
+            data = data[..., volume_nums]
+        return np.moveaxis(data.max(axis=axis), -1, 0).transpose(0, 2, 1).astype(np.float32)
+    if volume_nums is not None:
+        image_files = [image_files[volume_num] for volume_num in volume_nums]
+    return np.stack([np.asanyarray(nb.load(image_file).dataobj).max(axis=axis).T
+                     for image_file in image_files]).astype(np.float32)
+
+
+def scaled_mips(*mip_stacks):
+    """Scale stacks of projections to [0, 1], with a common maximum per volume."""
+    max_obs = np.max([mips.reshape(len(mips), -1).max(1) for mips in mip_stacks], 0)
+    vmax = 0.98 * max_obs[:, np.newaxis, np.newaxis]
+    return tuple(np.clip(mips, 0, vmax) / vmax for mips in mip_stacks)
 
 
 def to_image(fig):
@@ -405,60 +908,49 @@ def to_image(fig):
     return image
 
 
-def before_after_images(orig_file, aligned_file, model_file, imagenum):
-    fig, ax = plt.subplots(ncols=2, figsize=(10, 5))
-    fig.subplots_adjust(hspace=0, left=0, right=1, wspace=0)
+def _plot_mips(ax, moving_mip, target_mip, moving_contours, target_contours, label):
     for _ax in ax:
         _ax.clear()
-    orig_img = nb.load(orig_file).get_fdata()
-    aligned_img = nb.load(aligned_file).get_fdata()
-    model_img = nb.load(model_file).get_fdata()
-    orig_mip, aligned_mip, target_mip = scaled_mip(orig_img, aligned_img, model_img, 0)
-
-    # Get contours for the orig, aligned images
-    orig_contours = measure.find_contours(orig_mip, 0.7)
-    aligned_contours = measure.find_contours(aligned_mip, 0.7)
-    target_contours = measure.find_contours(target_mip, 0.7)
-
-    orig_contours_low = measure.find_contours(orig_mip, 0.05)
-    aligned_contours_low = measure.find_contours(aligned_mip, 0.05)
-    target_contours_low = measure.find_contours(target_mip, 0.05)
-
-    # Plot before
-    ax[0].imshow(orig_mip, vmax=1., vmin=0, origin="lower", cmap="gray",
+    ax[0].imshow(moving_mip, vmax=1., vmin=0, origin="lower", cmap="gray",
                  interpolation="nearest")
     ax[1].imshow(target_mip, vmax=1., vmin=0, origin="lower", cmap="gray",
                  interpolation="nearest")
-    ax[0].text(1, 1, "%03d: Before" % imagenum, fontsize=16, color='white')
-    for contour in target_contours + target_contours_low:
+    ax[0].text(1, 1, label, fontsize=16, color='white')
+    for contour in target_contours:
         ax[0].plot(contour[:, 1], contour[:, 0], linewidth=2, alpha=0.9, color="#e7298a")
         ax[1].plot(contour[:, 1], contour[:, 0], linewidth=2, alpha=0.9, color="#e7298a")
-    for contour in orig_contours + orig_contours_low:
+    for contour in moving_contours:
         ax[1].plot(contour[:, 1], contour[:, 0], linewidth=2, alpha=0.9, color="#d95f02")
         ax[0].plot(contour[:, 1], contour[:, 0], linewidth=2, alpha=0.9, color="#d95f02")
     for axis in ax:
         axis.set_xticks([])
         axis.set_yticks([])
 
-    before_image = to_image(fig)
 
-    # Plot after
-    for _ax in ax:
-        _ax.clear()
-    ax[0].imshow(aligned_mip, vmax=1., vmin=0, origin="lower", cmap="gray",
-                 interpolation="nearest")
-    ax[1].imshow(target_mip, vmax=1., vmin=0, origin="lower", cmap="gray",
-                 interpolation="nearest")
-    ax[0].text(1, 1, "%03d: After" % imagenum, fontsize=16, color='white')
-    for contour in target_contours + target_contours_low:
-        ax[0].plot(contour[:, 1], contour[:, 0], linewidth=2, alpha=0.9, color="#e7298a")
-        ax[1].plot(contour[:, 1], contour[:, 0], linewidth=2, alpha=0.9, color="#e7298a")
-    for contour in aligned_contours + aligned_contours_low:
-        ax[1].plot(contour[:, 1], contour[:, 0], linewidth=2, alpha=0.9, color="#d95f02")
-        ax[0].plot(contour[:, 1], contour[:, 0], linewidth=2, alpha=0.9, color="#d95f02")
-    for axis in ax:
-        axis.set_xticks([])
-        axis.set_yticks([])
+def before_after_images(orig_mip, aligned_mip, target_mip, imagenum):
+    """Draw the before and after frames of one volume from its scaled projections.
+
+    The figure is drawn on an Agg canvas without pyplot, so frames can be
+    drawn in worker processes.
+    """
+    fig = Figure(figsize=(10, 5))
+    FigureCanvasAgg(fig)
+    ax = fig.subplots(ncols=2)
+    fig.subplots_adjust(hspace=0, left=0, right=1, wspace=0)
+
+    # Get contours for the orig, aligned images
+    orig_contours = measure.find_contours(orig_mip, 0.7) + \
+        measure.find_contours(orig_mip, 0.05)
+    aligned_contours = measure.find_contours(aligned_mip, 0.7) + \
+        measure.find_contours(aligned_mip, 0.05)
+    target_contours = measure.find_contours(target_mip, 0.7) + \
+        measure.find_contours(target_mip, 0.05)
+
+    _plot_mips(ax, orig_mip, target_mip, orig_contours, target_contours,
+               "%03d: Before" % imagenum)
+    before_image = to_image(fig)
+    _plot_mips(ax, aligned_mip, target_mip, aligned_contours, target_contours,
+               "%03d: After" % imagenum)
     after_image = to_image(fig)
 
     return before_image, after_image
@@ -9,6 +9,7 @@ Miscellaneous utilities
 """
 
 import os
+import subprocess
 import numpy as np
 import nibabel as nb
 import scipy.ndimage as nd
@@ -21,9 +22,11 @@ from nipype.interfaces.base import (
 )
 from nipype.interfaces.io import add_traits
 from nipype.interfaces import ants
-from ..utils.atlases import get_atlases
+from ..utils.atlases import (get_atlases, atlas_target_key, atlas_cache_key,
+                             fetch_cached_atlas, store_cached_atlas, atlas_sampling_points,
+                             resample_labels)
 
-IFLOGGER = logging.getLogger('nipype.interfaces')
+IFLOGGER = logging.getLogger('nipype.interface')
 
 
 class GetConnectivityAtlasesInputSpec(BaseInterfaceInputSpec):
@@ -31,6 +34,12 @@ class GetConnectivityAtlasesInputSpec(BaseInterfaceInputSpec):
     forward_transform = File(exists=True, desc='transform to get atlas into T1w space if desired')
     reference_image = File(exists=True, desc='')
     space = traits.Str('T1w')
+    batched = traits.Bool(
+        False, usedefault=True,
+        desc='evaluate the transform once and resample all atlases in-process. '
+        'Otherwise each atlas is resampled with antsApplyTransforms (MultiLabel)')
+    use_cache = traits.Bool(True, usedefault=True,
+                            desc='reuse atlases resampled to the same grid before')
 
 
 class GetConnectivityAtlasesOutputSpec(TraitedSpec):
@@ -53,9 +62,14 @@ class GetConnectivityAtlases(SimpleInterface):
                 transform = self.inputs.forward_transform
         else:
             transform = 'identity'
+        method = 'GenericLabel' if self.inputs.batched else 'MultiLabel'
 
         # Transform atlases to match the DWI data
         resample_commands = []
+        sampling_points = None
+        target_key = None
+        if self.inputs.use_cache:
+            target_key = atlas_target_key(self.inputs.reference_image, transform, method)
         for atlas_name, atlas_config in atlas_configs.items():
             output_name = fname_presuffix(atlas_config['file'], newpath=runtime.cwd,
                                           suffix="_to_dwi")
@@ -70,12 +84,36 @@ class GetConnectivityAtlases(SimpleInterface):
             atlas_configs[atlas_name]['dwi_resolution_mif'] = output_mif
             atlas_configs[atlas_name]['orig_lut'] = output_mif_txt
             atlas_configs[atlas_name]['mrtrix_lut'] = output_orig_txt
+
+            cache_key = None
+            if target_key is not None:
+                cache_key = atlas_cache_key(atlas_config, target_key)
+                if fetch_cached_atlas(cache_key, [output_name, output_mif]):
+                    write_label_luts(output_orig_txt, output_mif_txt, atlas_config)
+                    resample_commands.append("%s: cached resampled atlas %s" % (
+                        atlas_config['file'], cache_key))
+                    continue
+
+            if self.inputs.batched:
+                if sampling_points is None:
+                    sampling_points, command = atlas_sampling_points(
+                        transform, self.inputs.reference_image, runtime.cwd)
+                    resample_commands.append(command)
+                resample_labels(atlas_config['file'], sampling_points,
+                                self.inputs.reference_image, output_name)
+                resample_commands.append("%s: resampled to %s" % (atlas_config['file'],
+                                                                  output_name))
+            else:
+                resample_commands.append(
+                    _resample_atlas(input_atlas=atlas_config['file'],
+                                    output_atlas=output_name,
+                                    transform=transform,
+                                    ref_image=self.inputs.reference_image))
             resample_commands.append(
-                _resample_atlas(input_atlas=atlas_config['file'],
-                                output_atlas=output_name,
-                                transform=transform,
-                                ref_image=self.inputs.reference_image))
-            label_convert(output_name, output_mif, output_orig_txt, output_mif_txt, atlas_config)
+                label_convert(output_name, output_mif, output_orig_txt, output_mif_txt,
+                              atlas_config))
+            if cache_key is not None and os.path.exists(output_mif):
+                store_cached_atlas(cache_key, [output_name, output_mif])
 
         self._results['atlas_configs'] = atlas_configs
         commands_file = os.path.join(runtime.cwd, "transform_commands.txt")
@@ -95,17 +133,29 @@ def _resample_atlas(input_atlas, output_atlas, transform, ref_image):
     return result.runtime.cmdline
 
 
-def label_convert(original_atlas, output_mif, orig_txt, mrtrix_txt, metadata):
-    """Create a mrtrix label file from an atlas."""
-
+def write_label_luts(orig_txt, mrtrix_txt, metadata):
+    """Write the original and the consecutive (mrtrix) label lookup tables."""
     with open(mrtrix_txt, "w") as mrtrix_f:
         with open(orig_txt, "w") as orig_f:
             for row_num, (roi_num, roi_name) in enumerate(
                     zip(metadata['node_ids'], metadata['node_names'])):
                 orig_f.write("{}\t{}\n".format(roi_num, roi_name))
                 mrtrix_f.write("{}\t{}\n".format(row_num + 1, roi_name))
+
+
+def label_convert(original_atlas, output_mif, orig_txt, mrtrix_txt, metadata):
+    """Create a mrtrix label file from an atlas."""
+    write_label_luts(orig_txt, mrtrix_txt, metadata)
     cmd = ['labelconvert', original_atlas, orig_txt, mrtrix_txt, output_mif]
-    os.system(' '.join(cmd))
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+    except OSError as exc:
+        IFLOGGER.warning("Unable to run labelconvert: %s", exc)
+        return ' '.join(cmd)
+    if proc.returncode:
+        IFLOGGER.warning("labelconvert failed on %s: %s", original_atlas, err.decode())
+    return ' '.join(cmd)
 
 
 class TPM2ROIInputSpec(BaseInterfaceInputSpec):
@@ -6,11 +6,21 @@
 Loading atlases
 ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
 
+Atlases can be resampled to the DWI grid in-process, and the results can be
+kept in a cache shared by the nodes of a run.
 
 """
 import os
 import os.path as op
 import json
+import hashlib
+import shutil
+import numpy as np
+import nibabel as nb
+from nipype import logging
+from .transforms import LPS_TO_RAS, apply_affine, is_itk_affine, map_points
+
+LOGGER = logging.getLogger('nipype.interface')
 
 
 def get_atlases(atlas_names):
@@ -28,3 +38,158 @@ def get_atlases(atlas_names):
         atlas_data['file'] = op.join(atlas_dir, atlas_data['file'])
         outputs[atlas_name] = atlas_data
     return outputs
+
+
+# Resampled atlases are stored in QSIPREP_ATLAS_CACHE, keyed by the atlas, the
+# output grid and the transform. ``qsiprep`` points it to a directory inside
+# the working directory. Resampled atlases are not stored when it is unset.
+def atlas_cache_dir():
+    """Directory of the resampled atlas store, or None if there is none."""
+    return os.getenv('QSIPREP_ATLAS_CACHE') or None
+
+
+def file_hash(fname):
+    """SHA1 of the contents of a file."""
+    digest = hashlib.sha1()
+    with open(fname, 'rb') as fobj:
+        for block in iter(lambda: fobj.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def atlas_target_key(reference_image, transform, method):
+    """The part of the atlas cache keys shared by all atlases of a node.
+
+    It depends on the geometry of the output grid, the contents of the
+    transform and the resampling method, so the transform is hashed once
+    however many atlases are resampled.
+    """
+    ref_img = nb.load(reference_image)
+    digest = hashlib.sha1()
+    for part in (ref_img.shape[:3], np.round(ref_img.affine, 6).tolist(),
+                 transform if transform == 'identity' else file_hash(transform), method):
+        digest.update(repr(part).encode())
+    return digest.hexdigest()
+
+
+def atlas_cache_key(atlas_config, target_key):
+    """Key of a resampled atlas in the atlas cache.
+
+    It depends on the atlas contents and labels and on ``target_key`` (see
+    :func:`atlas_target_key`).
+    """
+    digest = hashlib.sha1()
+    for part in (file_hash(atlas_config['file']), atlas_config['node_ids'],
+                 atlas_config['node_names'], target_key):
+        digest.update(repr(part).encode())
+    return digest.hexdigest()
+
+
+def fetch_cached_atlas(key, out_files):
+    """Copy cached files to ``out_files`` (one per extension) if all are cached."""
+    cache_dir = atlas_cache_dir()
+    if cache_dir is None:
+        return False
+    cache_files = [op.join(cache_dir, key + _extension(out_file))
+                   for out_file in out_files]
+    if not all(op.exists(cache_file) for cache_file in cache_files):
+        return False
+    for cache_file, out_file in zip(cache_files, out_files):
+        shutil.copyfile(cache_file, out_file)
+    LOGGER.info('Using cached atlas %s', key)
+    return True
+
+
+def store_cached_atlas(key, out_files):
+    """Add files to the atlas cache."""
+    cache_dir = atlas_cache_dir()
+    if cache_dir is None:
+        return
+    for out_file in out_files:
+        cache_file = op.join(cache_dir, key + _extension(out_file))
+        # Copy to a temporary file first so concurrent nodes never read a partial file
+        tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            shutil.copyfile(out_file, tmp_file)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            LOGGER.warning("Unable to write atlas cache file %s", cache_file)
+            if op.exists(tmp_file):
+                os.remove(tmp_file)
+
+
+def _extension(fname):
+    return '.nii.gz' if fname.endswith('.nii.gz') else op.splitext(fname)[1]
+
+
+def atlas_sampling_points(transform, reference_image, newpath):
+    """LPS coordinates in atlas space of every voxel of the output grid.
+
+    ``transform`` maps the output grid to the atlas (ANTs convention). ITK
+    affines and displacement fields are evaluated directly. Other transforms
+    (e.g. h5 composites) are first turned into one displacement field on the
+    output grid with antsApplyTransforms, so all atlases share one evaluation.
+
+    Returns
+    -------
+    points : ndarray, shape (3, n_voxels)
+    command : str
+        how the transform was evaluated
+    """
+    ref_img = nb.load(reference_image)
+    ref_ijk = np.indices(ref_img.shape[:3], dtype=np.float32).reshape(3, -1)
+    points = apply_affine(LPS_TO_RAS.dot(ref_img.affine), ref_ijk)
+    if transform == 'identity':
+        return points, 'identity transform'
+    if is_itk_affine(transform) or '.nii' in transform:
+        return map_points(points, [transform]), 'evaluated %s' % transform
+
+    from nipype.interfaces import ants
+    warp_file = op.join(newpath, 'atlas_warp.nii.gz')
+    xform = ants.ApplyTransforms(transforms=[transform], reference_image=reference_image,
+                                 input_image=reference_image, output_image=warp_file,
+                                 print_out_composite_warp_file=True)
+    xform.terminal_output = 'allatonce'
+    cmdline = xform.run().runtime.cmdline
+    return map_points(points, [warp_file]), cmdline
+
+
+def resample_labels(atlas_file, points, reference_image, out_file, chunk_size=2 ** 18):
+    """Resample a label image at the given points, keeping labels intact.
+
+    Each output voxel gets the label with the largest total trilinear weight
+    among the 8 atlas voxels around its point (like ``GenericLabel`` in
+    antsApplyTransforms). Points outside the atlas are background (0).
+    """
+    atlas_img = nb.load(atlas_file)
+    labels = np.asanyarray(atlas_img.dataobj).reshape(atlas_img.shape[:3])
+    if not np.issubdtype(labels.dtype, np.integer):
+        labels = np.round(labels).astype(np.int32)
+    ijk = apply_affine(np.linalg.inv(LPS_TO_RAS.dot(atlas_img.affine)), points)
+    corners = np.array([[0, 0, 0], [0, 0, 1], [0, 1, 0], [0, 1, 1],
+                        [1, 0, 0], [1, 0, 1], [1, 1, 0], [1, 1, 1]])
+    atlas_shape = np.array(labels.shape)[:, np.newaxis, np.newaxis]
+
+    resampled = np.zeros(ijk.shape[1], dtype=labels.dtype)
+    for start in range(0, ijk.shape[1], chunk_size):
+        chunk = ijk[:, start:start + chunk_size]
+        base = np.floor(chunk)
+        frac = chunk - base
+        # (3, n_points, 8) neighbour indices and their trilinear weights
+        neighbours = base[..., np.newaxis].astype(np.int64) + corners.T[:, np.newaxis]
+        weights = np.prod(np.where(corners.T[:, np.newaxis], frac[..., np.newaxis],
+                                   1 - frac[..., np.newaxis]), axis=0)
+        inside = np.all((neighbours >= 0) & (neighbours < atlas_shape), axis=0)
+        neighbour_labels = np.zeros(weights.shape, dtype=labels.dtype)
+        neighbour_labels[inside] = labels[tuple(neighbours[:, inside])]
+        votes = np.einsum('nij,nj->ni', neighbour_labels[:, :, np.newaxis] ==
+                          neighbour_labels[:, np.newaxis, :], weights)
+        resampled[start:start + chunk_size] = neighbour_labels[
+            np.arange(len(votes)), np.argmax(votes, axis=1)]
+
+    ref_img = nb.load(reference_image)
+    out_img = nb.Nifti1Image(resampled.reshape(ref_img.shape[:3]), ref_img.affine)
+    out_img.header.set_xyzt_units(*ref_img.header.get_xyzt_units())
+    out_img.to_filename(out_file)
+    return out_file
@@ -15,11 +15,14 @@ Fetch some test data
 
 """
 import os
+import re
 import sys
 import os.path as op
 import json
+import hashlib
 import warnings
 from bids import BIDSLayout
+from bids_validator import BIDSValidator
 
 
 class BIDSError(ValueError):
@@ -39,6 +42,364 @@ class BIDSWarning(RuntimeWarning):
     pass
 
 
+# Persistent BIDS indices are stored in QSIPREP_BIDS_INDEX, one file per
+# dataset. ``qsiprep`` points it to a directory inside the working directory.
+# Indices are kept in memory only when it is unset.
+BIDS_INDEX_VERSION = 1
+# Top-level folders that are not part of the raw dataset
+BIDS_INDEX_SKIP = ('derivatives', 'sourcedata', 'code', 'stimuli')
+ENTITY_NAMES = {'sub': 'subject', 'ses': 'session', 'acq': 'acquisition', 'ce': 'ceagent',
+                'rec': 'reconstruction', 'dir': 'direction', 'mod': 'modality'}
+_BIDS_INDICES = {}
+
+
+def bids_index_dir():
+    """Directory of the persistent BIDS indices, or None if there is none."""
+    return os.getenv('QSIPREP_BIDS_INDEX') or None
+
+
+class BIDSIndexFile(object):
+    """A file in a :class:`BIDSIndex`, with the attributes of a pybids ``BIDSFile``."""
+
+    def __init__(self, path, entities):
+        self.path = path
+        self.filename = op.basename(path)
+        self.dirname = op.dirname(path)
+        self.entities = entities
+
+    def __repr__(self):
+        return "<BIDSIndexFile filename='%s'>" % self.path
+
+
+class BIDSIndex(object):
+    """
+    A persistent index of a BIDS tree that can be used instead of a
+    ``BIDSLayout``.
+
+    The directory listings and the contents of all the JSON sidecars are
+    stored in ``index_dir`` (by default, ``QSIPREP_BIDS_INDEX``). When the
+    index is loaded again, only the directories and sidecars whose
+    modification times changed are read again, so loading a large dataset
+    that has already been indexed takes about one ``stat`` per directory and
+    sidecar. The index implements the
+    parts of the ``BIDSLayout`` interface used by qsiprep: ``get``,
+    ``get_subjects``, ``get_sessions``, ``get_metadata`` (with the BIDS
+    inheritance principle) and ``get_fieldmap`` (``IntendedFor`` links).
+
+    As ``BIDSLayout(validate=True)`` does, ``validate=True`` requires a
+    ``dataset_description.json`` with ``Name`` and ``BIDSVersion`` and leaves
+    out the files that the BIDS validator does not recognise.
+
+    >>> index = BIDSIndex('ds114')
+    >>> index.get_subjects()[:3]
+    ['01', '02', '03']
+    >>> index.get(return_type='file', subject='01', datatype='anat',
+    ...           suffix='T1w')  # doctest: +ELLIPSIS
+    ['.../ds114/sub-01/ses-retest/anat/sub-01_ses-retest_T1w.nii.gz', \
+'.../ds114/sub-01/ses-test/anat/sub-01_ses-test_T1w.nii.gz']
+
+    """
+
+    def __init__(self, root, index_dir=None, validate=True):
+        self.root = op.abspath(str(root))
+        if not op.isdir(self.root):
+            raise BIDSError('BIDS root folder does not exist', self.root)
+        self.validate = validate
+        if validate:
+            self._validate_root()
+        index_dir = bids_index_dir() if index_dir is None else index_dir
+        self.index_file = op.join(
+            index_dir, hashlib.sha1(self.root.encode()).hexdigest() + '.json') \
+            if index_dir else None
+        self._dirs = {}
+        self._sidecars = {}
+        self._changed = False
+        self._load()
+        self._update()
+        if self._changed:
+            self._save()
+        self._build()
+
+    def _validate_root(self):
+        description_file = op.join(self.root, 'dataset_description.json')
+        if not op.isfile(description_file):
+            raise BIDSError("'dataset_description.json' is missing from project root. "
+                            "Every valid BIDS dataset must have this file.", self.root)
+        with open(description_file) as fobj:
+            description = json.load(fobj)
+        for key in ('Name', 'BIDSVersion'):
+            if key not in description:
+                raise BIDSError("Mandatory '%s' field missing from "
+                                "dataset_description.json." % key, self.root)
+
+    def _load(self):
+        if self.index_file is None or not op.exists(self.index_file):
+            return
+        try:
+            with open(self.index_file) as fobj:
+                stored = json.load(fobj)
+        except (OSError, ValueError):
+            warnings.warn('Ignoring unreadable BIDS index %s' % self.index_file, BIDSWarning)
+            return
+        if stored.get('version') == BIDS_INDEX_VERSION and stored.get('root') == self.root:
+            self._dirs = stored['dirs']
+            self._sidecars = stored['sidecars']
+
+    def _save(self):
+        if self.index_file is None:
+            return
+        # Write to a temporary file first so concurrent jobs never read a partial index
+        tmp_file = '%s.%d.tmp' % (self.index_file, os.getpid())
+        try:
+            os.makedirs(op.dirname(self.index_file), exist_ok=True)
+            with open(tmp_file, 'w') as fobj:
+                json.dump({'version': BIDS_INDEX_VERSION, 'root': self.root,
+                           'dirs': self._dirs, 'sidecars': self._sidecars}, fobj)
+            os.replace(tmp_file, self.index_file)
+        except OSError:
+            warnings.warn('Unable to write BIDS index %s' % self.index_file, BIDSWarning)
+            if op.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def _update(self):
+        """Re-read the directories and sidecars that changed since the index was saved."""
+        old_dirs, old_sidecars = self._dirs, self._sidecars
+        self._dirs, self._sidecars = {}, {}
+        pending = ['']
+        while pending:
+            rel_dir = pending.pop()
+            abs_dir = op.join(self.root, rel_dir)
+            try:
+                mtime = os.stat(abs_dir).st_mtime
+            except OSError:
+                continue
+            listing = old_dirs.get(rel_dir)
+            if listing is None or listing['mtime'] != mtime:
+                self._changed = True
+                files, subdirs = [], []
+                for entry in os.scandir(abs_dir):
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir():
+                        if not (rel_dir == '' and entry.name in BIDS_INDEX_SKIP):
+                            subdirs.append(entry.name)
+                    else:
+                        files.append(entry.name)
+                listing = {'mtime': mtime, 'files': sorted(files), 'subdirs': sorted(subdirs)}
+            self._dirs[rel_dir] = listing
+            pending.extend(op.join(rel_dir, subdir) for subdir in listing['subdirs'])
+
+            for fname in listing['files']:
+                if not fname.endswith('.json'):
+                    continue
+                rel_file = op.join(rel_dir, fname)
+                try:
+                    mtime = os.stat(op.join(self.root, rel_file)).st_mtime
+                except OSError:
+                    continue
+                sidecar = old_sidecars.get(rel_file)
+                if sidecar is None or sidecar[0] != mtime:
+                    self._changed = True
+                    try:
+                        with open(op.join(self.root, rel_file)) as fobj:
+                            sidecar = [mtime, json.load(fobj)]
+                    except (OSError, ValueError):
+                        sidecar = [mtime, {}]
+                self._sidecars[rel_file] = sidecar
+        if set(old_dirs) - set(self._dirs) or set(old_sidecars) - set(self._sidecars):
+            self._changed = True
+
+    def _build(self):
+        """Parse the entities of all files in the index."""
+        self._files = {}
+        validator = BIDSValidator(index_associated=True) if self.validate else None
+        for rel_dir, listing in self._dirs.items():
+            parts = rel_dir.split(os.sep) if rel_dir else []
+            datatype = parts[-1] if parts and not parts[-1].startswith(('sub-', 'ses-')) \
+                else None
+            for fname in listing['files']:
+                if not fname.startswith('sub-'):
+                    continue
+                if validator is not None and not validator.is_bids(
+                        '/' + op.join(rel_dir, fname).replace(os.sep, '/')):
+                    continue
+                entities = parse_file_entities(fname)
+                if datatype is not None:
+                    entities['datatype'] = datatype
+                self._files[op.join(rel_dir, fname)] = entities
+
+    def _relpath(self, path):
+        path = str(path)
+        return op.relpath(path, self.root) if op.isabs(path) else path
+
+    def get(self, return_type='object', target=None, extension=None, extensions=None,
+            absolute_paths=True, regex_search=False, scope='all', **filters):
+        """Files matching entity values (a value or a list of accepted values).
+
+        The arguments are those of ``BIDSLayout.get``: ``return_type`` is
+        ``'object'``, ``'file'`` or ``'id'`` (the sorted values of the
+        ``target`` entity), ``regex_search`` matches the filter values as
+        regular expressions and ``absolute_paths=False`` returns paths
+        relative to the root. Only the raw dataset is indexed, so ``scope``
+        can only be ``'all'``, ``'raw'`` or ``'self'``.
+        """
+        if return_type not in ('object', 'file', 'id'):
+            raise ValueError("Invalid return_type '%s'" % return_type)
+        if return_type == 'id' and target is None:
+            raise ValueError("return_type='id' needs a target entity")
+        if scope not in ('all', 'raw', 'self'):
+            raise ValueError("The BIDS index does not contain the '%s' scope" % scope)
+        extension = extension if extension is not None else extensions
+        if extension is not None:
+            filters['extension'] = extension
+        for key, value in list(filters.items()):
+            if value is None:
+                del filters[key]
+            else:
+                value = value if isinstance(value, (list, tuple)) else [value]
+                if key == 'extension':
+                    value = [str(val).lstrip('.') for val in value]
+                filters[key] = set(str(val) for val in value)
+
+        if regex_search:
+            patterns = {key: [re.compile(val) for val in value]
+                        for key, value in filters.items()}
+
+            def _matches(key, entity):
+                return entity is not None and any(
+                    pattern.search(entity) for pattern in patterns[key])
+        else:
+            def _matches(key, entity):
+                return entity in filters[key]
+
+        matches = sorted(rel_file for rel_file, entities in self._files.items()
+                         if all(_matches(key, entities.get(key)) for key in filters))
+        if return_type == 'id':
+            return sorted(set(self._files[rel_file][target] for rel_file in matches
+                              if target in self._files[rel_file]))
+        paths = [op.join(self.root, rel_file) if absolute_paths else rel_file
+                 for rel_file in matches]
+        if return_type == 'file':
+            return paths
+        return [BIDSIndexFile(path, self._files[rel_file])
+                for path, rel_file in zip(paths, matches)]
+
+    def get_subjects(self, **filters):
+        return self.get(return_type='id', target='subject', **filters)
+
+    def get_sessions(self, **filters):
+        return self.get(return_type='id', target='session', **filters)
+
+    def parse_file_entities(self, path):
+        return parse_file_entities(op.basename(str(path)))
+
+    def get_metadata(self, path, **kwargs):
+        """Metadata of a file from its JSON sidecars, following the inheritance principle."""
+        rel_file = self._relpath(path)
+        entities = self._files.get(rel_file)
+        if entities is None:
+            return {}
+        pairs = _entity_pairs(op.basename(rel_file))
+
+        # Sidecars in the folders from the root to the file, with the same suffix
+        # and a subset of the entities of the file. More specific ones take precedence
+        candidates = []
+        rel_dir = op.dirname(rel_file)
+        parts = rel_dir.split(os.sep) if rel_dir else []
+        for depth in range(len(parts) + 1):
+            folder = os.sep.join(parts[:depth])
+            for fname in self._dirs.get(folder, {'files': []})['files']:
+                if not fname.endswith('.json'):
+                    continue
+                sidecar_pairs = _entity_pairs(fname)
+                if parse_file_entities(fname).get('suffix') != entities.get('suffix') or \
+                        not set(sidecar_pairs.items()) <= set(pairs.items()):
+                    continue
+                candidates.append((depth, len(sidecar_pairs), op.join(folder, fname)))
+
+        metadata = {}
+        for _, _, sidecar in sorted(candidates):
+            metadata.update(self._sidecars[sidecar][1])
+        return metadata
+
+    def get_fieldmap(self, path, return_list=False):
+        """Fieldmaps whose ``IntendedFor`` lists ``path``, like ``BIDSLayout.get_fieldmap``."""
+        subject = parse_file_entities(op.basename(str(path)))['subject']
+        fieldmaps = []
+        for fmap in self.get(subject=subject, suffix=['phase1', 'phasediff', 'epi', 'fieldmap'],
+                             extension=['nii.gz', 'nii']):
+            intended_for = self.get_metadata(fmap.path).get('IntendedFor')
+            if intended_for is None:
+                continue
+            if isinstance(intended_for, str):
+                intended_for = [intended_for]
+            if not any(str(path).endswith(target) for target in intended_for):
+                continue
+            suffix = fmap.entities['suffix']
+            if suffix == 'phasediff':
+                fieldmap = {'phasediff': fmap.path,
+                            'magnitude1': fmap.path.replace('phasediff', 'magnitude1'),
+                            'suffix': 'phasediff'}
+                magnitude2 = fmap.path.replace('phasediff', 'magnitude2')
+                if op.isfile(magnitude2):
+                    fieldmap['magnitude2'] = magnitude2
+            elif suffix == 'phase1':
+                fieldmap = {'phase1': fmap.path,
+                            'magnitude1': fmap.path.replace('phase1', 'magnitude1'),
+                            'phase2': fmap.path.replace('phase1', 'phase2'),
+                            'magnitude2': fmap.path.replace('phase1', 'magnitude2'),
+                            'suffix': 'phase'}
+            elif suffix == 'epi':
+                fieldmap = {'epi': fmap.path, 'suffix': 'epi'}
+            else:
+                fieldmap = {'fieldmap': fmap.path,
+                            'magnitude': fmap.path.replace('fieldmap', 'magnitude'),
+                            'suffix': 'fieldmap'}
+            fieldmaps.append(fieldmap)
+
+        if return_list:
+            return fieldmaps
+        if len(fieldmaps) > 1:
+            raise ValueError("More than one fieldmap found for %s" % path)
+        return fieldmaps[0] if fieldmaps else None
+
+
+def load_bids_index(bids_dir, validate=True):
+    """Get the :class:`BIDSIndex` of a dataset, reusing the one of this process."""
+    if isinstance(bids_dir, (BIDSIndex, BIDSLayout)):
+        return bids_dir
+    key = (op.abspath(str(bids_dir)), validate)
+    if key not in _BIDS_INDICES:
+        _BIDS_INDICES[key] = BIDSIndex(key[0], validate=validate)
+    return _BIDS_INDICES[key]
+
+
+def _entity_pairs(fname):
+    """Key-value pairs of a BIDS file name, with short keys."""
+    parts = fname.split('.', 1)[0].split('_')
+    return dict(part.split('-', 1) for part in parts if '-' in part)
+
+
+def parse_file_entities(fname):
+    """Entities of a BIDS file name, named as pybids does.
+
+    >>> parse_file_entities('sub-01_ses-1_dir-AP_run-2_dwi.nii.gz') == {
+    ...     'subject': '01', 'session': '1', 'direction': 'AP', 'run': '2',
+    ...     'suffix': 'dwi', 'extension': 'nii.gz'}
+    True
+
+    """
+    stem, _, extension = fname.partition('.')
+    entities = {ENTITY_NAMES.get(key, key): value
+                for key, value in _entity_pairs(fname).items()}
+    last_part = stem.split('_')[-1]
+    if '-' not in last_part:
+        entities['suffix'] = last_part
+    if extension:
+        entities['extension'] = extension
+    return entities
+
+
 def collect_participants(bids_dir, participant_label=None, strict=False,
                          bids_validate=True):
     """
@@ -47,6 +408,10 @@ def collect_participants(bids_dir, participant_label=None, strict=False,
 
     Returns the list of participants to be finally processed.
 
+    The participants are read from the persistent :class:`BIDSIndex` of the
+    dataset (or from ``bids_dir`` if it is already a layout or an index),
+    validated as ``BIDSLayout`` does if ``bids_validate`` is set.
+
     Requesting all subjects in a BIDS directory root:
 
     >>> collect_participants('ds114')
@@ -75,10 +440,7 @@ def collect_participants(bids_dir, participant_label=None, strict=False,
 
 
     """
-    if isinstance(bids_dir, BIDSLayout):
-        layout = bids_dir
-    else:
-        layout = BIDSLayout(str(bids_dir), validate=bids_validate)
+    layout = load_bids_index(bids_dir, validate=bids_validate)
 
     all_participants = set(layout.get_subjects())
 
@@ -123,13 +485,10 @@ def collect_participants(bids_dir, participant_label=None, strict=False,
 
 def collect_data(bids_dir, participant_label, task=None, bids_validate=True):
     """
-    Uses pybids to retrieve the input data for a given participant
+    Retrieve the input data for a given participant from the BIDS index
 
     """
-    if isinstance(bids_dir, BIDSLayout):
-        layout = bids_dir
-    else:
-        layout = BIDSLayout(str(bids_dir), validate=bids_validate)
+    layout = load_bids_index(bids_dir, validate=bids_validate)
 
     queries = {
         'fmap': {'datatype': 'fmap'},
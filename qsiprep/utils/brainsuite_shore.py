@@ -1,6 +1,11 @@
 from __future__ import division
+import os
+import hashlib
 import warnings
-from sklearn.linear_model import Lasso, LassoCV
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.linear_model import Lasso, LassoCV, lasso_path
+from sklearn.model_selection import KFold
 from sklearn.exceptions import ConvergenceWarning
 from sklearn.metrics import r2_score
 from math import factorial
@@ -12,9 +17,130 @@ from .shm import real_sym_sh_brainsuite
 from dipy.core.geometry import cart2sphere
 
 from dipy.utils.optpkg import optional_package
+from nipype import logging
+from ..__about__ import __version__
 
 cvxpy, have_cvxpy, _ = optional_package("cvxpy")
 
+# Number of voxels per matrix product in multi-voxel L2 fits
+L2_CHUNK_SIZE = 20000
+# Number of voxels sent to each worker in multi-voxel L1 fits
+L1_CHUNK_SIZE = 2000
+# Ratio of the smallest to the largest alpha of a CV path, as in LassoCV
+L1_ALPHA_EPS = 1e-3
+
+LOGGER = logging.getLogger('nipype.interface')
+
+# Basis matrices and regularized pseudo-inverses are shared between model
+# instances through an in-memory LRU. They are also stored on disk when
+# QSIPREP_SHORE_CACHE points to a directory, which ``qsiprep`` sets to a
+# directory inside the working directory so that nodes running in different
+# processes share them. The keys include the package version and
+# SHORE_CACHE_FORMAT, which must be increased whenever the matrices computed
+# for the same inputs change.
+SHORE_CACHE_FORMAT = 1
+SHORE_CACHE_SIZE = 32
+_SHORE_MATRIX_CACHE = OrderedDict()
+
+
+def shore_cache_dir():
+    """Directory of the on-disk SHORE matrix store, or None to keep matrices in memory."""
+    return os.getenv('QSIPREP_SHORE_CACHE') or None
+
+
+def shore_cache_key(*parts):
+    """Hash arrays and scalars into a key for the SHORE matrix store."""
+    digest = hashlib.sha1()
+    digest.update(repr((__version__, SHORE_CACHE_FORMAT)).encode())
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part)
+            digest.update(str((part.dtype.str, part.shape)).encode())
+            digest.update(part.tobytes())
+        else:
+            digest.update(repr(part).encode())
+    return digest.hexdigest()
+
+
+def gtab_cache_key(gtab):
+    """Key describing the q-space sampling of a gradient table."""
+    return shore_cache_key(np.asarray(gtab.bvals, dtype=float),
+                           np.asarray(gtab.bvecs, dtype=float),
+                           np.asarray(gtab.b0s_mask, dtype=bool),
+                           gtab.big_delta, gtab.small_delta)
+
+
+def cached_shore_matrix(name, key, compute):
+    """Get a matrix from the SHORE matrix store, computing it if needed.
+
+    Matrices are looked up in memory first, then in :func:`shore_cache_dir`.
+    Cached matrices are read-only and shared, so callers must not modify
+    them in place.
+
+    Parameters
+    ----------
+    name : str
+        kind of matrix, used as a prefix of the cache file name
+    key : str
+        hash of everything the matrix depends on (see :func:`shore_cache_key`)
+    compute : callable
+        computes the matrix when it is not cached
+    """
+    cache_name = "%s-%s" % (name, key)
+    matrix = _SHORE_MATRIX_CACHE.pop(cache_name, None)
+    if matrix is None:
+        cache_dir = shore_cache_dir()
+        cache_file = os.path.join(cache_dir, cache_name + ".npy") if cache_dir else None
+        if cache_file is not None and os.path.exists(cache_file):
+            try:
+                matrix = np.load(cache_file)
+            except (OSError, ValueError):
+                LOGGER.warning("Ignoring unreadable SHORE cache file %s", cache_file)
+        if matrix is None:
+            matrix = np.asarray(compute())
+            if cache_file is not None:
+                _save_shore_matrix(cache_file, matrix)
+        matrix.setflags(write=False)
+    _SHORE_MATRIX_CACHE[cache_name] = matrix
+    while len(_SHORE_MATRIX_CACHE) > SHORE_CACHE_SIZE:
+        _SHORE_MATRIX_CACHE.popitem(last=False)
+    return matrix
+
+
+def _save_shore_matrix(cache_file, matrix):
+    # Write to a temporary file first so concurrent nodes never read a partial file
+    tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(tmp_file, "wb") as tmp:
+            np.save(tmp, matrix)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        LOGGER.warning("Unable to write SHORE cache file %s", cache_file)
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def cached_shore_basis(radial_order, zeta, gtab, tau=1 / (4 * np.pi**2)):
+    """:func:`brainsuite_shore_basis` through the SHORE matrix store."""
+    return cached_shore_matrix(
+        "basis", shore_cache_key(gtab_cache_key(gtab), radial_order, zeta, tau),
+        lambda: brainsuite_shore_basis(radial_order, zeta, gtab, tau))
+
+
+def cached_shore_matrix_odf(radial_order, zeta, sphere_vertices):
+    """:func:`shore_matrix_odf` through the SHORE matrix store."""
+    return cached_shore_matrix(
+        "odf", shore_cache_key(np.asarray(sphere_vertices, dtype=float), radial_order, zeta),
+        lambda: shore_matrix_odf(radial_order, zeta, sphere_vertices))
+
+
+def cached_shore_matrix_pdf(radial_order, zeta, rtab):
+    """:func:`brainsuite_shore_matrix_pdf` through the SHORE matrix store."""
+    return cached_shore_matrix(
+        "pdf", shore_cache_key(np.asarray(rtab, dtype=float), radial_order, zeta),
+        lambda: brainsuite_shore_matrix_pdf(radial_order, zeta, rtab))
+
 
 class BrainSuiteShoreModel(Cache):
     r"""Simple Harmonic Oscillator based Reconstruction and Estimation
@@ -63,6 +189,8 @@ class BrainSuiteShoreModel(Cache):
             l1_maxiter=1000,
             l1_verbose=False,
             l1_alpha=1.0,
+            l1_num_threads=1,
+            l1_n_alphas=100,
             pos_grid=11,
             pos_radius=20e-03):
         r""" Analytical and continuous modeling of the diffusion signal with
@@ -99,6 +227,11 @@ class BrainSuiteShoreModel(Cache):
             radial regularisation constant
         lambdaL : float,
             angular regularisation constant
+        l1_num_threads : int,
+            number of processes used for multi-voxel L1 fits
+        l1_n_alphas : int,
+            number of alphas in the regularization path of each voxel when
+            ``regularization_weighting`` is "CV"
         tau : float,
             diffusion time. By default the value that makes q equal to the
             square root of the b-value.
@@ -170,6 +303,8 @@ class BrainSuiteShoreModel(Cache):
         self.l1_maxiter = l1_maxiter
         self.l1_verbose = l1_verbose
         self.l1_alpha = l1_alpha
+        self.l1_num_threads = l1_num_threads
+        self.l1_n_alphas = l1_n_alphas
 
         # For computing EAP
         self.pos_grid = pos_grid
@@ -183,19 +318,115 @@ class BrainSuiteShoreModel(Cache):
         ell = self.ind_mat[:, 1]
         return np.diag((ell * (ell + 1))**2)
 
-    @multi_voxel_fit
-    def fit(self, data):
-
-        # Generate the SHORE basis
+    def _shore_basis(self):
+        """The SHORE basis of the gradient table."""
         M = self.cache_get('shore_matrix', key=self.gtab)
         if M is None:
-            M = brainsuite_shore_basis(self.radial_order, self.zeta, self.gtab, self.tau)
+            M = cached_shore_basis(self.radial_order, self.zeta, self.gtab, self.tau)
             self.cache_set('shore_matrix', self.gtab, M)
+        return M
+
+    def _shore_matrices(self):
+        """The SHORE basis of the gradient table and its regularized pseudo-inverse."""
+        M = self._shore_basis()
         MpseudoInv = self.cache_get('shore_matrix_reg_pinv', key=self.gtab)
         if MpseudoInv is None:
-            MpseudoInv = np.linalg.solve(
-                np.dot(M.T, M) + self.lambdaN * self.Nshore + self.lambdaL * self.Lshore, M.T)
+            pinv_key = shore_cache_key(gtab_cache_key(self.gtab), self.radial_order,
+                                       self.zeta, self.tau, self.lambdaN, self.lambdaL)
+            MpseudoInv = cached_shore_matrix(
+                "reg_pinv", pinv_key,
+                lambda: np.linalg.solve(np.dot(M.T, M) + self.lambdaN * self.Nshore +
+                                        self.lambdaL * self.Lshore, M.T))
             self.cache_set('shore_matrix_reg_pinv', self.gtab, MpseudoInv)
+        return M, MpseudoInv
+
+    def fit(self, data, mask=None):
+        """Fit the model to every voxel in ``data`` where ``mask`` is True.
+
+        The L2 solution is closed-form, so multi-voxel L2 fits are computed for
+        all voxels at once. Multi-voxel L1 fits are split into chunks of voxels
+        that are fit in ``l1_num_threads`` processes. Both are returned as a
+        :class:`BrainSuiteShoreMultiVoxelFit`.
+        """
+        if data.ndim == 1:
+            return self._fit_voxel(data)
+        if mask is None:
+            mask = np.ones(data.shape[:-1], dtype=bool)
+        elif mask.shape != data.shape[:-1]:
+            raise ValueError("mask and data shape do not match")
+        mask = mask.astype(bool)
+        if self.regularization == "L1":
+            return self._fit_l1_multi_voxel(data, mask)
+        return self._fit_l2_multi_voxel(data, mask)
+
+    def _fit_l2_multi_voxel(self, data, mask, chunk_size=L2_CHUNK_SIZE):
+        M, MpseudoInv = self._shore_matrices()
+        masked_data = data[mask]
+        num_voxels = masked_data.shape[0]
+        coef = np.zeros((num_voxels, self.n_coefs))
+        r2 = np.zeros(num_voxels)
+        cnr = np.zeros(num_voxels)
+        for start in range(0, num_voxels, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            chunk_data = masked_data[chunk].astype(np.float64)
+            chunk_coef = np.dot(chunk_data, MpseudoInv.T)
+            fitted = np.dot(chunk_coef, M.T)
+            coef[chunk] = chunk_coef
+            r2[chunk] = _r2_score_rows(chunk_data, fitted)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cnr[chunk] = np.nan_to_num(np.var(fitted, 1) / np.var(fitted - chunk_data, 1))
+
+        return BrainSuiteShoreMultiVoxelFit(
+            self, mask, coef, regularization=2, alpha=0., r2=r2, cnr=cnr)
+
+    def _fit_l1_multi_voxel(self, data, mask, chunk_size=L1_CHUNK_SIZE):
+        M, MpseudoInv = self._shore_matrices()
+        masked_data = data[mask].astype(np.float64)
+        num_voxels = masked_data.shape[0]
+
+        # Everything that depends only on the gradient table is computed once
+        # and shared by all the chunks
+        gram = np.ascontiguousarray(np.dot(M.T, M))
+        l1_params = {
+            "positive": self.l1_positive_constraint,
+            "max_iter": self.l1_maxiter}
+        if self.regularization_weighting == "CV":
+            folds = [(train, test, np.ascontiguousarray(np.dot(M[train].T, M[train])))
+                     for train, test in
+                     KFold(n_splits=self.l1_cv or 3).split(M)]
+        else:
+            folds = None
+
+        chunks = [(masked_data[start:start + chunk_size], M, MpseudoInv, gram, folds,
+                   self.l1_alpha, self.l1_n_alphas, l1_params)
+                  for start in range(0, num_voxels, chunk_size)]
+        num_threads = self.l1_num_threads
+        if num_threads is not None and num_threads < 1:
+            num_threads = None
+        if num_threads == 1:
+            results = [_fit_l1_chunk(chunk) for chunk in chunks]
+        else:
+            with ProcessPoolExecutor(max_workers=num_threads) as pool:
+                results = list(pool.map(_fit_l1_chunk, chunks))
+
+        if results:
+            coef, alpha, regularization = [np.concatenate(arrays) for arrays in zip(*results)]
+        else:
+            coef = np.zeros((0, self.n_coefs))
+            alpha = regularization = np.zeros(0)
+        fitted = np.dot(coef, M.T)
+        r2 = _r2_score_rows(masked_data, fitted)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cnr = np.nan_to_num(np.var(fitted, 1) / np.var(fitted - masked_data, 1))
+
+        return BrainSuiteShoreMultiVoxelFit(
+            self, mask, coef, regularization=regularization, alpha=alpha, r2=r2, cnr=cnr)
+
+    @multi_voxel_fit
+    def _fit_voxel(self, data):
+
+        # Generate the SHORE basis
+        M, MpseudoInv = self._shore_matrices()
 
         # Compute the signal coefficients in SHORE basis
         l2_fallback = False
@@ -222,7 +453,8 @@ class BrainSuiteShoreModel(Cache):
                 try:
                     lasso_fit = lasso.fit(M, data)
                     coef = lasso_fit.coef_
-                    alpha = lasso_fit.alpha_
+                    alpha = lasso_fit.alpha_ if self.regularization_weighting == "CV" \
+                        else lasso_fit.alpha
                     fitted = lasso_fit.predict(M)
 
                 except Warning as this_warning:
@@ -242,6 +474,71 @@ class BrainSuiteShoreModel(Cache):
         return BrainSuiteShoreFit(self, coef, regularization, alpha, r2, cnr)
 
 
+def _fit_l1_chunk(args):
+    """Fit L1-regularized SHORE coefficients to a chunk of voxels.
+
+    Each voxel is fit like ``LassoCV`` (or ``Lasso`` when ``folds`` is None) in
+    the per-voxel model fit: the alpha grid of a voxel spans ``l1_n_alphas``
+    values below the smallest alpha that zeroes all its coefficients. The
+    Gram matrices of the basis and of each CV fold and the folds are shared
+    across voxels. The path of each fold is warm-started from one alpha to the
+    next by ``lasso_path``, and the final fit of each voxel is warm-started
+    from the mean of the fold solutions at the selected alpha (or from the
+    previous voxel without CV). Voxels that do not converge fall back to the
+    L2 solution.
+    """
+    chunk_data, M, MpseudoInv, gram, folds, l1_alpha, l1_n_alphas, l1_params = args
+    num_voxels = chunk_data.shape[0]
+    coef = np.zeros((num_voxels, M.shape[1]))
+    voxel_alphas = np.zeros(num_voxels)
+    regularization = np.ones(num_voxels)
+    lasso = Lasso(alpha=l1_alpha, fit_intercept=False, precompute=gram, warm_start=True,
+                  **l1_params)
+    lasso.coef_ = np.zeros(M.shape[1])
+
+    for voxel_num, voxel_data in enumerate(chunk_data):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', ConvergenceWarning)
+            if folds is not None:
+                alphas = _voxel_alpha_grid(M, voxel_data, l1_n_alphas)
+                mse = np.zeros(len(alphas))
+                fold_coefs = []
+                for train, test, fold_gram in folds:
+                    train_data = voxel_data[train]
+                    _, path_coefs, _ = lasso_path(
+                        M[train], train_data, alphas=alphas, precompute=fold_gram,
+                        Xy=np.dot(M[train].T, train_data), **l1_params)
+                    residuals = voxel_data[test][:, np.newaxis] - np.dot(M[test], path_coefs)
+                    mse += (residuals ** 2).mean(0)
+                    fold_coefs.append(path_coefs)
+                best_alpha = np.argmin(mse)
+                lasso.alpha = alphas[best_alpha]
+                lasso.coef_ = np.mean([path_coefs[:, best_alpha] for path_coefs in fold_coefs],
+                                      axis=0)
+            lasso.fit(M, voxel_data)
+        converged = not any(issubclass(warning.category, ConvergenceWarning)
+                            for warning in caught)
+
+        if converged:
+            coef[voxel_num] = lasso.coef_
+            voxel_alphas[voxel_num] = lasso.alpha
+        else:
+            coef[voxel_num] = np.dot(MpseudoInv, voxel_data)
+            regularization[voxel_num] = 2
+            lasso.coef_ = np.zeros(M.shape[1])
+
+    return coef, voxel_alphas, regularization
+
+
+def _voxel_alpha_grid(M, voxel_data, n_alphas):
+    """The alphas ``LassoCV`` would try for one voxel, from largest to smallest."""
+    alpha_max = np.abs(np.dot(M.T, voxel_data)).max() / M.shape[0]
+    if alpha_max <= np.finfo(float).resolution:
+        return np.full(n_alphas, np.finfo(float).resolution)
+    return np.logspace(np.log10(alpha_max * L1_ALPHA_EPS), np.log10(alpha_max),
+                       n_alphas)[::-1]
+
+
 class BrainSuiteShoreFit():
     def __init__(self, model, shore_coef, regularization=0, alpha=0., r2=0., cnr=0.):
         """ Calculates diffusion properties for a single voxel
@@ -291,7 +588,7 @@ class BrainSuiteShoreFit():
 
         psi = self.model.cache_get('shore_matrix_pdf', key=(gridsize, radius_max))
         if psi is None:
-            psi = shore_matrix_pdf(self.radial_order, self.zeta, rtab)
+            psi = cached_shore_matrix_pdf(self.radial_order, self.zeta, rtab)
             self.model.cache_set('shore_matrix_pdf', (gridsize, radius_max), psi)
 
         propagator = np.dot(psi, self._shore_coef)
@@ -311,7 +608,7 @@ class BrainSuiteShoreFit():
         else:
             psi = None
         if psi is None:
-            psi = brainsuite_shore_matrix_pdf(self.radial_order, self.zeta, r_points)
+            psi = cached_shore_matrix_pdf(self.radial_order, self.zeta, r_points)
             if not r_points.flags.writeable:
                 self.model.cache_set('shore_matrix_pdf', hash(r_points.data), psi)
 
@@ -323,40 +620,14 @@ class BrainSuiteShoreFit():
         r""" Calculates the real analytical ODF in terms of Spherical
         Harmonics.
         """
-        # Number of Spherical Harmonics involved in the estimation
-        J = (self.radial_order + 1) * (self.radial_order + 2) // 2
-
-        # Compute the Spherical Harmonics Coefficients
-        c_sh = np.zeros(J)
-        counter = 0
-
-        for n in range(self.radial_order + 1):
-            for l in range(0, n + 1, 2):
-                for m in range(-l, l + 1):
-
-                    j = int(l + m + (2 * np.array(range(0, l, 2)) + 1).sum())
-
-                    Cnl = (((-1)**
-                            (n - l / 2)) / (2.0 * (4.0 * np.pi**2 * self.zeta)**(3.0 / 2.0)) * (
-                                (2.0 * (4.0 * np.pi**2 * self.zeta)**
-                                 (3.0 / 2.0) * factorial(n - l)) / (gamma(n + 3.0 / 2.0)))**
-                           (1.0 / 2.0))
-                    Gnl = (gamma(l / 2 + 3.0 / 2.0) * gamma(3.0 / 2.0 + n)) / \
-                        (gamma(l + 3.0 / 2.0) * factorial(n - l)) * \
-                        (1.0 / 2.0) ** (-l / 2 - 3.0 / 2.0)
-                    Fnl = hyp2f1(-n + l, l / 2 + 3.0 / 2.0, l + 3.0 / 2.0, 2.0)
-
-                    c_sh[j] += self._shore_coef[counter] * Cnl * Gnl * Fnl
-                    counter += 1
-
-        return c_sh
+        return np.dot(shore_odf_sh_matrix(self.radial_order, self.zeta), self._shore_coef)
 
     def odf(self, sphere):
         r""" Calculates the ODF for a given discrete sphere.
         """
         upsilon = self.model.cache_get('shore_matrix_odf', key=sphere)
         if upsilon is None:
-            upsilon = shore_matrix_odf(self.radial_order, self.zeta, sphere.vertices)
+            upsilon = cached_shore_matrix_odf(self.radial_order, self.zeta, sphere.vertices)
             self.model.cache_set('shore_matrix_odf', sphere, upsilon)
 
         odf = np.dot(upsilon, self._shore_coef)
@@ -445,7 +716,7 @@ class BrainSuiteShoreFit():
         qvals = np.sqrt(gtab.bvals / self.model.tau) / (2 * np.pi)
         q = qvals[:, None] * gtab.bvecs
 
-        M = brainsuite_shore_basis(self.radial_order, self.zeta, gtab, self.model.tau)
+        M = cached_shore_basis(self.radial_order, self.zeta, gtab, self.model.tau)
 
         E = S0 * np.dot(M, self._shore_coef)
         return E
@@ -476,6 +747,164 @@ class BrainSuiteShoreFit():
         return self._r2
 
 
+class BrainSuiteShoreMultiVoxelFit():
+    def __init__(self, model, mask, shore_coef, regularization=0, alpha=0., r2=0., cnr=0.):
+        """ Array-backed SHORE fit for all the voxels in a mask
+
+        Parameters
+        ----------
+        model : object,
+            BrainSuiteShoreModel
+        mask : ndarray,
+            boolean array of the voxels that were fit
+        shore_coef : 2d ndarray, shape (n_voxels, n_coefs)
+            shore coefficients of the voxels in ``mask``
+        regularization, alpha, r2, cnr : scalar or 1d ndarray
+            per-voxel fit properties of the voxels in ``mask``
+        """
+
+        self.model = model
+        self.mask = mask
+        self._masked_coef = shore_coef
+        self._alpha = alpha
+        self._r2 = r2
+        self._cnr = cnr
+        self._regularization = regularization
+        self.gtab = model.gtab
+        self.radial_order = model.radial_order
+        self.zeta = model.zeta
+
+    @property
+    def shape(self):
+        return self.mask.shape
+
+    def _unmask(self, masked_values):
+        """Put per-voxel values back into the shape of the mask."""
+        masked_values = np.asarray(masked_values)
+        output = np.zeros(self.mask.shape + masked_values.shape[1:],
+                          dtype=np.result_type(masked_values, np.float64))
+        output[self.mask] = masked_values
+        return output
+
+    def _project(self, matrix, chunk_size=L2_CHUNK_SIZE):
+        """Multiply the coefficients of each voxel by ``matrix`` in chunks of voxels."""
+        matrix = np.asarray(matrix)
+        masked_output = np.zeros((self._masked_coef.shape[0], matrix.shape[0]))
+        for start in range(0, self._masked_coef.shape[0], chunk_size):
+            chunk = slice(start, start + chunk_size)
+            masked_output[chunk] = np.dot(self._masked_coef[chunk], matrix.T)
+        return self._unmask(masked_output)
+
+    @property
+    def _shore_coef(self):
+        return self._unmask(self._masked_coef)
+
+    def pdf(self, r_points):
+        """ Diffusion propagator on a given set of real points.
+        """
+        psi = cached_shore_matrix_pdf(self.radial_order, self.zeta, r_points)
+        eap = self._project(psi)
+        return np.clip(eap, 0, None)
+
+    def odf_sh(self):
+        r""" Calculates the real analytical ODF in terms of Spherical
+        Harmonics.
+        """
+        return self._project(shore_odf_sh_matrix(self.radial_order, self.zeta))
+
+    def odf(self, sphere):
+        r""" Calculates the ODF for a given discrete sphere.
+        """
+        upsilon = self.model.cache_get('shore_matrix_odf', key=sphere)
+        if upsilon is None:
+            upsilon = cached_shore_matrix_odf(self.radial_order, self.zeta, sphere.vertices)
+            self.model.cache_set('shore_matrix_odf', sphere, upsilon)
+        return self._project(upsilon)
+
+    def _radial_moment(self, weights):
+        moment = np.dot(self._masked_coef[:, :len(weights)], weights)
+        return self._unmask(np.clip(moment, 0, None))
+
+    def rtop_signal(self):
+        r""" Calculates the analytical return to origin probability (RTOP)
+        from the signal. See :meth:`BrainSuiteShoreFit.rtop_signal`.
+        """
+        return self._radial_moment(np.array([
+            (-1) ** n * ((16 * np.pi * self.zeta ** 1.5 * gamma(n + 1.5)) /
+                         (factorial(n))) ** 0.5
+            for n in range(int(self.radial_order / 2) + 1)]))
+
+    def rtop_pdf(self):
+        r""" Calculates the analytical return to origin probability (RTOP)
+        from the pdf. See :meth:`BrainSuiteShoreFit.rtop_pdf`.
+        """
+        return self._radial_moment(np.array([
+            (-1) ** n * ((4 * np.pi ** 2 * self.zeta ** 1.5 * factorial(n)) /
+                         (gamma(n + 1.5))) ** 0.5 * genlaguerre(n, 0.5)(0)
+            for n in range(int(self.radial_order / 2) + 1)]))
+
+    def msd(self):
+        r""" Calculates the analytical mean squared displacement (MSD).
+        See :meth:`BrainSuiteShoreFit.msd`.
+        """
+        return self._radial_moment(np.array([
+            (-1) ** n * (9 * (gamma(n + 1.5)) / (8 * np.pi ** 6 * self.zeta ** 3.5 *
+                                                 factorial(n))) ** 0.5 *
+            hyp2f1(-n, 2.5, 1.5, 2)
+            for n in range(int(self.radial_order / 2) + 1)]))
+
+    def fitted_signal(self):
+        """ The fitted signal.
+        """
+        phi = self.model._shore_basis()
+        return self._project(phi)
+
+    def predict(self, gtab, S0=100.):
+        r"""Recovers the reconstructed signal for any qvalue array or
+        gradient table.
+        """
+        M = cached_shore_basis(self.radial_order, self.zeta, gtab, self.model.tau)
+        E = self._project(M)
+        if isinstance(S0, np.ndarray):
+            S0 = S0[..., np.newaxis]
+        return S0 * E
+
+    @property
+    def shore_coeff(self):
+        """The SHORE coefficients."""
+        return self._shore_coef
+
+    @property
+    def alpha(self):
+        """The alpha used for the L1 fit."""
+        return self._unmask(np.broadcast_to(self._alpha, self.mask.sum()))
+
+    @property
+    def cnr(self):
+        """Contrast to Noise ratio."""
+        return self._unmask(np.broadcast_to(self._cnr, self.mask.sum()))
+
+    @property
+    def regularization(self):
+        """Regularization used for fitting coefficients."""
+        return self._unmask(np.broadcast_to(self._regularization, self.mask.sum()))
+
+    @property
+    def r2(self):
+        """Model r^2."""
+        return self._unmask(np.broadcast_to(self._r2, self.mask.sum()))
+
+
+def _r2_score_rows(data, fitted):
+    """``sklearn.metrics.r2_score`` computed separately for each row."""
+    numerator = ((data - fitted) ** 2).sum(1)
+    denominator = ((data - data.mean(1)[:, np.newaxis]) ** 2).sum(1)
+    r2 = np.where(numerator == 0, 1., 0.)
+    nonzero = denominator != 0
+    r2[nonzero] = 1 - numerator[nonzero] / denominator[nonzero]
+    return r2
+
+
 def _kappa(zeta, n, l):
     return np.sqrt((2 * factorial(n - l)) / (zeta**1.5 * gamma(n + 1.5)))
 
@@ -607,6 +1036,50 @@ def _kappa_odf(zeta, n, l):
          (l + 3)) / (16 * np.pi**3 * (zeta)**1.5 * factorial(n - l) * gamma(l + 1.5)**2))
 
 
+def shore_odf_sh_matrix(radial_order, zeta):
+    r"""Matrix that maps SHORE coefficients to the spherical harmonic coefficients
+    of the analytical ODF.
+
+    Parameters
+    ----------
+    radial_order : unsigned int,
+        an even integer that represent the order of the basis
+    zeta : unsigned int,
+        scale factor
+
+    Returns
+    -------
+    odf_sh : array, shape (J, n_coefs)
+        where J = (radial_order + 1) * (radial_order + 2) / 2
+    """
+    # Number of Spherical Harmonics involved in the estimation
+    J = (radial_order + 1) * (radial_order + 2) // 2
+    n_coefs = shore_index_matrix(radial_order).shape[0]
+    odf_sh = np.zeros((J, n_coefs))
+    counter = 0
+
+    for n in range(radial_order + 1):
+        for l in range(0, n + 1, 2):
+            for m in range(-l, l + 1):
+
+                j = int(l + m + (2 * np.array(range(0, l, 2)) + 1).sum())
+
+                Cnl = (((-1)**
+                        (n - l / 2)) / (2.0 * (4.0 * np.pi**2 * zeta)**(3.0 / 2.0)) * (
+                            (2.0 * (4.0 * np.pi**2 * zeta)**
+                             (3.0 / 2.0) * factorial(n - l)) / (gamma(n + 3.0 / 2.0)))**
+                       (1.0 / 2.0))
+                Gnl = (gamma(l / 2 + 3.0 / 2.0) * gamma(3.0 / 2.0 + n)) / \
+                    (gamma(l + 3.0 / 2.0) * factorial(n - l)) * \
+                    (1.0 / 2.0) ** (-l / 2 - 3.0 / 2.0)
+                Fnl = hyp2f1(-n + l, l / 2 + 3.0 / 2.0, l + 3.0 / 2.0, 2.0)
+
+                odf_sh[j, counter] += Cnl * Gnl * Fnl
+                counter += 1
+
+    return odf_sh
+
+
 def create_rspace(gridsize, radius_max):
     """ Create the real space table, that contains the points in which to compute the pdf.
 
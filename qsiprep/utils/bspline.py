@@ -10,7 +10,7 @@ from scipy.interpolate import interpn
 from datetime import datetime as dt
 from ..interfaces.images import to_lps
 from nipype import logging
-LOGGER = logging.getLogger('nipype.interfaces')
+LOGGER = logging.getLogger('nipype.interface')
 
 
 class BSplineFieldmap(object):
@@ -19,7 +19,7 @@ class BSplineFieldmap(object):
     """
 
     def __init__(self, fmapnii, weights=None, knots_zooms=None, padding=3,
-                 pe_dir=1, njobs=-1):
+                 pe_dir=1, njobs=-1, damping=0.0):
 
         self._pedir = pe_dir
         if knots_zooms is None:
@@ -77,6 +77,7 @@ class BSplineFieldmap(object):
         self._invcoeff = None
 
         self._njobs = njobs
+        self._damping = damping
 
     def _generate_knots(self):
         extent = self._fmapaff[:3, :3].dot(self._data.shape[:3])
@@ -116,9 +117,9 @@ class BSplineFieldmap(object):
 
         print('[%s] Starting least-squares fitting using %d unmasked points' %
               (dt.now(), len(fieldata[self._weights > 0.0])))
-        self._coeff = np.linalg.lstsq(
-            self._X[self._weights > 0.0, ...].toarray(),
-            fieldata[self._weights > 0.0])[0]
+        self._coeff = sparse_lstsq(
+            self._X[self._weights > 0.0, ...],
+            fieldata[self._weights > 0.0], damp=self._damping)
         print('[%s] Finished least-squares fitting' % dt.now())
 
     def get_coeffmap(self):
@@ -146,8 +147,9 @@ class BSplineFieldmap(object):
 
         print('[%s] Starting least-squares fitting using %d unmasked points' %
               (dt.now(), len(targets)))
-        self._invcoeff = np.linalg.lstsq(
-            self._Xinv, self._fmapxyz[:, self._pedir] - targets[:, self._pedir])[0]
+        self._invcoeff = sparse_lstsq(
+            self._Xinv, self._fmapxyz[:, self._pedir] - targets[:, self._pedir],
+            damp=self._damping)
         print('[%s] Finished least-squares fitting' % dt.now())
 
     def get_inverted(self):
@@ -207,35 +209,100 @@ def compute_affine(data, zooms):
 def tbspl_eval(points, knots, zooms, njobs=None):
     """
     Evaluate tensor product BSpline
+
+    The knots must form a regular grid with spacing ``zooms``, listed in the
+    order given by :func:`get_ijk`. The cubic BSpline is separable, so the
+    weights are computed per axis on the 4 knots supporting each point and
+    multiplied into the 4x4x4 support of the design matrix, which is
+    assembled directly in sparse form. ``njobs`` is accepted for backwards
+    compatibility and ignored.
     """
-    from scipy.sparse import vstack
-    from qsiprep.utils.maths import bspl
+    from scipy.sparse import coo_matrix
 
     points = np.array(points, dtype=float)
     knots = np.array(knots, dtype=float)
-    vbspl = np.vectorize(bspl)
-
-    if njobs is not None and njobs < 1:
-        njobs = None
-
-    if njobs == 1:
-        coeffs = [_evalp((p, knots, vbspl, zooms)) for p in points]
-    else:
-        from multiprocessing import Pool
-        pool = Pool(processes=njobs, maxtasksperchild=100)
-        coeffs = pool.map(
-            _evalp, [(p, knots, vbspl, zooms) for p in points])
-        pool.close()
-        pool.join()
-
-    return vstack(coeffs)
-
-
-def _evalp(args):
-    import numpy as np
-    from scipy.sparse import csr_matrix
+    zooms = np.array(zooms, dtype=float)
+
+    axes = [np.unique(knots[:, axis]) for axis in range(3)]
+    grid_shape = tuple(len(axis_knots) for axis_knots in axes)
+    origin = np.array([axis_knots[0] for axis_knots in axes])
+    expected = origin + get_ijk(np.empty(grid_shape)) * zooms
+    if knots.shape != expected.shape or not np.allclose(knots, expected):
+        raise ValueError('Knots must lie on a regular grid with spacing %s' % str(zooms))
+
+    # Per-axis knot indices and weights of the 4 supporting knots, (npoints, 4)
+    axis_indices = []
+    axis_weights = []
+    for axis in range(3):
+        position = (points[:, axis] - origin[axis]) / zooms[axis]
+        indices = np.floor(position).astype(int)[:, np.newaxis] + np.arange(-1, 3)
+        weights = _bspl_weights(indices - position[:, np.newaxis])
+        weights[(indices < 0) | (indices >= grid_shape[axis])] = 0.0
+        axis_indices.append(indices)
+        axis_weights.append(weights)
+
+    # Combine the supports into (npoints, 64) columns and values
+    columns = np.ravel_multi_index(
+        (axis_indices[0][:, :, np.newaxis, np.newaxis],
+         axis_indices[1][:, np.newaxis, :, np.newaxis],
+         axis_indices[2][:, np.newaxis, np.newaxis, :]),
+        grid_shape, mode='clip').reshape(len(points), -1)
+    values = (axis_weights[0][:, :, np.newaxis, np.newaxis] *
+              axis_weights[1][:, np.newaxis, :, np.newaxis] *
+              axis_weights[2][:, np.newaxis, np.newaxis, :]).reshape(len(points), -1)
+    rows = np.repeat(np.arange(len(points)), values.shape[1]).reshape(values.shape)
+
+    nonzero = values != 0.0
+    return coo_matrix((values[nonzero], (rows[nonzero], columns[nonzero])),
+                      shape=(len(points), len(knots))).tocsr()
+
+
+def sparse_lstsq(design, values, damp=0.0, tol=1e-10):
+    """
+    Least-squares solution of ``design.dot(coeff) = values`` for a sparse
+    design matrix, optionally Tikhonov-regularized with ``damp``.
 
-    point, knots, vbspl, zooms = args
-    u_vec = (knots - point[np.newaxis, ...]) / zooms[np.newaxis, ...]
-    c = vbspl(u_vec.reshape(-1)).reshape((knots.shape[0], 3)).prod(axis=1)
-    return csr_matrix(c)
+    The normal equations are banded for a BSpline basis, so they are built
+    and factorized in sparse form. Knots without support get a zero
+    coefficient. If the normal equations are singular, the system is solved
+    with column-scaled LSMR instead. The dense design matrix is never built.
+    """
+    from scipy.sparse import csr_matrix, identity, diags
+    from scipy.sparse.linalg import splu, lsmr
+
+    design = csr_matrix(design)
+    values = np.asarray(values, dtype=float)
+    sparse_mb = (design.data.nbytes + design.indices.nbytes + design.indptr.nbytes) / 1e6
+    dense_mb = design.shape[0] * design.shape[1] * 8 / 1e6
+
+    coeff = np.zeros(design.shape[1])
+    active = np.flatnonzero(design.getnnz(axis=0))
+    design = design[:, active]
+    gram = design.T.dot(design) + damp ** 2 * identity(len(active))
+    try:
+        coeff[active] = splu(gram.tocsc()).solve(design.T.dot(values))
+        if not np.all(np.isfinite(coeff)):
+            raise RuntimeError('Non-finite solution of the normal equations')
+    except RuntimeError:
+        norms = np.sqrt(np.asarray(design.multiply(design).sum(axis=0))).ravel()
+        scaling = diags(1.0 / norms)
+        solution, istop, itn = lsmr(design.dot(scaling), values, damp=damp, atol=tol,
+                                    btol=tol, maxiter=10 * len(active))[:3]
+        coeff[active] = scaling.dot(solution)
+        LOGGER.info('Normal equations are singular, used %d LSMR iterations (stop reason %d)',
+                    itn, istop)
+        if istop == 7:
+            LOGGER.warning('LSMR reached the iteration limit before converging')
+
+    LOGGER.info('Sparse least-squares: design matrix %s (%.1f MB sparse, %.1f MB dense), '
+                'normal equations %s with %d nonzeros, residual norm %g',
+                str(design.shape), sparse_mb, dense_mb, str(gram.shape), gram.nnz,
+                np.linalg.norm(design.dot(coeff[active]) - values))
+    return coeff
+
+
+def _bspl_weights(x):
+    """Univariate cubic bspline evaluated on an array"""
+    x_t = np.abs(x)
+    return np.where(x_t <= 1.0, 2.0 / 3.0 - x_t ** 2 + 0.5 * x_t ** 3,
+                    np.where(x_t < 2.0, (2.0 - np.minimum(x_t, 2.0)) ** 3 / 6.0, 0.0))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+MRtrix image writing
+^^^^^^^^^^^^^^^^^^^^
+
+Write MRtrix ``.mif`` images without calling MRtrix. The data are written
+voxel by voxel with the volume axis contiguous (``layout: +1,+2,+3,+0``), the
+layout MRtrix uses for SH and FOD images, so they can be streamed in chunks
+of voxels.
+
+
+"""
+import numpy as np
+from nibabel.openers import ImageOpener
+
+MIF_DATATYPES = {
+    np.dtype('<f4'): 'Float32LE',
+    np.dtype('<f8'): 'Float64LE',
+    np.dtype('<i2'): 'Int16LE',
+    np.dtype('<i4'): 'Int32LE',
+    np.dtype('uint8'): 'UInt8',
+}
+
+
+def mif_header(shape, affine, dtype=np.float32, comments=()):
+    """Text header of a 4D ``.mif`` image whose last axis is contiguous.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        (X, Y, Z, N) shape of the image
+    affine : (4, 4) array
+        voxel to RAS mm affine, as in NIfTI
+    dtype : numpy dtype
+        little-endian data type of the voxel values
+    comments : sequence of str
+        lines added as ``comments`` entries
+
+    Returns
+    -------
+    header : bytes
+        the header, including the ``file`` entry and ``END``, padded so the
+        data start on a 16 byte boundary
+    """
+    affine = np.asarray(affine, dtype=float)
+    zooms = np.sqrt((affine[:3, :3] ** 2).sum(0))
+    rotation = affine[:3, :3] / zooms
+    lines = ['mrtrix image',
+             'dim: ' + ','.join('%d' % dim for dim in shape),
+             'vox: ' + ','.join('%.6g' % zoom for zoom in zooms) + ',nan',
+             'layout: +1,+2,+3,+0',
+             'datatype: ' + MIF_DATATYPES[np.dtype(dtype).newbyteorder('<')]]
+    lines += ['transform: ' + ','.join('%.10g' % value for value in row)
+              for row in np.column_stack([rotation, affine[:3, 3]])]
+    lines += ['comments: ' + comment for comment in comments]
+    header = '\n'.join(lines) + '\n'
+
+    # The data offset is written in the header, so the header size depends on it
+    data_offset = 0
+    while True:
+        header_size = len(header) + len('file: . %d\nEND\n' % data_offset)
+        aligned_size = int(np.ceil(header_size / 16.)) * 16
+        if aligned_size == data_offset:
+            break
+        data_offset = aligned_size
+    header += 'file: . %d\nEND\n' % data_offset
+    return header.encode('latin-1') + b'\x00' * (data_offset - len(header))
+
+
+def write_voxelwise_mif(out_file, shape, affine, voxel_blocks, dtype=np.float32,
+                        comments=()):
+    """Write a 4D ``.mif`` image from blocks of voxels.
+
+    Parameters
+    ----------
+    out_file : str
+        output file name, compressed if it ends with ``.gz``
+    shape : tuple of int
+        (X, Y, Z, N) shape of the image
+    affine : (4, 4) array
+        voxel to RAS mm affine, as in NIfTI
+    voxel_blocks : iterable of arrays
+        (voxels, N) arrays that together cover all the X * Y * Z voxels in
+        Fortran (x fastest) order
+    dtype : numpy dtype
+        data type written to the file
+    comments : sequence of str
+        lines added as ``comments`` entries
+
+    Returns
+    -------
+    out_file : str
+    """
+    dtype = np.dtype(dtype).newbyteorder('<')
+    num_voxels = int(np.prod(shape[:3]))
+    written = 0
+    with ImageOpener(out_file, 'wb') as fobj:
+        fobj.write(mif_header(shape, affine, dtype, comments))
+        for block in voxel_blocks:
+            fobj.write(np.ascontiguousarray(block, dtype=dtype).tobytes())
+            written += len(block)
+    if written != num_voxels:
+        raise ValueError('Wrote %d voxels to %s, expected %d' % (written, out_file, num_voxels))
+    return out_file
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Streaming NIfTI writing
+^^^^^^^^^^^^^^^^^^^^^^^
+
+Concatenate 3D and 4D images into a 4D series, or extract some of the volumes
+of a series, without holding the series in memory: the header is written
+first and the volumes are appended one at a time, so only one volume is
+loaded at once.
+
+
+"""
+import shutil
+import subprocess
+from contextlib import contextmanager
+from io import BytesIO
+import numpy as np
+import nibabel as nb
+from nibabel.openers import ImageOpener
+
+
+def num_volumes(img):
+    """Number of volumes in a 3D or 4D image."""
+    return img.shape[3] if len(img.shape) > 3 else 1
+
+
+def iter_volumes(img):
+    """Yield the volumes of a 3D or 4D image as 3D arrays, one at a time."""
+    if len(img.shape) < 4:
+        yield np.asanyarray(img.dataobj)
+        return
+    for volume in range(img.shape[3]):
+        yield np.asanyarray(img.dataobj[..., volume])
+
+
+def is_scaled(img):
+    """Whether the data of ``img`` have scaling factors."""
+    slope, inter = img.dataobj.slope, img.dataobj.inter
+    return bool(np.isfinite(slope) and (slope != 1 or inter != 0))
+
+
+def header_bytes(hdr):
+    """Serialize ``hdr`` with its extensions, padded to the start of the data.
+
+    The data offset is set to the end of the header on a 16 byte boundary.
+    """
+    hdr_bytes = BytesIO()
+    hdr.write_to(hdr_bytes)
+    hdr.set_data_offset(int(np.ceil(hdr_bytes.tell() / 16.)) * 16)
+    hdr_bytes = BytesIO()
+    hdr.write_to(hdr_bytes)
+    hdr_bytes.write(b'\x00' * (hdr.get_data_offset() - hdr_bytes.tell()))
+    return hdr_bytes.getvalue()
+
+
+@contextmanager
+def open_nifti_output(out_file, num_threads=1):
+    """Open ``out_file`` for writing, through ``pigz`` if it is available.
+
+    ``.gz`` files are compressed with ``num_threads`` pigz threads when
+    ``num_threads > 1`` and pigz is on the path, and with gzip otherwise.
+    """
+    pigz = shutil.which('pigz') if out_file.endswith('.gz') and num_threads > 1 else None
+    if pigz is None:
+        with ImageOpener(out_file, 'wb') as fobj:
+            yield fobj
+        return
+    with open(out_file, 'wb') as raw_file:
+        proc = subprocess.Popen([pigz, '-p', str(num_threads), '-1', '-c'],
+                                stdin=subprocess.PIPE, stdout=raw_file)
+        try:
+            yield proc.stdin
+        finally:
+            proc.stdin.close()
+            if proc.wait():
+                raise RuntimeError('pigz failed to write %s' % out_file)
+
+
+def concat_niftis(in_files, out_file, dtype=None, header_source=None, abs_values=False,
+                  num_threads=1):
+    """Concatenate images along the fourth dimension, one volume at a time.
+
+    Parameters
+    ----------
+    in_files : list of str
+        3D or 4D images on the same grid. The affine comes from the first one.
+    out_file : str
+        output file name, compressed if it ends with ``.gz``
+    dtype : numpy dtype or None
+        dtype of the output. By default the dtype of the first image, or
+        float32 if any input has scaling factors.
+    header_source : str or None
+        image from which the time units and repetition time (if it is 4D)
+        are copied
+    abs_values : bool
+        write the absolute values of the data (negative values from
+        interpolation are flipped, as done for DWIs)
+    num_threads : int
+        number of pigz threads used for ``.gz`` output
+
+    Returns
+    -------
+    out_file : str
+    """
+    imgs = [nb.load(in_file) for in_file in in_files]
+    first_img = imgs[0]
+    for img, in_file in zip(imgs, in_files):
+        if img.shape[:3] != first_img.shape[:3]:
+            raise ValueError('%s does not have the shape of %s' % (in_file, in_files[0]))
+
+    if dtype is None:
+        scaled = any(is_scaled(img) for img in imgs)
+        dtype = np.float32 if scaled else first_img.get_data_dtype()
+
+    # Keep the orientation, units and timing of the first image, like 3dTCat
+    first_zooms = first_img.header.get_zooms()
+    out_hdr = first_img.header.copy()
+    out_hdr.set_data_dtype(dtype)
+    out_hdr.set_data_shape(first_img.shape[:3] + (sum(num_volumes(img) for img in imgs),))
+    out_hdr.set_zooms(first_zooms[:3] + (first_zooms[3] if len(first_zooms) > 3 else 1.,))
+    # The volumes are written with their scaling factors applied
+    out_hdr.set_slope_inter(np.nan, np.nan)
+    if header_source is not None:
+        src_hdr = nb.load(header_source).header
+        out_hdr.set_xyzt_units(t=src_hdr.get_xyzt_units()[-1])
+        if len(src_hdr.get_zooms()) > 3:
+            out_hdr.set_zooms(out_hdr.get_zooms()[:3] + (src_hdr.get_zooms()[3],))
+    out_dtype = out_hdr.get_data_dtype()
+
+    with open_nifti_output(out_file, num_threads) as fobj:
+        fobj.write(header_bytes(out_hdr))
+        for img in imgs:
+            for volume in iter_volumes(img):
+                if abs_values:
+                    # Before the cast, so that e.g. int16 -32768 does not wrap around
+                    volume = np.abs(volume.astype(np.float64))
+                    if np.issubdtype(out_dtype, np.integer):
+                        volume = np.minimum(volume, np.iinfo(out_dtype).max)
+                fobj.write(volume.astype(out_dtype).tobytes(order='F'))
+    return out_file
+
+
+def extract_volumes(in_file, indices, out_file, num_threads=1):
+    """Write some volumes of an image to a new file, one volume at a time.
+
+    Volumes are indexed along the last axis, so this works for 4D series as
+    well as for 6D local bvec images.
+
+    Parameters
+    ----------
+    in_file : str
+        image to take the volumes from
+    indices : sequence of int
+        volumes to keep, in output order
+    out_file : str
+        output file name, compressed if it ends with ``.gz``
+    num_threads : int
+        number of pigz threads used for ``.gz`` output
+
+    Returns
+    -------
+    out_file : str
+    """
+    img = nb.load(in_file)
+    out_hdr = img.header.copy()
+    out_hdr.set_data_shape(img.shape[:-1] + (len(indices),))
+    if is_scaled(img):
+        out_hdr.set_data_dtype(np.float32)
+    out_hdr.set_slope_inter(np.nan, np.nan)
+    out_dtype = out_hdr.get_data_dtype()
+
+    with open_nifti_output(out_file, num_threads) as fobj:
+        fobj.write(header_bytes(out_hdr))
+        for index in indices:
+            volume = np.asanyarray(img.dataobj[..., int(index)])
+            fobj.write(volume.astype(out_dtype).tobytes(order='F'))
+    return out_file
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+In-process linear registration
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+Rigid and affine registration of a volume to a target with Mattes mutual
+information on Gaussian pyramids, using the optimizer in
+:mod:`dipy.align.imaffine`. The stages, pyramid levels, smoothing, number
+of histogram bins and winsorization quantiles are read from the same
+``antsRegistration`` json files used for SHORELine, so the two methods can be
+swapped. The resulting transforms are written as ITK affines that map fixed
+points to moving points, like the ``*0GenericAffine.mat`` files written by
+ANTs.
+
+Some settings of the json files have no counterpart in dipy and are ignored:
+the metric is sampled densely instead of on ``sampling_percentage`` of the
+voxels, and dipy's L-BFGS-B optimizer uses its own step sizes and stopping
+rule instead of ``transform_parameters``, ``convergence_threshold`` and
+``convergence_window_size``.
+
+The fixed image mask restricts the metric to the brain. dipy 0.15 cannot
+mask the metric, so with it the fixed image is cropped to the bounding box of
+the mask instead.
+
+
+"""
+import json
+from inspect import signature
+import numpy as np
+import nibabel as nb
+from dipy.align.imaffine import (AffineRegistration, MutualInformationMetric,
+                                 AffineInversionError, AffineInvalidValuesError)
+from dipy.align.transforms import RigidTransform3D, AffineTransform3D
+from ..interfaces.itk import SPLINE_ORDERS
+from .transforms import apply_affine, ras_to_itk, write_itk_affine
+
+DIPY_TRANSFORMS = {
+    'Rigid': RigidTransform3D,
+    'Affine': AffineTransform3D,
+}
+
+# Errors of a registration that did not work out, as opposed to bad inputs
+REGISTRATION_ERRORS = (ValueError, np.linalg.LinAlgError, AffineInversionError,
+                       AffineInvalidValuesError)
+
+# The static_mask argument was added after dipy 0.15
+OPTIMIZE_TAKES_MASK = 'static_mask' in signature(AffineRegistration.optimize).parameters
+
+
+def registration_stages(ants_settings, zooms):
+    """Read the stages of an ``antsRegistration`` json file.
+
+    Parameters
+    ----------
+    ants_settings : str
+        json file with the inputs of :class:`nipype.interfaces.ants.Registration`.
+        Only Rigid and Affine stages are supported.
+    zooms : sequence of float
+        voxel sizes of the fixed image, used to convert smoothing sigmas in mm
+        to voxels
+
+    Returns
+    -------
+    stages : list of dict
+        keys ``transform``, ``level_iters``, ``factors``, ``sigmas`` (in voxels),
+        ``nbins`` and ``winsorize`` (lower and upper quantiles), with levels
+        ordered from coarse to fine
+    interpolation : str
+        ANTs interpolator for the warped image
+    """
+    with open(ants_settings) as settings_json:
+        settings = json.load(settings_json)
+    sigma_units = settings.get('sigma_units', ['vox'] * len(settings['transforms']))
+    winsorize = (settings.get('winsorize_lower_quantile', 0.),
+                 settings.get('winsorize_upper_quantile', 1.))
+    stages = []
+    for stage_num, transform in enumerate(settings['transforms']):
+        if transform not in DIPY_TRANSFORMS:
+            raise ValueError('Unsupported transform %s in %s' % (transform, ants_settings))
+        sigmas = np.array(settings['smoothing_sigmas'][stage_num], dtype=float)
+        if sigma_units[stage_num] == 'mm':
+            sigmas = sigmas / min(zooms)
+        stages.append({
+            'transform': transform,
+            'level_iters': list(settings['number_of_iterations'][stage_num]),
+            'factors': list(settings['shrink_factors'][stage_num]),
+            'sigmas': sigmas.tolist(),
+            'nbins': int(settings['radius_or_number_of_bins'][stage_num]),
+            'winsorize': winsorize})
+    return stages, settings.get('interpolation', 'Linear')
+
+
+def winsorize(data, lower, upper):
+    """Clip the intensities of ``data`` to its ``lower`` and ``upper`` quantiles."""
+    if lower <= 0. and upper >= 1.:
+        return data
+    low_value, high_value = np.percentile(data, [100 * lower, 100 * upper])
+    return np.clip(data, low_value, high_value)
+
+
+def crop_to_mask(data, affine, mask):
+    """Crop ``data`` to the bounding box of ``mask``.
+
+    Returns the cropped data and its voxel to world affine.
+    """
+    nonzero = np.nonzero(mask)
+    if not len(nonzero[0]):
+        raise ValueError('The fixed image mask is empty')
+    starts = np.array([axis.min() for axis in nonzero])
+    stops = np.array([axis.max() + 1 for axis in nonzero])
+    cropped = data[tuple(slice(start, stop) for start, stop in zip(starts, stops))]
+    cropped_affine = affine.copy()
+    cropped_affine[:3, 3] = affine[:3, :3].dot(starts) + affine[:3, 3]
+    return cropped, cropped_affine
+
+
+def register_affine(fixed_data, fixed_affine, moving_data, moving_affine, stages,
+                    fixed_mask=None):
+    """Register ``moving_data`` to ``fixed_data``, one stage after another.
+
+    Parameters
+    ----------
+    fixed_data, moving_data : 3D arrays
+    fixed_affine, moving_affine : (4, 4) arrays
+        voxel to RAS mm affines
+    stages : list of dict
+        from :func:`registration_stages`
+    fixed_mask : 3D int array or None
+        nonzero where the metric is computed. With dipy 0.15 the fixed image
+        is cropped to its bounding box instead
+
+    Returns
+    -------
+    affine : (4, 4) array
+        maps RAS points of the fixed image to RAS points of the moving image
+    """
+    mask_kwargs = {}
+    if fixed_mask is not None:
+        if OPTIMIZE_TAKES_MASK:
+            mask_kwargs['static_mask'] = fixed_mask
+        else:
+            fixed_data, fixed_affine = crop_to_mask(fixed_data, fixed_affine, fixed_mask)
+
+    affine = np.eye(4)
+    for stage in stages:
+        lower, upper = stage.get('winsorize', (0., 1.))
+        metric = MutualInformationMetric(nbins=stage['nbins'], sampling_proportion=None)
+        registration = AffineRegistration(
+            metric=metric, level_iters=stage['level_iters'], sigmas=stage['sigmas'],
+            factors=stage['factors'], verbosity=0)
+        affine_map = registration.optimize(
+            winsorize(fixed_data, lower, upper), winsorize(moving_data, lower, upper),
+            DIPY_TRANSFORMS[stage['transform']](), None,
+            static_grid2world=fixed_affine, moving_grid2world=moving_affine,
+            starting_affine=affine, **mask_kwargs)
+        affine = affine_map.affine
+    if not np.all(np.isfinite(affine)):
+        raise ValueError('Registration diverged')
+    return affine
+
+
+def resample_to_fixed(moving_data, moving_affine, fixed_shape, fixed_affine, affine,
+                      interpolation='BSpline'):
+    """Sample ``moving_data`` on the fixed grid through ``affine`` (fixed to moving RAS)."""
+    from scipy.ndimage import map_coordinates
+    fixed_ijk = np.indices(fixed_shape, dtype=np.float32).reshape(3, -1)
+    voxel_map = np.linalg.inv(moving_affine).dot(affine).dot(fixed_affine)
+    order = SPLINE_ORDERS[interpolation]
+    return map_coordinates(moving_data, apply_affine(voxel_map, fixed_ijk), order=order,
+                           mode='constant', cval=0., prefilter=order > 1
+                           ).reshape(fixed_shape)
+
+
+def register_to_file(fixed_file, moving_file, stages, transform_file, warped_file=None,
+                     fixed_mask=None, interpolation='BSpline'):
+    """Register two images and write the ITK transform and the warped image.
+
+    Parameters
+    ----------
+    fixed_file, moving_file : str
+        images to register
+    stages : list of dict
+        from :func:`registration_stages`
+    transform_file : str
+        output ITK affine (``.mat`` or ``.txt``)
+    warped_file : str or None
+        output moving image resampled on the fixed grid
+    fixed_mask : 3D int array or None
+        mask on the grid of ``fixed_file``, loaded once by the caller
+    interpolation : str
+        ANTs interpolator name for the warped image
+
+    Returns
+    -------
+    transform_file : str
+    warped_file : str or None
+    """
+    fixed_img = nb.load(fixed_file)
+    moving_img = nb.load(moving_file)
+    fixed_data = np.asanyarray(fixed_img.dataobj, dtype=np.float32).reshape(fixed_img.shape[:3])
+    moving_data = np.asanyarray(moving_img.dataobj, dtype=np.float32).reshape(
+        moving_img.shape[:3])
+    affine = register_affine(fixed_data, fixed_img.affine, moving_data, moving_img.affine,
+                             stages, fixed_mask=fixed_mask)
+    write_itk_affine(ras_to_itk(affine), transform_file)
+    if warped_file is not None:
+        warped = resample_to_fixed(moving_data, moving_img.affine, fixed_data.shape,
+                                   fixed_img.affine, affine, interpolation)
+        warped_img = nb.Nifti1Image(warped, fixed_img.affine, fixed_img.header)
+        warped_img.set_data_dtype(np.float32)
+        warped_img.to_filename(warped_file)
+    return transform_file, warped_file
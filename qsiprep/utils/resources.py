@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Resource estimation
+^^^^^^^^^^^^^^^^^^^
+
+Estimate the memory and threads needed by the heavy nodes of a workflow from
+the NIfTI headers of the DWI series, without loading any data. Each interface
+has a cost model that is linear in the size of the series, the size of the
+in-brain part of the series and the size of a single volume. The models can
+be calibrated with the ``resource_monitor.json`` that nipype writes when
+``--resource-monitor`` is used.
+
+The coefficients of the cost models count the arrays each interface keeps in
+memory at its peak, read from the implementation of the interface. For
+external commands (eddy, dwidenoise, DSI Studio, MRtrix) they are
+conservative multiples of the size of the series. In both cases they are
+upper bounds that ``calibrate_cost_models`` scales to the measured peaks.
+
+
+"""
+import os
+import os.path as op
+import json
+from collections import defaultdict, namedtuple
+from functools import lru_cache
+import numpy as np
+import nibabel as nb
+from nipype import logging
+
+LOGGER = logging.getLogger('nipype.interface')
+
+GB = 1024.0 ** 3
+
+# Fraction of the field of view covered by the brain mask when no mask is
+# available, e.g. before preprocessing. Adult intracranial volumes are below
+# 1.8 L and DWI fields of view are usually 5-8 L (e.g. 240x240x140 mm), so
+# masks cover 0.2-0.35 of the voxels. 0.4 errs on the side of more memory.
+BRAIN_FRACTION = 0.4
+
+# Scale factors written by ``calibrate_cost_models``
+CALIBRATION_FILE = os.getenv('QSIPREP_RESOURCE_CALIBRATION')
+
+SeriesGeometry = namedtuple('SeriesGeometry', ['shape', 'num_volumes', 'itemsize', 'zooms'])
+
+# base: constant GB
+# series: GB per copy of the series as float32
+# masked: GB per copy of the in-mask series as float64
+# volume: GB per float32 volume
+# threads: maximum number of threads (0 for single-threaded, None for no limit)
+CostModel = namedtuple('CostModel', ['base', 'series', 'masked', 'volume', 'threads'])
+
+COST_MODELS = {
+    # The masked training data and its SHORE coefficients and fitted signal
+    # (2 in-mask copies), plus the b=0 reference and the prediction volumes
+    'SignalPrediction': CostModel(0.5, 0., 2., 2., 0),
+    # Also holds the predictions of all the left-out volumes
+    'SignalPredictionAll': CostModel(0.5, 0., 3., 2., 0),
+    # SignalPredictionAll plus the fixed, moving and warped volumes and the
+    # metric gradients of one registration per thread
+    'SHORELine': CostModel(1., 0., 3., 8., None),
+    # One volume per mapnode iteration: input, output, the displacement field
+    # (3 volumes) and the interpolation buffer. Time series are handled in
+    # ``_model_sizes``
+    'ApplyTransforms': CostModel(0.3, 0., 0., 6., 1),
+    'FixHeaderApplyTransforms': CostModel(0.3, 0., 0., 6., 1),
+    # The output series, plus one volume's sampling coordinates (3 volumes),
+    # spline coefficients and output at a time
+    'MultiVolumeResample': CostModel(0.3, 1., 0., 8., 0),
+    # Streamed one volume at a time
+    'Merge': CostModel(0.1, 0., 0., 4., None),
+    'MergeDWIs': CostModel(0.1, 0., 0., 4., None),
+    # External commands
+    'ExtendedEddy': CostModel(1., 4., 0., 0., None),
+    'DWIDenoise': CostModel(0.3, 3., 0., 0., None),
+    # Reconstruction
+    'MAPMRIReconstruction': CostModel(1., 0., 4., 0., None),
+    'BrainSuiteShoreReconstruction': CostModel(1., 0., 4., 0., None),
+    'DSIStudioReconstruction': CostModel(0.5, 2., 0., 0., None),
+    'DSIStudioGQIReconstruction': CostModel(0.5, 2., 0., 0., None),
+    'DSIStudioDTIReconstruction': CostModel(0.5, 2., 0., 0., None),
+    'EstimateFOD': CostModel(0.5, 2., 0., 0., None),
+    'GlobalTractography': CostModel(1., 2., 0., 0., None),
+}
+
+
+@lru_cache(maxsize=256)
+def _header_geometry(fname, mtime, size):
+    img = nb.load(fname)
+    shape = img.shape + (1,) * (4 - len(img.shape))
+    return SeriesGeometry(shape=tuple(shape[:3]), num_volumes=int(np.prod(shape[3:])),
+                          itemsize=img.get_data_dtype().itemsize,
+                          zooms=tuple(float(zoom) for zoom in img.header.get_zooms()[:3]))
+
+
+@lru_cache(maxsize=256)
+def _mask_fraction(fname, mtime, size):
+    mask = np.asanyarray(nb.load(fname).dataobj)
+    return float(np.count_nonzero(mask)) / mask.size
+
+
+def mask_fraction(mask_file, default=BRAIN_FRACTION):
+    """Fraction of the voxels inside a brain mask.
+
+    Masks are small, so this reads the whole image. The result is cached
+    like the headers in :func:`series_geometry`. ``default`` is returned if
+    ``mask_file`` is ``None`` or cannot be read.
+    """
+    if mask_file is None or not op.exists(mask_file):
+        return default
+    stat = os.stat(mask_file)
+    try:
+        return _mask_fraction(op.abspath(mask_file), stat.st_mtime, stat.st_size)
+    except nb.filebasedimages.ImageFileError:
+        LOGGER.warning('Unable to read the brain mask %s', mask_file)
+        return default
+
+
+def series_geometry(dwi_files):
+    """Read the geometry of one or more DWI series from their headers.
+
+    The headers are cached on the file path, modification time and size, so
+    building several workflows over the same files reads each header once.
+    The volumes of several series are added together.
+
+    Parameters
+    ----------
+    dwi_files : str or list of str
+        NIfTI files on the same grid
+
+    Returns
+    -------
+    geometry : SeriesGeometry or None
+        ``None`` if none of the files can be read
+    """
+    if isinstance(dwi_files, str):
+        dwi_files = [dwi_files]
+    geometries = []
+    for dwi_file in dwi_files:
+        if not op.exists(dwi_file):
+            continue
+        stat = os.stat(dwi_file)
+        try:
+            geometries.append(_header_geometry(op.abspath(dwi_file), stat.st_mtime,
+                                               stat.st_size))
+        except nb.filebasedimages.ImageFileError:
+            LOGGER.warning('Unable to read the header of %s', dwi_file)
+    if not geometries:
+        return None
+    return geometries[0]._replace(
+        num_volumes=sum(geometry.num_volumes for geometry in geometries),
+        itemsize=max(geometry.itemsize for geometry in geometries))
+
+
+def resample_geometry(geometry, output_resolution):
+    """Geometry of ``geometry`` resampled to isotropic ``output_resolution`` voxels."""
+    scales = [zoom / float(output_resolution) for zoom in geometry.zooms]
+    return geometry._replace(
+        shape=tuple(int(np.ceil(dim * scale)) for dim, scale in zip(geometry.shape, scales)),
+        zooms=(float(output_resolution),) * 3)
+
+
+def volume_gb(geometry, itemsize=4):
+    """Size of one volume in GB."""
+    return np.prod(geometry.shape) * itemsize / GB
+
+
+def series_gb(geometry, itemsize=4):
+    """Size of the whole series in GB."""
+    return volume_gb(geometry, itemsize) * geometry.num_volumes
+
+
+@lru_cache(maxsize=1)
+def load_calibration(calibration_file=CALIBRATION_FILE):
+    """Per-interface scale factors written by ``calibrate_cost_models``."""
+    if not calibration_file or not op.exists(calibration_file):
+        return {}
+    with open(calibration_file) as calibration_json:
+        return json.load(calibration_json)
+
+
+def _model_sizes(geometry, mask_fraction, time_series=False):
+    sizes = np.array([1.,
+                      series_gb(geometry),
+                      series_gb(geometry, 8) * mask_fraction,
+                      volume_gb(geometry)])
+    if time_series:
+        # A volume-wise model applied to the whole series
+        sizes[3] *= geometry.num_volumes
+    return sizes
+
+
+def estimate_resources(interface_name, geometry, omp_nthreads=1, mask_fraction=BRAIN_FRACTION,
+                       time_series=False, calibration=None):
+    """Estimate the peak memory and the number of threads of an interface.
+
+    Parameters
+    ----------
+    interface_name : str
+        class name of the interface, a key of ``COST_MODELS``
+    geometry : SeriesGeometry
+        geometry of the data the interface runs on
+    omp_nthreads : int
+        maximum number of threads per process
+    mask_fraction : float
+        fraction of the voxels inside the brain mask
+    time_series : bool
+        a volume-wise interface runs on the whole series at once
+    calibration : dict or None
+        scale factors per interface, read from ``QSIPREP_RESOURCE_CALIBRATION``
+        by default
+
+    Returns
+    -------
+    mem_gb : float
+    n_procs : int
+    """
+    model = COST_MODELS[interface_name]
+    if calibration is None:
+        calibration = load_calibration()
+    coefficients = np.array(model[:4])
+    mem_gb = coefficients.dot(_model_sizes(geometry, mask_fraction, time_series))
+    mem_gb *= calibration.get(interface_name, 1.)
+    if model.threads is None:
+        n_procs = omp_nthreads
+    else:
+        n_procs = max(1, min(omp_nthreads, model.threads))
+    return float(mem_gb), int(n_procs)
+
+
+def _is_time_series(interface):
+    return getattr(interface.inputs, 'input_image_type', None) == 3
+
+
+def set_node_resources(workflow, dwi_files, omp_nthreads=1, mask_file=None,
+                       output_resolution=None):
+    """Attach ``mem_gb`` and ``n_procs`` estimates to the heavy nodes of a workflow.
+
+    Nodes (in nested workflows too) whose interface has a cost model get their
+    memory estimate from the headers of ``dwi_files``. Multithreaded
+    interfaces get ``omp_nthreads`` threads, which also sets their
+    ``num_threads`` input. Other nodes are left untouched.
+
+    Parameters
+    ----------
+    workflow : nipype Workflow
+    dwi_files : str or list of str
+        the DWI series processed by the workflow
+    omp_nthreads : int
+        maximum number of threads per process
+    mask_file : str or None
+        brain mask on the grid of the processed series, if it already exists.
+        Otherwise ``BRAIN_FRACTION`` of the voxels are assumed to be in the
+        brain
+    output_resolution : float or None
+        voxel size the series is resampled to, if it differs from the input
+    """
+    geometry = series_geometry(dwi_files)
+    if geometry is None:
+        # For docs building
+        return
+    if output_resolution is not None:
+        geometry = resample_geometry(geometry, output_resolution)
+    calibration = load_calibration()
+    brain_fraction = mask_fraction(mask_file)
+
+    for node_name in workflow.list_node_names():
+        node = workflow.get_node(node_name)
+        interface_name = node.interface.__class__.__name__
+        if interface_name not in COST_MODELS:
+            continue
+        mem_gb, n_procs = estimate_resources(
+            interface_name, geometry, omp_nthreads=omp_nthreads, mask_fraction=brain_fraction,
+            time_series=_is_time_series(node.interface), calibration=calibration)
+        node._mem_gb = mem_gb
+        if COST_MODELS[interface_name].threads != 0:
+            node.n_procs = n_procs
+        LOGGER.debug('%s (%s): %.2f GB, %d threads', node_name, interface_name,
+                     node.mem_gb, node.n_procs)
+
+
+def calibrate_cost_models(resource_monitor_json, dwi_files, out_file=None, mask_file=None,
+                          margin=1.1):
+    """Calibrate the cost models from nipype's resource monitor.
+
+    The peak resident memory of every node (and mapnode iteration) is
+    compared with the estimate for the same interface. The scale factor of an
+    interface is the largest ratio found, times ``margin``.
+
+    Parameters
+    ----------
+    resource_monitor_json : str or list of str
+        ``resource_monitor.json`` files written with ``--resource-monitor``
+    dwi_files : str or list of str
+        the DWI series that were processed in those runs
+    out_file : str or None
+        where to write the scale factors. Point ``QSIPREP_RESOURCE_CALIBRATION``
+        to this file to use them.
+    mask_file : str or None
+        brain mask of the processed series, if available
+    margin : float
+        safety factor applied to the measured peaks
+
+    Returns
+    -------
+    calibration : dict
+        scale factor per interface
+    """
+    if isinstance(resource_monitor_json, str):
+        resource_monitor_json = [resource_monitor_json]
+    geometry = series_geometry(dwi_files)
+    if geometry is None:
+        raise ValueError('Unable to read the headers of %s' % dwi_files)
+
+    brain_fraction = mask_fraction(mask_file)
+
+    peaks = defaultdict(float)
+    interfaces = {}
+    for monitor_file in resource_monitor_json:
+        with open(monitor_file) as monitor_json:
+            monitor = json.load(monitor_json)
+        for name, mapnode, interface, rss in zip(monitor['name'], monitor['mapnode'],
+                                                 monitor['interface'], monitor['rss_GiB']):
+            if interface not in COST_MODELS or rss is None:
+                continue
+            key = (name, mapnode)
+            peaks[key] = max(peaks[key], rss)
+            interfaces[key] = interface
+
+    ratios = defaultdict(list)
+    for key, peak in peaks.items():
+        interface = interfaces[key]
+        estimate, _ = estimate_resources(interface, geometry, mask_fraction=brain_fraction,
+                                         calibration={})
+        ratios[interface].append(peak / estimate)
+
+    calibration = {interface: float(np.clip(max(values) * margin, 0.25, 4.))
+                   for interface, values in ratios.items()}
+    if out_file is not None:
+        with open(out_file, 'w') as calibration_json:
+            json.dump(calibration, calibration_json, indent=2, sort_keys=True)
+    return calibration
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Memory-mapped DWI series
+^^^^^^^^^^^^^^^^^^^^^^^^
+
+A DWI series stored as a single uncompressed 4D NIfTI file with ``.bval`` and
+``.bvec`` files next to it. The data are memory-mapped, so a volume is a view
+into the file and reading a few volumes does not load the series.
+``MultiVolumeResample`` and the SHORELine loaders accept the path of a series
+in place of a list of single-volume files. The single-volume files and
+one-line gradient files used by the older interfaces are written from the
+series only when they are asked for.
+
+
+"""
+import os
+import os.path as op
+import numpy as np
+import nibabel as nb
+from dipy.io import read_bvals_bvecs
+from .nifti import concat_niftis, iter_volumes, num_volumes
+
+
+def series_sidecars(series_file):
+    """Paths of the bval and bvec files of a series."""
+    stem = series_file[:-len('.nii')]
+    return stem + '.bval', stem + '.bvec'
+
+
+def is_series(image_files):
+    """Whether ``image_files`` is a series handle rather than a list of 3D volumes."""
+    if isinstance(image_files, str):
+        return True
+    return len(image_files) == 1 and len(nb.load(image_files[0]).shape) == 4
+
+
+class DWISeries(object):
+    """A 4D DWI series, memory-mapped, with its gradient table.
+
+    Parameters
+    ----------
+    series_file : str
+        uncompressed 4D NIfTI. The gradients are read from the ``.bval`` and
+        ``.bvec`` files with the same name, if they exist.
+    b0_threshold : float
+        maximum b-value of a b=0 volume
+    """
+
+    def __init__(self, series_file, b0_threshold=50):
+        self.series_file = series_file
+        self.b0_threshold = b0_threshold
+        self._img = None
+        self._data = None
+        self._gradients = None
+
+    @classmethod
+    def create(cls, out_file, dwi_files, bval_file=None, bvec_file=None, b0_threshold=50):
+        """Write a series from 3D or 4D images, one volume at a time.
+
+        Parameters
+        ----------
+        out_file : str
+            output ``.nii`` file. Compressed files cannot be memory-mapped.
+        dwi_files : str or list of str
+            images to concatenate
+        bval_file, bvec_file : str or None
+            FSL-style gradient files of the whole series
+        b0_threshold : float
+            maximum b-value of a b=0 volume
+
+        Returns
+        -------
+        series : DWISeries
+        """
+        if not out_file.endswith('.nii'):
+            raise ValueError('A series must be an uncompressed .nii file, got %s' % out_file)
+        if isinstance(dwi_files, str):
+            dwi_files = [dwi_files]
+        concat_niftis(dwi_files, out_file, header_source=dwi_files[0])
+        if bval_file is not None and bvec_file is not None:
+            bvals, bvecs = read_bvals_bvecs(bval_file, bvec_file)
+            out_bval, out_bvec = series_sidecars(out_file)
+            np.savetxt(out_bval, bvals[np.newaxis], fmt='%.6g')
+            np.savetxt(out_bvec, bvecs.T, fmt='%.8f')
+        return cls(out_file, b0_threshold=b0_threshold)
+
+    @property
+    def img(self):
+        if self._img is None:
+            self._img = nb.load(self.series_file, mmap=True)
+        return self._img
+
+    @property
+    def shape(self):
+        return self.img.shape
+
+    @property
+    def affine(self):
+        return self.img.affine
+
+    def __len__(self):
+        return self.shape[3]
+
+    @property
+    def data(self):
+        """The 4D data, a memory map unless the file has scaling factors."""
+        if self._data is None:
+            self._data = np.asanyarray(self.img.dataobj)
+        return self._data
+
+    def volume(self, index):
+        """A view of one volume."""
+        return self.data[..., index]
+
+    def volumes(self, indices=None, mask=None, dtype=np.float32):
+        """Load some volumes, or their in-mask voxels, as a single array.
+
+        Returns
+        -------
+        data : array
+            (X, Y, Z, volumes) or, with a mask, (voxels, volumes)
+        """
+        if indices is None:
+            indices = np.arange(len(self))
+        data = self.data
+        if mask is not None:
+            return np.column_stack([data[..., index][mask] for index in indices]).astype(dtype)
+        return np.stack([data[..., index] for index in indices], -1).astype(dtype)
+
+    @property
+    def gradients(self):
+        if self._gradients is None:
+            bval_file, bvec_file = series_sidecars(self.series_file)
+            if not (op.exists(bval_file) and op.exists(bvec_file)):
+                raise ValueError('No gradients found for %s' % self.series_file)
+            self._gradients = read_bvals_bvecs(bval_file, bvec_file)
+        return self._gradients
+
+    @property
+    def bvals(self):
+        return self.gradients[0]
+
+    @property
+    def bvecs(self):
+        """(volumes, 3) gradient directions."""
+        return self.gradients[1]
+
+    @property
+    def b0_indices(self):
+        return np.flatnonzero(self.bvals < self.b0_threshold)
+
+    def volume_file(self, index, out_dir):
+        """Path of a single-volume file, written on the first request."""
+        out_file = op.join(out_dir, 'vol%04d.nii.gz' % index)
+        if not op.exists(out_file):
+            _write_volume(self.img, self.volume(index), out_file)
+        return out_file
+
+    def volume_files(self, out_dir, indices=None):
+        """Paths of single-volume files, written when they do not exist yet."""
+        if indices is None:
+            indices = range(len(self))
+        os.makedirs(out_dir, exist_ok=True)
+        return [self.volume_file(index, out_dir) for index in indices]
+
+    def gradient_files(self, out_dir, prefix='dwi'):
+        """One-line bval and bvec files for each volume."""
+        bval_files = []
+        bvec_files = []
+        for index, (bval, bvec) in enumerate(zip(self.bvals, self.bvecs)):
+            bval_file = op.join(out_dir, '%s_%04d.bval' % (prefix, index))
+            bvec_file = op.join(out_dir, '%s_%04d.bvec' % (prefix, index))
+            if not op.exists(bval_file):
+                np.savetxt(bval_file, [bval])
+            if not op.exists(bvec_file):
+                np.savetxt(bvec_file, bvec)
+            bval_files.append(bval_file)
+            bvec_files.append(bvec_file)
+        return bval_files, bvec_files
+
+
+def _write_volume(img, volume, out_file):
+    out_hdr = img.header.copy()
+    out_hdr.set_data_shape(img.shape[:3])
+    nb.Nifti1Image(np.asarray(volume), img.affine, out_hdr).to_filename(out_file)
+
+
+def split_volumes(in_file, out_dir):
+    """Write each volume of a 4D image to ``vol%04d.nii.gz``, like ``fslsplit``.
+
+    The image is read once, and memory-mapped when it is uncompressed.
+
+    Returns
+    -------
+    out_files : list of str
+    """
+    img = nb.load(in_file, mmap=True)
+    data = np.asanyarray(img.dataobj)
+    if data.ndim == 3:
+        data = data[..., np.newaxis]
+    out_files = []
+    for index in range(data.shape[3]):
+        out_files.append(op.join(out_dir, 'vol%04d.nii.gz' % index))
+        _write_volume(img, data[..., index], out_files[-1])
+    return out_files
+
+
+def iter_image_volumes(image_files):
+    """Yield the volumes of 3D volumes and 4D series, one at a time."""
+    if isinstance(image_files, str):
+        image_files = [image_files]
+    for image_file in image_files:
+        for volume in iter_volumes(nb.load(image_file, mmap=True)):
+            yield volume
+
+
+def load_volumes(image_files, mask=None, dtype=np.float32):
+    """Load 3D volumes and 4D series into one array, one volume at a time.
+
+    Parameters
+    ----------
+    image_files : str or list of str
+        a 4D series, or a list of 3D volumes and 4D series, on the same grid
+    mask : boolean array or None
+        only load the voxels in the mask
+    dtype : numpy dtype
+
+    Returns
+    -------
+    data : array
+        (X, Y, Z, volumes) or, with a mask, (voxels, volumes)
+    """
+    if isinstance(image_files, str):
+        image_files = [image_files]
+    imgs = [nb.load(image_file, mmap=True) for image_file in image_files]
+    total_volumes = sum(num_volumes(img) for img in imgs)
+    if mask is None:
+        output_matrix = np.zeros(tuple(imgs[0].shape[:3]) + (total_volumes,), dtype=dtype)
+    else:
+        output_matrix = np.zeros((mask.sum(), total_volumes), dtype=dtype)
+    for volume_num, volume in enumerate(iter_image_volumes(image_files)):
+        output_matrix[..., volume_num] = volume if mask is None else volume[mask]
+    return output_matrix
@@ -351,6 +351,55 @@ def real_sym_sh_mrtrix(sh_order, theta, phi):
     return real_sh, m, n
 
 
+def real_sym_sh_mrtrix3(sh_order, theta, phi):
+    """
+    Compute real spherical harmonics as in MRtrix3, where the real harmonic
+    $Y^m_n$ is defined to be::
+
+        Real($Y^m_n$) * sqrt(2)         if m > 0
+        $Y^0_n$                         if m = 0
+        Imag($Y^|m|_n$) * sqrt(2)       if m < 0
+
+    This is the orthonormal basis of the ``.mif`` files written by
+    ``amp2sh`` and ``dwi2fod``, unlike ``real_sym_sh_mrtrix``.
+
+    Parameters
+    -----------
+    sh_order : int
+        The maximum degree or the spherical harmonic basis.
+    theta : float [0, pi]
+        The polar (colatitudinal) coordinate.
+    phi : float [0, 2*pi]
+        The azimuthal (longitudinal) coordinate.
+
+    Returns
+    --------
+    y_mn : real float
+        The real harmonic $Y^m_n$ sampled at `theta` and `phi`.
+    m : array
+        The order of the harmonics.
+    n : array
+        The degree of the harmonics.
+
+    """
+    m, n = sph_harm_ind_list(sh_order)
+    phi = np.reshape(phi, [-1, 1])
+    theta = np.reshape(theta, [-1, 1])
+
+    m = -m
+    real_sh = real_sph_harm(m, n, theta, phi)
+    return real_sh, -m, n
+
+
+def max_order_for_directions(num_directions, max_order=8):
+    """Largest even SH order that ``num_directions`` samples can fit, as in ``amp2sh``."""
+    sh_order = 0
+    while sh_order + 2 <= max_order and \
+            (sh_order + 3) * (sh_order + 4) // 2 <= num_directions:
+        sh_order += 2
+    return sh_order
+
+
 def real_sym_sh_basis(sh_order, theta, phi):
     """Samples a real symmetric spherical harmonic basis at point on the sphere
 
@@ -399,6 +448,7 @@ def real_sym_sh_basis(sh_order, theta, phi):
 
 sph_harm_lookup = {None: real_sym_sh_basis,
                    "mrtrix": real_sym_sh_mrtrix,
+                   "mrtrix3": real_sym_sh_mrtrix3,
                    "fibernav": real_sym_sh_basis,
                    "brainsuite": real_sym_sh_brainsuite}
 
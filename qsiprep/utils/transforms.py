@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Affine transform algebra
+^^^^^^^^^^^^^^^^^^^^^^^^
+
+Read and write ITK affines, convert them between the ITK (LPS), RAS and FSL
+conventions, compose them and decompose them into scales, shears, rotations
+and translations. All functions accept stacks of 4x4 matrices, so a whole
+series is handled in one call. Chains of affines and displacement fields can
+also be applied to points or composed into a single displacement field.
+
+
+"""
+import numpy as np
+import nibabel as nb
+
+# Converts LPS coordinates to RAS and back
+LPS_TO_RAS = np.diag([-1., -1., 1., 1.])
+
+
+def read_itk_affine(transform_file):
+    """Read an ITK linear transform (``.mat`` or ``.txt``) as a 4x4 matrix.
+
+    Like the ITK transform itself, the matrix maps points from the fixed
+    (output) space to the moving (input) space, in LPS physical coordinates.
+    """
+    if transform_file.endswith(".mat"):
+        from scipy.io import loadmat
+        contents = loadmat(transform_file)
+        transform_types = [key for key in contents if not key.startswith("__") and
+                           key != "fixed"]
+        if len(transform_types) != 1:
+            raise ValueError("Expected one transform in %s" % transform_file)
+        transform_type = transform_types[0]
+        parameters = contents[transform_type].ravel()
+        fixed_parameters = contents["fixed"].ravel()
+    else:
+        transform_types = []
+        with open(transform_file, "r") as tfm:
+            for line in tfm:
+                if line.startswith("Transform:"):
+                    transform_types.append(line.split(":", 1)[1].strip())
+                elif line.startswith("Parameters:"):
+                    parameters = np.array(line.split(":", 1)[1].split(), dtype=float)
+                elif line.startswith("FixedParameters:"):
+                    fixed_parameters = np.array(line.split(":", 1)[1].split(), dtype=float)
+        if len(transform_types) != 1:
+            raise ValueError("Expected one transform in %s" % transform_file)
+        transform_type = transform_types[0]
+
+    if not transform_type.startswith(("AffineTransform", "MatrixOffsetTransformBase")) or \
+            not transform_type.endswith("_3_3"):
+        raise ValueError("Unsupported transform type %s in %s" % (
+            transform_type, transform_file))
+    matrix = np.asarray(parameters[:9], dtype=float).reshape(3, 3)
+    translation = np.asarray(parameters[9:12], dtype=float)
+    center = np.asarray(fixed_parameters[:3], dtype=float)
+
+    affine = np.eye(4)
+    affine[:3, :3] = matrix
+    affine[:3, 3] = translation + center - matrix.dot(center)
+    return affine
+
+
+def write_itk_affine(affine, out_file):
+    """Write a 4x4 LPS matrix as an ITK ``AffineTransform_double_3_3``.
+
+    ``.mat`` files are written in the MATLAB v4 format used by ANTs, anything
+    else as an ITK text transform.
+    """
+    parameters = np.concatenate([affine[:3, :3].ravel(), affine[:3, 3]])
+    if out_file.endswith(".mat"):
+        from scipy.io import savemat
+        savemat(out_file, {"AffineTransform_double_3_3": parameters[:, np.newaxis],
+                           "fixed": np.zeros((3, 1))}, format="4")
+    else:
+        with open(out_file, "w") as tfm:
+            tfm.write("#Insight Transform File V1.0\n#Transform 0\n"
+                      "Transform: AffineTransform_double_3_3\n")
+            tfm.write("Parameters: %s\n" % " ".join(["%.17g" % val for val in parameters]))
+            tfm.write("FixedParameters: 0 0 0\n")
+    return out_file
+
+
+def itk_to_ras(itk_affines):
+    """Convert ITK (fixed to moving, LPS) matrices to RAS, keeping their direction."""
+    return np.matmul(LPS_TO_RAS, np.matmul(itk_affines, LPS_TO_RAS))
+
+
+def ras_to_itk(ras_affines):
+    """Convert RAS matrices to the LPS convention of ITK."""
+    return itk_to_ras(ras_affines)
+
+
+def compose_affines(affines):
+    """Compose point transforms listed in ANTs order.
+
+    ``antsApplyTransforms -t A -t B`` maps an output point ``x`` to ``B(A(x))``
+    in the input image (the image itself is moved by B first), so the
+    composed matrix is ``B.dot(A)``. ``affines`` is a list of 4x4 matrices or
+    of stacks of them (one per volume), which are broadcast against each
+    other. An empty list composes to the identity.
+    """
+    if not len(affines):
+        return np.eye(4)
+    composed = np.asarray(affines[0], dtype=float)
+    for affine in affines[1:]:
+        composed = np.matmul(affine, composed)
+    return composed
+
+
+def is_itk_affine(transform_file):
+    """Whether a transform file is a linear ITK transform that can be read natively."""
+    return transform_file.endswith((".mat", ".txt", ".tfm"))
+
+
+def apply_affine(affine, points):
+    """Apply a 4x4 matrix to (3, n_points) coordinates"""
+    return affine[:3, :3].dot(points) + affine[:3, 3:]
+
+
+def map_points(points, transforms):
+    """Map LPS points through ITK affines and displacement fields in ANTs order.
+
+    Consecutive affines are composed before being applied.
+    """
+    from scipy.ndimage import map_coordinates
+
+    pending = []
+    for transform in transforms + [None]:
+        if transform is not None and is_itk_affine(transform):
+            pending.append(read_itk_affine(transform))
+            continue
+        if pending:
+            points = apply_affine(compose_affines(pending), points)
+            pending = []
+        if transform is None:
+            break
+        warp_img = nb.load(transform)
+        displacements = np.asanyarray(warp_img.dataobj, dtype=np.float32).reshape(
+            warp_img.shape[:3] + (3,))
+        ijk = apply_affine(np.linalg.inv(LPS_TO_RAS.dot(warp_img.affine)), points)
+        points = points + np.stack([
+            map_coordinates(displacements[..., axis], ijk, order=1, mode='constant', cval=0.)
+            for axis in range(3)])
+    return points
+
+
+def compose_displacement_field(transforms, reference_image, out_file):
+    """Compose ITK affines and displacement fields into one displacement field.
+
+    The field is sampled on the grid of ``reference_image`` and written as an
+    ITK vector image (LPS displacements, float32), like the composite warp of
+    ``antsApplyTransforms --print-out-composite-warp-file``. The header,
+    including the qform and sform codes, is copied from ``reference_image``.
+    """
+    ref_img = nb.load(reference_image)
+    ref_shape = ref_img.shape[:3]
+    ref_ijk = np.indices(ref_shape, dtype=np.float32).reshape(3, -1)
+    points = apply_affine(LPS_TO_RAS.dot(ref_img.affine), ref_ijk)
+    displacements = map_points(points, list(transforms)) - points
+
+    out_hdr = ref_img.header.copy()
+    out_hdr.set_data_shape(ref_shape + (1, 3))
+    out_hdr.set_zooms(ref_img.header.get_zooms()[:3] + (1., 1.))
+    out_hdr.set_data_dtype(np.float32)
+    out_hdr.set_slope_inter(np.nan, np.nan)
+    out_hdr.set_intent('vector')
+    out_img = nb.Nifti1Image(
+        displacements.T.reshape(ref_shape + (1, 3)).astype(np.float32),
+        ref_img.affine, out_hdr)
+    out_img.to_filename(out_file)
+    return out_file
+
+
+def fsl_scaled_mm(img):
+    """Matrix from voxel indices to the FSL "scaled mm" coordinates of ``img``.
+
+    FSL flips the first axis of images with a positive voxel-to-RAS
+    determinant (neurological orientation).
+    """
+    zooms = np.array(img.header.get_zooms()[:3], dtype=float)
+    scaled = np.diag(np.concatenate([zooms, [1.]]))
+    if np.linalg.det(img.affine[:3, :3]) > 0:
+        scaled[0, 0] = -zooms[0]
+        scaled[0, 3] = zooms[0] * (img.shape[0] - 1)
+    return scaled
+
+
+def itk_to_fsl(itk_affines, src_img, ref_img):
+    """Convert ITK matrices to FSL matrices mapping ``src_img`` to ``ref_img``.
+
+    This is the conversion done by ``c3d_affine_tool -ref ref -src src -itk
+    file -ras2fsl``: the ITK matrix maps fixed (reference) points to moving
+    (source) points, so its RAS version is inverted before being expressed
+    in the scaled mm coordinates of both images.
+    """
+    src_to_ref = np.linalg.inv(itk_to_ras(itk_affines))
+    ref_world_to_fsl = fsl_scaled_mm(ref_img).dot(np.linalg.inv(ref_img.affine))
+    src_fsl_to_world = src_img.affine.dot(np.linalg.inv(fsl_scaled_mm(src_img)))
+    return np.matmul(ref_world_to_fsl, np.matmul(src_to_ref, src_fsl_to_world))
+
+
+def fsl_center_of_gravity(img):
+    """Intensity centre of gravity of an image in FSL scaled mm coordinates."""
+    data = np.asanyarray(img.dataobj, dtype=float)
+    if data.ndim > 3:
+        data = data.reshape(data.shape[:3] + (-1,))[..., 0]
+    weights = data - data.min()
+    total = weights.sum()
+    if abs(total) < 1e-5:
+        total = 1.
+    voxel_cog = [np.sum(weights.sum(axis=tuple(other for other in range(3) if other != axis))
+                        * np.arange(data.shape[axis])) / total for axis in range(3)]
+    return fsl_scaled_mm(img).dot(np.concatenate([voxel_cog, [1.]]))[:3]
+
+
+def decompose_affines(affines, center=None):
+    """Decompose matrices into scales, shears, rotations and translations.
+
+    This follows FSL's ``avscale``: ``matrix = rotation * shear * scale``, the
+    rotation is expressed as x, y, z Euler angles in radians and the
+    translation is that of ``center`` (the origin by default).
+
+    Returns
+    -------
+    params : ndarray, shape (..., 12)
+        scaleX, scaleY, scaleZ, shearXY, shearXZ, shearYZ, rotateX, rotateY,
+        rotateZ, shiftX, shiftY, shiftZ
+    """
+    affines = np.asarray(affines, dtype=float)
+    if center is None:
+        center = np.zeros(3)
+    x = affines[..., :3, 0]
+    y = affines[..., :3, 1]
+    z = affines[..., :3, 2]
+
+    def dot(vec1, vec2):
+        return np.sum(vec1 * vec2, axis=-1)
+
+    scale_x = np.sqrt(dot(x, x))
+    scale_y = np.sqrt(dot(y, y) - dot(x, y) ** 2 / scale_x ** 2)
+    shear_xy = dot(x, y) / (scale_x * scale_y)
+    x0 = x / scale_x[..., np.newaxis]
+    y0 = y / scale_y[..., np.newaxis] - shear_xy[..., np.newaxis] * x0
+    scale_z = np.sqrt(dot(z, z) - dot(x0, z) ** 2 - dot(y0, z) ** 2)
+    shear_xz = dot(x0, z) / (scale_x * scale_z)
+    shear_yz = dot(y0, z) / (scale_y * scale_z)
+
+    shear = np.zeros(affines.shape[:-2] + (3, 3))
+    shear[..., [0, 1, 2], [0, 1, 2]] = 1
+    shear[..., 0, 1] = shear_xy
+    shear[..., 0, 2] = shear_xz
+    shear[..., 1, 2] = shear_yz
+    scales = np.stack([scale_x, scale_y, scale_z], -1)
+    rotation = np.matmul(affines[..., :3, :3] / scales[..., np.newaxis, :],
+                         np.linalg.inv(shear))
+
+    cos_y = np.sqrt(rotation[..., 0, 0] ** 2 + rotation[..., 0, 1] ** 2)
+    gimbal_lock = cos_y < 1e-4
+    safe_cos_y = np.where(gimbal_lock, 1., cos_y)
+    rotate_x = np.where(gimbal_lock,
+                        np.arctan2(-rotation[..., 2, 1], rotation[..., 1, 1]),
+                        np.arctan2(rotation[..., 1, 2] / safe_cos_y,
+                                   rotation[..., 2, 2] / safe_cos_y))
+    rotate_y = np.arctan2(-rotation[..., 0, 2], np.where(gimbal_lock, 0., cos_y))
+    rotate_z = np.where(gimbal_lock, 0.,
+                        np.arctan2(rotation[..., 0, 1] / safe_cos_y,
+                                   rotation[..., 0, 0] / safe_cos_y))
+
+    translation = np.einsum('...ij,...j->...i', affines[..., :3, :3], center) + \
+        affines[..., :3, 3] - center
+
+    return np.concatenate([scales, np.stack([shear_xy, shear_xz, shear_yz], -1),
+                           np.stack([rotate_x, rotate_y, rotate_z], -1), translation], -1)
+
+
+def fsl_motion_params(itk_files, src_files, ref_file):
+    """Motion parameters of ITK head motion affines, as ``avscale`` reports them.
+
+    Each ITK affine is converted to an FSL matrix between its source image
+    and ``ref_file`` and decomposed around the centre of gravity of the
+    source. Rotations and translations are flipped to the LPS convention.
+
+    Returns
+    -------
+    params : ndarray, shape (n_files, 12)
+        see :func:`decompose_affines`
+    """
+    ref_img = nb.load(ref_file)
+    fsl_affines = []
+    centers = []
+    for itk_file, src_file in zip(itk_files, src_files):
+        src_img = nb.load(src_file)
+        fsl_affines.append(itk_to_fsl(read_itk_affine(itk_file), src_img, ref_img))
+        centers.append(fsl_center_of_gravity(src_img))
+    params = decompose_affines(np.array(fsl_affines), np.array(centers))
+    params[:, 6:] *= np.tile([1, -1, -1], 2)
+    return params
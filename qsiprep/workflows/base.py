@@ -47,7 +47,8 @@ def init_qsiprep_wf(subject_list, run_uuid, work_dir, output_dir, bids_dir,
                     impute_slice_threshold, hmc_transform, shoreline_iters, eddy_config,
                     write_local_bvecs, output_spaces, template, motion_corr_to,
                     b0_to_t1w_transform, intramodal_template_iters, intramodal_template_transform,
-                    prefer_dedicated_fmaps, fmap_bspline, fmap_demean, use_syn, force_syn):
+                    prefer_dedicated_fmaps, fmap_bspline, fmap_demean, use_syn, force_syn,
+                    shoreline_tolerance=None, shoreline_use_ants=False):
     """
     This workflow organizes the execution of qsiprep, with a sub-workflow for
     each subject.
@@ -232,6 +233,8 @@ def init_qsiprep_wf(subject_list, run_uuid, work_dir, output_dir, bids_dir,
             hmc_model=hmc_model,
             hmc_transform=hmc_transform,
             shoreline_iters=shoreline_iters,
+            shoreline_tolerance=shoreline_tolerance,
+            shoreline_use_ants=shoreline_use_ants,
             eddy_config=eddy_config,
             impute_slice_threshold=impute_slice_threshold,
             write_local_bvecs=write_local_bvecs,
@@ -261,7 +264,7 @@ def init_single_subject_wf(
         template, output_resolution, prefer_dedicated_fmaps, motion_corr_to, b0_to_t1w_transform,
         intramodal_template_iters, intramodal_template_transform, hmc_model, hmc_transform,
         shoreline_iters, eddy_config, impute_slice_threshold, fmap_bspline, fmap_demean, use_syn,
-        force_syn):
+        force_syn, shoreline_tolerance=None, shoreline_use_ants=False):
     """
     This workflow organizes the preprocessing pipeline for a single subject.
     It collects and reports information about the subject, and prepares
@@ -609,6 +612,8 @@ to workflows in *qsiprep*'s documentation]\
             hmc_model=hmc_model,
             hmc_transform=hmc_transform,
             shoreline_iters=shoreline_iters,
+            shoreline_tolerance=shoreline_tolerance,
+            shoreline_use_ants=shoreline_use_ants,
             eddy_config=eddy_config,
             impute_slice_threshold=impute_slice_threshold,
             reportlets_dir=reportlets_dir,
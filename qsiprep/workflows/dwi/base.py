@@ -18,6 +18,7 @@ from ...interfaces import DerivativesDataSink
 from ...interfaces.reports import DiffusionSummary
 from ...interfaces.confounds import DMRISummary
 from ...engine import Workflow
+from ...utils.resources import set_node_resources
 
 # dwi workflows
 from ..fieldmap.unwarp import init_fmap_unwarp_report_wf
@@ -56,6 +57,8 @@ def init_dwi_preproc_wf(scan_groups,
                         force_syn,
                         low_mem,
                         sloppy,
+                        shoreline_tolerance=None,
+                        shoreline_use_ants=False,
                         layout=None):
     """
     This workflow controls the dwi preprocessing stages of qsiprep.
@@ -317,6 +320,8 @@ def init_dwi_preproc_wf(scan_groups,
             hmc_align_to=motion_corr_to,
             template=template,
             shoreline_iters=shoreline_iters,
+            shoreline_tolerance=shoreline_tolerance,
+            shoreline_use_ants=shoreline_use_ants,
             impute_slice_threshold=impute_slice_threshold,
             omp_nthreads=omp_nthreads,
             fmap_bspline=fmap_bspline,
@@ -466,6 +471,9 @@ def init_dwi_preproc_wf(scan_groups,
         (summary, ds_report_summary, [('out_report', 'in_file')])
     ])
 
+    # Estimate the memory and threads of the heavy nodes from the image headers
+    set_node_resources(workflow, all_dwis, omp_nthreads=omp_nthreads)
+
     # Fill-in datasinks of reportlets seen so far
     for node in workflow.list_node_names():
         if node.split('.')[-1].startswith('ds_report'):
@@ -18,6 +18,7 @@ from ...niworkflows.interfaces.registration import SimpleBeforeAfterRPT
 from ...interfaces.reports import GradientPlot
 from ...interfaces.mrtrix import MRTrixGradientTable
 from ...engine import Workflow
+from ...utils.resources import set_node_resources
 
 # dwi workflows
 from .util import _create_mem_gb
@@ -382,6 +383,10 @@ def init_dwi_finalize_wf(scan_groups,
         if "T1w" not in output_spaces:
             workflow.connect([(outputnode, gradient_plot, [('bvecs_mni', 'final_bvec_file')])])
 
+    # Estimate the memory and threads of the heavy nodes from the image headers
+    set_node_resources(workflow, all_dwis, omp_nthreads=omp_nthreads,
+                       output_resolution=output_resolution)
+
     # Fill-in datasinks of reportlets seen so far
     for node in workflow.list_node_names():
         if node.split('.')[-1].startswith('ds_report'):
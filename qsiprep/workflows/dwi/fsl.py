@@ -112,7 +112,8 @@ def init_fsl_hmc_wf(scan_groups,
         eddy_args = json.load(f)
 
     # These should be in LAS+
-    dwi_merge = pe.Node(MergeDWIs(), name="dwi_merge")
+    dwi_merge = pe.Node(MergeDWIs(num_threads=omp_nthreads), name="dwi_merge",
+                        n_procs=omp_nthreads)
     eddy = pe.Node(ExtendedEddy(**eddy_args), name="eddy")
     spm_motion = pe.Node(Eddy2SPMMotion(), name="spm_motion")
     # Convert eddy outputs back to LPS+, split them
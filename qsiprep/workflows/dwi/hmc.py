@@ -10,9 +10,9 @@ import nipype.pipeline.engine as pe
 from pkg_resources import resource_filename as pkgrf
 from nipype.interfaces import ants, afni, utility as niu
 from ...engine import Workflow
-from ...interfaces.gradients import MatchTransforms, GradientRotation, CombineMotions
-from ...interfaces.shoreline import (SignalPrediction, ExtractDWIsForModel, ReorderOutputs,
-                                     B0Mean, SHORELineReport, IterationSummary, CalculateCNR)
+from ...interfaces.gradients import MatchTransforms, GradientRotation
+from ...interfaces.shoreline import (SHORELine, ExtractDWIsForModel, ReorderOutputs, B0Mean,
+                                     SHORELineReport, IterationSummary, CalculateCNR)
 from ...interfaces import DerivativesDataSink
 from .util import init_skullstrip_b0_wf
 
@@ -20,8 +20,8 @@ DEFAULT_MEMORY_MIN_GB = 0.01
 
 
 def init_dwi_hmc_wf(hmc_transform, hmc_model, hmc_align_to, source_file,
-                    num_model_iterations=2, mem_gb=3, omp_nthreads=1, sloppy=False,
-                    name="dwi_hmc_wf"):
+                    num_model_iterations=2, shoreline_tolerance=None, shoreline_use_ants=False,
+                    mem_gb=3, omp_nthreads=1, sloppy=False, name="dwi_hmc_wf"):
     """Perform head motion correction and susceptibility distortion correction.
 
     This workflow uses antsRegistration and an iteratively updated signal model to perform
@@ -45,6 +45,13 @@ def init_dwi_hmc_wf(hmc_transform, hmc_model, hmc_align_to, source_file,
         num_model_iterations: int
             If ``hmc_model`` is ``'3dSHORE'`` or ``'SH'`` determines the number of times the
             model is updated and motion corretion is estimated. Default: 2.
+        shoreline_tolerance: tuple or None
+            (translation in mm, rotation in degrees) changes between model iterations
+            below which the iterations stop before ``num_model_iterations``. Default: None,
+            run all the iterations.
+        shoreline_use_ants: bool
+            Register the volumes to their model predictions with antsRegistration instead
+            of in-process. Default: False.
 
     **Inputs**
 
@@ -119,8 +126,12 @@ def init_dwi_hmc_wf(hmc_transform, hmc_model, hmc_align_to, source_file,
         return workflow
 
     # Do model-based motion correction
+    translation_tolerance, rotation_tolerance = shoreline_tolerance or (0., 0.)
     dwi_model_hmc_wf = init_dwi_model_hmc_wf(hmc_model, hmc_transform, mem_gb, omp_nthreads,
-                                             num_iters=num_model_iterations)
+                                             num_iters=num_model_iterations,
+                                             translation_tolerance=translation_tolerance,
+                                             rotation_tolerance=rotation_tolerance,
+                                             use_ants=shoreline_use_ants)
 
     # Warp the modeled images into non-motion-corrected space
     uncorrect_model_images = pe.MapNode(
@@ -312,147 +323,9 @@ def first_image(image_list):
     return image_list[0]
 
 
-def _bvecs_to_list(bvec_file):
-    import numpy as np
-    bvec = np.loadtxt(bvec_file).T
-    return list(bvec)
-
-
-def _bvals_to_floats(bval_files):
-    import numpy as np
-    return [float(np.loadtxt(bval_file)) for bval_file in bval_files]
-
-
-def init_hmc_model_iteration_wf(modelname, transform, precision="coarse", name="hmc_model_iter0"):
-    """Create a model-based hmc registration iteration workflow.
-
-    This workflow takes an initial set of transforms, applies them to the
-    original data, and builds a signal model out of the transformed images.
-
-    The original images are then registered to the model-generated target
-    images. Included in the outputs are the transforms and optionally the
-    noise-free images in original (non-aligned) space.
-
-    .. workflow::
-        :graph2use: colored
-        :simple_form: yes
-
-        from qsiprep.workflows.dwi.hmc import init_dwi_model_hmc_wf
-        wf = init_dwi_model_hmc_wf(modelname='3dSHORE',
-                                   transform='Affine',
-                                   num_iters=2,
-                                   mem_gb=3,
-                                   omp_nthreads=1)
-
-    **Parameters**
-
-        modelname : str
-            one of the models for reconstructing an EAP and producing
-            signal estimates used for motion correction
-        transform : str
-            either "Rigid" or "Affine". Choosing "Affine" may help with Eddy warping
-        precision : str
-            Use fast "coarse" alignment or accurate "precise" registration
-        name : str
-            name of the workflow
-
-    **Inputs**
-
-        original_dwi_files
-            list of 3d dwi files, no b0's
-        bvals
-            list of bval files corresponding to `original_dwi_files`
-        approx_aligned_dwi_files
-            dwi files that have been registered through a shoreline iteration
-        approx_aligned_bvecs
-            list of bvec files corresponding to `approx_aligned_dwi_files`
-        b0_indices
-            list of which indices in `dwi_files` are b0 images
-        initial_transforms
-            list of transforms from a previous registration
-        b0_mask
-            mask of containing brain voxels
-        b0_mean
-            mean of the aligned b0 images
-
-    **Outputs**
-
-        hmc_transforms
-            list of transforms, one per file in `dwi_files`
-        rotated_bvecs
-            rotated bvec matrix
-    """
-
-    workflow = Workflow(name=name)
-    inputnode = pe.Node(
-        niu.IdentityInterface(
-            fields=['original_dwi_files', 'bvals', 'approx_aligned_dwi_files',
-                    'approx_aligned_bvecs', 'b0_mask', 'b0_mean', 'original_bvecs']),
-        name='inputnode')
-    outputnode = pe.Node(
-        niu.IdentityInterface(
-            fields=['hmc_transforms', 'aligned_dwis', 'aligned_bvecs', 'predicted_dwis',
-                    'motion_params']),
-        name='outputnode')
-
-    ants_settings = pkgrf(
-        "qsiprep",
-        "data/shoreline_{precision}_{transform}.json".format(precision=precision,
-                                                             transform=transform))
-
-    predict_dwis = pe.MapNode(SignalPrediction(model=modelname),
-                              iterfield=['bval_to_predict', 'bvec_to_predict'],
-                              name="predict_dwis")
-    predict_dwis.synchronize = True
-
-    # Register original images to the predicted images
-    register_to_predicted = pe.MapNode(ants.Registration(from_file=ants_settings),
-                                       iterfield=['fixed_image', 'moving_image'],
-                                       name='register_to_predicted')
-    register_to_predicted.synchronize = True
-
-    # Apply new transforms to bvecs
-    post_bvec_transforms = pe.Node(GradientRotation(), name="post_bvec_transforms")
-
-    # Summarize the motion
-    calculate_motion = pe.Node(CombineMotions(), name="calculate_motion")
-
-    workflow.connect([
-        # Send inputs to DWI prediction
-        (inputnode, predict_dwis, [('approx_aligned_dwi_files', 'aligned_dwis'),
-                                   ('approx_aligned_bvecs', 'aligned_bvecs'),
-                                   ('bvals', 'bvals'),
-                                   ('b0_mean', 'aligned_b0_mean'),
-                                   ('b0_mask', 'aligned_mask'),
-                                   (('approx_aligned_bvecs', _bvecs_to_list), 'bvec_to_predict'),
-                                   (('bvals', _bvals_to_floats), 'bval_to_predict')]),
-        (predict_dwis, register_to_predicted, [('predicted_image', 'fixed_image')]),
-        (inputnode, register_to_predicted, [
-            ('original_dwi_files', 'moving_image'),
-            ('b0_mask', 'fixed_image_masks')]),
-
-        (register_to_predicted, calculate_motion, [
-            (('forward_transforms', _list_squeeze), 'transform_files')]),
-        (inputnode, calculate_motion, [('original_dwi_files', 'source_files'),
-                                       ('b0_mean', 'ref_file')]),
-        (calculate_motion, outputnode, [('motion_file', 'motion_params')]),
-
-        (register_to_predicted, post_bvec_transforms, [
-            (('forward_transforms', _list_squeeze), 'affine_transforms')]),
-        (inputnode, post_bvec_transforms, [('original_bvecs', 'bvec_files'),
-                                           ('bvals', 'bval_files')]),
-
-        (predict_dwis, outputnode, [('predicted_image', 'predicted_dwis')]),
-        (post_bvec_transforms, outputnode, [('bvecs', 'aligned_bvecs')]),
-        (register_to_predicted, outputnode, [('warped_image', 'aligned_dwis'),
-                                             ('forward_transforms', 'hmc_transforms')])
-    ])
-
-    return workflow
-
-
 def init_dwi_model_hmc_wf(modelname, transform, mem_gb, omp_nthreads,
-                          num_iters=2, name='dwi_model_hmc_wf', metric="Mattes"):
+                          num_iters=2, translation_tolerance=0., rotation_tolerance=0.,
+                          use_ants=False, name='dwi_model_hmc_wf', metric="Mattes"):
     """Create a model-based hmc workflow.
 
     .. workflow::
@@ -474,7 +347,16 @@ def init_dwi_model_hmc_wf(modelname, transform, mem_gb, omp_nthreads,
         transform : str
             either "Rigid" or "Affine". Choosing "Affine" may help with Eddy warping
         num_iters : int
-            the number of times the model will be updated with transformed data
+            the maximum number of times the model will be updated with transformed data
+        translation_tolerance : float
+            stop iterating once no volume moved more than this (mm) since the previous
+            iteration. Both tolerances must be met. 0 always runs ``num_iters`` iterations.
+        rotation_tolerance : float
+            stop iterating once no volume rotated more than this (degrees) since the
+            previous iteration
+        use_ants : bool
+            register the volumes to their predictions with antsRegistration instead of
+            in-process
 
     **Inputs**
 
@@ -532,12 +414,13 @@ def init_dwi_model_hmc_wf(modelname, transform, mem_gb, omp_nthreads,
     # Create a mask and an average from the aligned b0 images
     b0_mean = pe.Node(B0Mean(), name='b0_mean')
 
-    # Start building and connecting the model iterations
-    initial_model_iteration = init_hmc_model_iteration_wf(
-        modelname, transform, precision="coarse", name="initial_model_iteration")
-
-    # Collect motion estimates across iterations
-    collect_motion_params = pe.Node(niu.Merge(num_iters), name="collect_motion_params")
+    # Iterate the model-based registration until the motion estimates stop changing
+    shoreline = pe.Node(
+        SHORELine(model=modelname, transform=transform, num_iterations=num_iters,
+                  translation_tolerance=translation_tolerance,
+                  rotation_tolerance=rotation_tolerance, use_ants=use_ants,
+                  num_threads=omp_nthreads),
+        name='shoreline', n_procs=omp_nthreads)
 
     workflow.connect([
         (inputnode, extract_dwis, [('dwi_files', 'dwi_files'),
@@ -552,53 +435,24 @@ def init_dwi_model_hmc_wf(modelname, transform, mem_gb, omp_nthreads,
         (extract_dwis, b0_based_image_transforms, [('model_dwi_files', 'input_image'),
                                                    ('transforms', 'transforms')]),
         (b0_mean, b0_based_image_transforms, [('average_image', 'reference_image')]),
-
-        # Connect the first iteration
-        (extract_dwis, initial_model_iteration, [
-            ('model_dwi_files', 'inputnode.original_dwi_files'),
-            ('model_bvecs', 'inputnode.original_bvecs'),
-            ('model_bvals', 'inputnode.bvals')]),
-        (b0_based_image_transforms, initial_model_iteration, [
-            ('output_image', 'inputnode.approx_aligned_dwi_files')]),
-        (b0_based_bvec_transforms, initial_model_iteration, [
-            ('bvecs', 'inputnode.approx_aligned_bvecs')]),
-        (b0_mean, initial_model_iteration, [
-            ('average_image', 'inputnode.b0_mean')]),
-        (inputnode, initial_model_iteration, [
-            ('warped_b0_mask', 'inputnode.b0_mask')]),
-        (initial_model_iteration, collect_motion_params, [
-            ('outputnode.motion_params', 'in1')])
+        (extract_dwis, shoreline, [
+            ('model_dwi_files', 'original_dwi_files'),
+            ('model_bvecs', 'original_bvecs'),
+            ('model_bvals', 'bvals')]),
+        (b0_based_image_transforms, shoreline, [
+            ('output_image', 'approx_aligned_dwi_files')]),
+        (b0_based_bvec_transforms, shoreline, [
+            ('bvecs', 'approx_aligned_bvecs')]),
+        (b0_mean, shoreline, [('average_image', 'b0_mean')]),
+        (inputnode, shoreline, [('warped_b0_mask', 'b0_mask')])
     ])
 
-    model_iterations = [initial_model_iteration]
-    for iteration_num in range(num_iters-1):
-        iteration_name = 'shoreline_iteration%03d' % (iteration_num + 1)
-        motion_key = 'in%d' % (iteration_num + 2)
-        model_iterations.append(
-            init_hmc_model_iteration_wf(modelname=modelname, transform=transform,
-                                        precision="precise", name=iteration_name)
-        )
-        workflow.connect([
-            (model_iterations[-2], model_iterations[-1], [
-                ('outputnode.aligned_dwis', 'inputnode.approx_aligned_dwi_files'),
-                ('outputnode.aligned_bvecs', 'inputnode.approx_aligned_bvecs')]),
-            (extract_dwis, model_iterations[-1], [
-                ('model_dwi_files', 'inputnode.original_dwi_files'),
-                ('model_bvals', 'inputnode.bvals'),
-                ('model_bvecs', 'inputnode.original_bvecs')]),
-            (b0_mean, model_iterations[-1], [
-                ('average_image', 'inputnode.b0_mean')]),
-            (inputnode, model_iterations[-1], [
-                ('warped_b0_mask', 'inputnode.b0_mask')]),
-            (model_iterations[-1], collect_motion_params, [
-                ('outputnode.motion_params', motion_key)])
-        ])
-
     # Return to the original, b0-interspersed ordering
     reorder_dwi_xforms = pe.Node(ReorderOutputs(), name='reorder_dwi_xforms')
 
     # Create a report:
-    shoreline_report = pe.Node(SHORELineReport(), name='shoreline_report')
+    shoreline_report = pe.Node(SHORELineReport(num_threads=omp_nthreads), name='shoreline_report',
+                               n_procs=omp_nthreads)
     ds_report_shoreline_gif = pe.Node(
         DerivativesDataSink(suffix="shoreline_animation"), name='ds_report_shoreline_gif',
         mem_gb=1, run_without_submitting=True)
@@ -611,8 +465,8 @@ def init_dwi_model_hmc_wf(modelname, transform, mem_gb, omp_nthreads,
             DerivativesDataSink(suffix="shoreline_iterdata"), name='ds_report_iteration_plot',
             mem_gb=0.1, run_without_submitting=True)
         workflow.connect([
-            (collect_motion_params, summarize_iterations, [
-                ('out', 'collected_motion_files')]),
+            (shoreline, summarize_iterations, [
+                ('motion_files', 'collected_motion_files')]),
             (summarize_iterations, ds_report_iteration_plot, [
                 ('plot_file', 'in_file')]),
             (summarize_iterations, outputnode, [
@@ -621,10 +475,10 @@ def init_dwi_model_hmc_wf(modelname, transform, mem_gb, omp_nthreads,
                 ('iteration_summary_file', 'iteration_summary')])])
 
     workflow.connect([
-        (model_iterations[-1], reorder_dwi_xforms, [
-            ('outputnode.hmc_transforms', 'model_based_transforms'),
-            ('outputnode.predicted_dwis', 'model_predicted_images'),
-            ('outputnode.aligned_dwis', 'warped_dwi_images')]),
+        (shoreline, reorder_dwi_xforms, [
+            ('hmc_transforms', 'model_based_transforms'),
+            ('predicted_dwis', 'model_predicted_images'),
+            ('aligned_dwis', 'warped_dwi_images')]),
         (b0_mean, reorder_dwi_xforms, [('average_image', 'b0_mean')]),
         (inputnode, reorder_dwi_xforms, [
             ('warped_b0_images', 'warped_b0_images'),
@@ -37,6 +37,8 @@ def init_qsiprep_hmcsdc_wf(scan_groups,
                            force_syn,
                            dwi_metadata=None,
                            sloppy=False,
+                           shoreline_tolerance=None,
+                           shoreline_use_ants=False,
                            name='qsiprep_hmcsdc_wf'):
     """
     This workflow controls the head motion correction and susceptibility distortion
@@ -105,6 +107,8 @@ def init_qsiprep_hmcsdc_wf(scan_groups,
     dwi_hmc_wf = init_dwi_hmc_wf(hmc_transform, hmc_model, hmc_align_to,
                                  source_file=source_file,
                                  num_model_iterations=shoreline_iters,
+                                 shoreline_tolerance=shoreline_tolerance,
+                                 shoreline_use_ants=shoreline_use_ants,
                                  sloppy=sloppy,
                                  omp_nthreads=omp_nthreads, name="dwi_hmc_wf")
 
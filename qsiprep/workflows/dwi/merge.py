@@ -89,7 +89,8 @@ def init_merge_and_denoise_wf(dwi_denoise_window,
     # validate_dwis = pe.MapNode(ValidateImage(), iterfield=[], name='validate_dwis')
     conform_dwis = pe.MapNode(
         ConformDwi(orientation=orientation), iterfield=['dwi_file'], name="conform_dwis")
-    merge_dwis = pe.Node(MergeDWIs(), name='merge_dwis')
+    merge_dwis = pe.Node(MergeDWIs(num_threads=omp_nthreads), name='merge_dwis',
+                         n_procs=omp_nthreads)
 
     workflow.connect([
         (inputnode, conform_dwis, [('dwi_files', 'dwi_file')]),
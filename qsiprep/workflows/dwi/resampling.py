@@ -15,10 +15,9 @@ from nipype.interfaces import afni, utility as niu, ants
 
 from .util import init_dwi_reference_wf
 from ...engine import Workflow
-from ...interfaces.nilearn import Merge
 from ...interfaces.gradients import (ComposeTransforms, ExtractB0s, GradientRotation,
                                      LocalGradientRotation, SplitIntramodalTransform)
-from ...interfaces.itk import DisassembleTransform
+from ...interfaces.itk import DisassembleTransform, MultiVolumeResample
 from ...interfaces.images import ChooseInterpolator
 
 DEFAULT_MEMORY_MIN_GB = 0.01
@@ -215,7 +214,7 @@ generating a *preprocessed DWI run in {tpl} space*.
         ])
     else:
         workflow.connect([
-            (compose_transforms, cnr_tfm, [(('out_warps', _get_first), 'transforms')])
+            (compose_transforms, cnr_tfm, [(('transform_lists', _get_first), 'transforms')])
         ])
 
     def _get_first(items):
@@ -224,12 +223,9 @@ generating a *preprocessed DWI run in {tpl} space*.
     get_interpolation = pe.Node(
         ChooseInterpolator(output_resolution=output_resolution), name='get_interpolation')
 
-    dwi_transform = pe.MapNode(
-        ants.ApplyTransforms(float=True),
-        name='dwi_transform', iterfield=['input_image', 'transforms'])
-
-    merge = pe.Node(Merge(compress=use_compression), name='merge',
-                    mem_gb=mem_gb * 3)
+    dwi_transform = pe.Node(
+        MultiVolumeResample(compress=use_compression),
+        name='dwi_transform', mem_gb=mem_gb * 3)
 
     extract_b0_series = pe.Node(ExtractB0s(), name="extract_b0_series")
 
@@ -250,15 +246,14 @@ generating a *preprocessed DWI run in {tpl} space*.
         (inputnode, cnr_tfm, [('cnr_map', 'input_image'),
                               ('output_grid', 'reference_image')]),
         (cnr_tfm, outputnode, [('output_image', 'cnr_map_resampled')]),
-        (compose_transforms, dwi_transform, [('out_warps', 'transforms')]),
-        (inputnode, merge, [('name_source', 'header_source')]),
-        (inputnode, dwi_transform, [('dwi_files', 'input_image'),
-                                    ('output_grid', 'reference_image')]),
+        (compose_transforms, dwi_transform, [('transform_lists', 'transforms')]),
+        (inputnode, dwi_transform, [('dwi_files', 'input_images'),
+                                    ('output_grid', 'reference_image'),
+                                    ('name_source', 'header_source')]),
         (inputnode, get_interpolation, [('dwi_files', 'dwi_files')]),
         (get_interpolation, dwi_transform, [('interpolation_method', 'interpolation')]),
-        (dwi_transform, merge, [('output_image', 'in_files')]),
-        (merge, outputnode, [('out_file', 'dwi_resampled')]),
-        (merge, extract_b0_series, [('out_file', 'dwi_series')]),
+        (dwi_transform, outputnode, [('out_file', 'dwi_resampled')]),
+        (dwi_transform, extract_b0_series, [('out_file', 'dwi_series')]),
         (inputnode, extract_b0_series, [('b0_indices', 'b0_indices')]),
         (extract_b0_series, final_b0_ref, [('b0_average', 'inputnode.b0_template')]),
         (extract_b0_series, resample_t1_mask, [('b0_average', 'reference_image')]),
@@ -272,8 +267,10 @@ generating a *preprocessed DWI run in {tpl} space*.
     if write_local_bvecs:
         local_grad_rotation = pe.Node(LocalGradientRotation(), name='local_grad_rotation')
         workflow.connect([
-            (compose_transforms, local_grad_rotation, [('out_warps', 'warp_transforms')]),
+            (compose_transforms, local_grad_rotation, [('out_warps', 'warp_transforms'),
+                                                       ('volume_affines', 'affine_transforms')]),
             (inputnode, local_grad_rotation, [('bvec_files', 'bvec_files')]),
+            (final_b0_ref, local_grad_rotation, [('outputnode.dwi_mask', 'mask_image')]),
             (local_grad_rotation, outputnode, [('local_bvecs', 'local_bvecs')])
         ])
 
@@ -10,7 +10,6 @@ Utility workflows
 
 """
 import os
-import nibabel as nb
 
 from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu, fsl, afni, ants
@@ -29,6 +28,7 @@ from ...interfaces.dipy import HistEQ, MedianOtsu
 from ...interfaces.nilearn import MaskEPI
 from ...interfaces.ants import ImageMath
 from ...interfaces import DerivativesDataSink
+from ...utils.resources import series_geometry, series_gb
 
 
 DEFAULT_MEMORY_MIN_GB = 0.01
@@ -420,13 +420,13 @@ def init_skullstrip_b0_wf(name='skullstrip_b0_wf', use_t1_prior=False, use_initi
 
 
 def _create_mem_gb(dwi_fname):
-    dwi_size_gb = os.path.getsize(dwi_fname) / (1024**3)
-    try:
-        dwi_nvols = nb.load(dwi_fname).shape[3]
-    except IndexError:
-        dwi_nvols = 1
-    except nb.filebasedimages.ImageFileError:
+    geometry = series_geometry(dwi_fname)
+    if geometry is None:
         dwi_nvols = 1
+        dwi_size_gb = os.path.getsize(dwi_fname) / (1024**3)
+    else:
+        dwi_nvols = geometry.num_volumes
+        dwi_size_gb = series_gb(geometry, geometry.itemsize)
     mem_gb = {
         'filesize': dwi_size_gb,
         'resampled': dwi_size_gb * 4,
@@ -27,7 +27,7 @@ from ...utils.sloppy_recon import make_sloppy
 import logging
 import json
 from ...interfaces.anatomical import QsiprepAnatomicalIngress
-from bids.layout import BIDSLayout
+from ...utils.bids import load_bids_index
 from .build_workflow import init_dwi_recon_workflow
 from .anatomical import init_recon_anatomical_wf
 from .interchange import anatomical_input_fields
@@ -162,7 +162,7 @@ def init_single_subject_wf(
 
         spec = _load_recon_spec(recon_spec, sloppy=sloppy)
         space = spec['space']
-        layout = BIDSLayout(recon_input, validate=False, absolute_paths=True)
+        layout = load_bids_index(recon_input, validate=False)
         # Get all the output files that are in this space
         dwi_files = [f.path for f in
                      layout.get(suffix="dwi", subject=subject_id, absolute_paths=True,
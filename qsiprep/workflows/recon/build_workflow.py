@@ -13,6 +13,7 @@ from .converters import init_mif_to_fibgz_wf
 from .dynamics import init_controllability_wf
 from .utils import init_conform_dwi_wf, init_discard_repeated_samples_wf
 from ...engine import Workflow
+from ...utils.resources import series_geometry, series_gb, set_node_resources
 from .interchange import (qsiprep_output_names, input_fields, default_input_set)
 
 LOGGER = logging.getLogger('nipype.interface')
@@ -22,6 +23,16 @@ def _get_resampled(atlas_configs, atlas_name, to_retrieve):
     return atlas_configs[atlas_name][to_retrieve]
 
 
+def _series_size(dwi_file):
+    geometry = series_geometry(dwi_file)
+    return 0 if geometry is None else series_gb(geometry)
+
+
+def _brain_mask(dwi_file):
+    """The brain mask qsiprep writes next to a preprocessed DWI series."""
+    return dwi_file.replace('_desc-preproc_dwi.nii', '_desc-brain_mask.nii')
+
+
 def _check_repeats(nodelist):
     total_len = len(nodelist)
     unique_len = len(set(nodelist))
@@ -105,7 +116,7 @@ def init_dwi_recon_workflow(dwi_files, workflow_spec, output_dir, reportlets_dir
     for node_spec in workflow_spec['nodes']:
         if not node_spec['name']:
             raise Exception("Node has no name [{}]".format(node_spec))
-        new_node = workflow_from_spec(node_spec)
+        new_node = workflow_from_spec(node_spec, omp_nthreads=omp_nthreads)
         if new_node is None:
             raise Exception("Unable to create a node for %s" % node_spec)
         nodes_to_add.append(new_node)
@@ -166,6 +177,12 @@ def init_dwi_recon_workflow(dwi_files, workflow_spec, output_dir, reportlets_dir
                                [('atlas_configs', 'inputnode.atlas_configs')])])
         _check_repeats(workflow.list_node_names())
 
+    # Estimate the memory and threads of the heavy nodes from the largest input
+    if dwi_files:
+        largest_dwi = max(dwi_files, key=_series_size)
+        set_node_resources(workflow, largest_dwi, omp_nthreads=omp_nthreads,
+                           mask_file=_brain_mask(largest_dwi))
+
     # Fill-in datasinks and reportlet datasinks seen so far
     for node in workflow.list_node_names():
         node_suffix = node.split('.')[-1]
@@ -180,7 +197,7 @@ def init_dwi_recon_workflow(dwi_files, workflow_spec, output_dir, reportlets_dir
     return workflow
 
 
-def workflow_from_spec(node_spec):
+def workflow_from_spec(node_spec, omp_nthreads=1):
     """Build a nipype workflow based on a json file."""
     software = node_spec.get("software", "qsiprep")
     output_suffix = node_spec.get("output_suffix", "")
@@ -216,9 +233,9 @@ def workflow_from_spec(node_spec):
     # Dipy operations
     elif software == "Dipy":
         if node_spec["action"] == "3dSHORE_reconstruction":
-            return init_dipy_brainsuite_shore_recon_wf(**kwargs)
+            return init_dipy_brainsuite_shore_recon_wf(omp_nthreads=omp_nthreads, **kwargs)
         if node_spec["action"] == "MAPMRI_reconstruction":
-            return init_dipy_mapmri_recon_wf(**kwargs)
+            return init_dipy_mapmri_recon_wf(omp_nthreads=omp_nthreads, **kwargs)
 
     # qsiprep operations
     else:
@@ -229,7 +246,7 @@ def workflow_from_spec(node_spec):
         if node_spec['action'] == 'conform':
             return init_conform_dwi_wf(**kwargs)
         if node_spec['action'] == 'mif_to_fib':
-            return init_mif_to_fibgz_wf(**kwargs)
+            return init_mif_to_fibgz_wf(omp_nthreads=omp_nthreads, **kwargs)
     raise Exception("Unknown node %s", node_spec)
 
 
@@ -29,7 +29,7 @@ from ...engine import Workflow
 LOGGER = logging.getLogger('nipype.workflow')
 
 
-def init_mif_to_fibgz_wf(name="mif_to_fibgz", output_suffix="", params={}):
+def init_mif_to_fibgz_wf(name="mif_to_fibgz", output_suffix="", params={}, omp_nthreads=1):
     """Converts a MRTrix mif file to DSI Studio fib file.
 
     This workflow uses ``sh2amp`` to sample the FODs on the standard DSI Studio
@@ -52,7 +52,8 @@ def init_mif_to_fibgz_wf(name="mif_to_fibgz", output_suffix="", params={}):
     outputnode = pe.Node(
         niu.IdentityInterface(fields=['fib_file']), name="outputnode")
     workflow = Workflow(name=name)
-    convert_to_fib = pe.Node(FODtoFIBGZ(), name="convert_to_fib")
+    convert_to_fib = pe.Node(FODtoFIBGZ(num_threads=omp_nthreads), name="convert_to_fib",
+                             n_procs=omp_nthreads)
     workflow.connect([
         (inputnode, convert_to_fib, [('mif_file', 'mif_file')]),
         (convert_to_fib, outputnode, [('fib_file', 'fib_file')])
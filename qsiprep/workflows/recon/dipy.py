@@ -42,7 +42,8 @@ def external_format_datasinks(output_suffix, params, wf):
         wf.connect(outputnode, 'fod_sh_mif', ds_mif, 'in_file')
 
 
-def init_dipy_brainsuite_shore_recon_wf(name="dipy_3dshore_recon", output_suffix="", params={}):
+def init_dipy_brainsuite_shore_recon_wf(name="dipy_3dshore_recon", output_suffix="", params={},
+                                        omp_nthreads=1):
     """Reconstruct EAPs, ODFs, using 3dSHORE (brainsuite-style basis set).
 
     Inputs
@@ -95,6 +96,11 @@ def init_dipy_brainsuite_shore_recon_wf(name="dipy_3dshore_recon", output_suffix
         pos_radius
             Radius for EAP estimation (default=20e-03)
 
+    Parameters
+
+        omp_nthreads: int
+            Number of processes used to fit L1-regularized models
+
     """
 
     inputnode = pe.Node(niu.IdentityInterface(fields=input_fields),
@@ -109,7 +115,8 @@ def init_dipy_brainsuite_shore_recon_wf(name="dipy_3dshore_recon", output_suffix
     workflow = Workflow(name=name)
     resample_mask = pe.Node(
         afni.Resample(outputtype='NIFTI_GZ', resample_mode="NN"), name='resample_mask')
-    recon_shore = pe.Node(BrainSuiteShoreReconstruction(**params), name="recon_shore")
+    recon_shore = pe.Node(BrainSuiteShoreReconstruction(num_threads=omp_nthreads, **params),
+                          name="recon_shore", n_procs=omp_nthreads)
     doing_extrapolation = params.get("extrapolate_scheme") in ("HCP", "ABCD")
 
     workflow.connect([
@@ -221,7 +228,8 @@ def init_dipy_brainsuite_shore_recon_wf(name="dipy_3dshore_recon", output_suffix
     return workflow
 
 
-def init_dipy_mapmri_recon_wf(name="dipy_mapmri_recon", output_suffix="", params={}):
+def init_dipy_mapmri_recon_wf(name="dipy_mapmri_recon", output_suffix="", params={},
+                              omp_nthreads=1):
     """Reconstruct EAPs, ODFs, using 3dSHORE (brainsuite-style basis set).
 
     Inputs
@@ -305,7 +313,8 @@ def init_dipy_mapmri_recon_wf(name="dipy_mapmri_recon", output_suffix="", params
         name="outputnode")
 
     workflow = Workflow(name=name)
-    recon_map = pe.Node(MAPMRIReconstruction(**params), name="recon_map")
+    recon_map = pe.Node(MAPMRIReconstruction(num_threads=omp_nthreads, **params),
+                        name="recon_map", n_procs=omp_nthreads)
     resample_mask = pe.Node(
         afni.Resample(outputtype='NIFTI_GZ', resample_mode="NN"), name='resample_mask')
 
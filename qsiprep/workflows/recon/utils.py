@@ -69,9 +69,11 @@ def init_discard_repeated_samples_wf(name="discard_repeats", output_suffix="",
     discard_repeats = pe.Node(RemoveDuplicates(**params), name='discard_repeats')
     workflow.connect([
         (inputnode, discard_repeats, [('dwi_file', 'dwi_file'), ('bval_file', 'bval_file'),
-                                      ('bvec_file', 'bvec_file')]),
+                                      ('bvec_file', 'bvec_file'),
+                                      ('local_bvec_file', 'local_bvec_file')]),
         (discard_repeats, outputnode, [('dwi_file', 'dwi_file'), ('bval_file', 'bval_file'),
-                                       ('bvec_file', 'bvec_file')])
+                                       ('bvec_file', 'bvec_file'),
+                                       ('local_bvec_file', 'local_bvec_file')])
     ])
 
     return workflow
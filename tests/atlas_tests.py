@@ -0,0 +1,128 @@
+"""
+Test the in-process resampling of label atlases and the atlas cache.
+"""
+import json
+import shutil
+import subprocess
+import numpy as np
+import nibabel as nb
+import pytest
+from qsiprep.interfaces import utils as interface_utils
+from qsiprep.interfaces.utils import GetConnectivityAtlases
+from qsiprep.utils import atlases
+from qsiprep.utils.atlases import atlas_sampling_points, resample_labels
+from qsiprep.utils.transforms import write_itk_affine
+
+AFFINE = np.array([[-2., 0., 0., 24.],
+                   [0., 2., 0., -30.],
+                   [0., 0., 2., -16.],
+                   [0., 0., 0., 1.]])
+
+
+def _blocky_atlas(shape=(24, 30, 16), seed=0):
+    """Labels 1-8 in octants, with some background."""
+    rng = np.random.RandomState(seed)
+    centre = np.array(shape) // 2 + rng.randint(-2, 3, size=3)
+    ijk = np.indices(shape)
+    labels = 1 + sum((ijk[axis] >= centre[axis]).astype(np.int16) * 2 ** axis
+                     for axis in range(3))
+    labels[:2] = 0
+    return labels.astype(np.int16)
+
+
+@pytest.fixture
+def atlas_file(tmp_path):
+    fname = str(tmp_path / 'atlas.nii.gz')
+    nb.Nifti1Image(_blocky_atlas(), AFFINE).to_filename(fname)
+    return fname
+
+
+def _translation(tmp_path, shift_lps):
+    affine = np.eye(4)
+    affine[:3, 3] = shift_lps
+    return write_itk_affine(affine, str(tmp_path / 'shift.mat'))
+
+
+def test_resample_labels_identity(atlas_file, tmp_path):
+    points, _ = atlas_sampling_points('identity', atlas_file, str(tmp_path))
+    out_img = nb.load(resample_labels(atlas_file, points, atlas_file,
+                                      str(tmp_path / 'out.nii.gz')))
+    np.testing.assert_array_equal(np.asanyarray(out_img.dataobj), _blocky_atlas())
+
+
+def test_resample_labels_whole_voxel_shift(atlas_file, tmp_path):
+    # One voxel along the second axis, which points along -P in LPS
+    transform = _translation(tmp_path, [0., -2., 0.])
+    points, _ = atlas_sampling_points(transform, atlas_file, str(tmp_path))
+    resampled = np.asanyarray(nb.load(resample_labels(
+        atlas_file, points, atlas_file, str(tmp_path / 'out.nii.gz'))).dataobj)
+    expected = np.zeros_like(_blocky_atlas())
+    expected[:, :-1] = _blocky_atlas()[:, 1:]
+    np.testing.assert_array_equal(resampled, expected)
+
+
+@pytest.mark.skipif(shutil.which('antsApplyTransforms') is None,
+                    reason='ANTs is not installed')
+@pytest.mark.parametrize("interpolation,agreement", [('GenericLabel', 0.99),
+                                                     ('MultiLabel', 0.95)])
+def test_resample_labels_matches_ants(atlas_file, tmp_path, interpolation, agreement):
+    motion = np.eye(4)
+    angle = 0.1
+    motion[:2, :2] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+    motion[:3, 3] = [1.3, -0.6, 0.9]
+    transform = write_itk_affine(motion, str(tmp_path / 'motion.mat'))
+    points, _ = atlas_sampling_points(transform, atlas_file, str(tmp_path))
+    ours = np.asanyarray(nb.load(resample_labels(
+        atlas_file, points, atlas_file, str(tmp_path / 'ours.nii.gz'))).dataobj)
+    ants_file = str(tmp_path / 'ants.nii.gz')
+    subprocess.check_call(['antsApplyTransforms', '-d', '3', '-i', atlas_file, '-r',
+                           atlas_file, '-o', ants_file, '-n', interpolation, '-t', transform])
+    ants = np.round(nb.load(ants_file).get_fdata()).astype(int)
+    assert (ours == ants).mean() > agreement
+
+
+def test_atlas_cache(atlas_file, tmp_path, monkeypatch):
+    atlas_dir = tmp_path / 'atlases'
+    atlas_dir.mkdir()
+    config = {}
+    for name in ('first', 'second'):
+        shutil.copyfile(atlas_file, str(atlas_dir / (name + '.nii.gz')))
+        config[name] = {'file': name + '.nii.gz', 'node_ids': list(range(1, 9)),
+                        'node_names': ['region%d' % num for num in range(1, 9)]}
+    with open(str(atlas_dir / 'atlas_config.json'), 'w') as config_json:
+        json.dump(config, config_json)
+    transform = _translation(tmp_path, [0., -2., 0.])
+    monkeypatch.setenv('QSIRECON_ATLAS', str(atlas_dir))
+    monkeypatch.setenv('QSIPREP_ATLAS_CACHE', str(tmp_path / 'cache'))
+
+    hashed = []
+    file_hash = atlases.file_hash
+
+    def _recording_hash(fname):
+        hashed.append(fname)
+        return file_hash(fname)
+    monkeypatch.setattr(atlases, 'file_hash', _recording_hash)
+
+    def _copy_label_convert(in_file, out_mif, *args):
+        # Stands in for MRtrix's labelconvert, which only writes the .mif
+        shutil.copyfile(in_file, out_mif)
+        return 'labelconvert ' + in_file
+    monkeypatch.setattr(interface_utils, 'label_convert', _copy_label_convert)
+
+    outputs = []
+    for run_num in range(2):
+        run_dir = tmp_path / ('run%d' % run_num)
+        run_dir.mkdir()
+        result = GetConnectivityAtlases(
+            atlas_names=['first', 'second'], forward_transform=transform,
+            reference_image=atlas_file, space='T1w',
+            batched=True).run(cwd=str(run_dir))
+        outputs.append(result.outputs)
+    # The transform is hashed once per run, not once per atlas
+    assert hashed.count(transform) == 2
+    with open(outputs[1].commands) as commands:
+        assert commands.read().count('cached resampled atlas') == 2
+    for name in ('first', 'second'):
+        np.testing.assert_array_equal(
+            nb.load(outputs[0].atlas_configs[name]['dwi_resolution_file']).get_fdata(),
+            nb.load(outputs[1].atlas_configs[name]['dwi_resolution_file']).get_fdata())
@@ -0,0 +1,136 @@
+"""
+Test the persistent BIDS index against a small BIDS tree.
+"""
+import json
+import os
+import pytest
+from qsiprep.utils import bids
+from qsiprep.utils.bids import (BIDSError, BIDSIndex, collect_data, collect_participants,
+                                load_bids_index)
+
+
+def _touch(root, rel_path, contents=''):
+    path = root / rel_path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if isinstance(contents, dict):
+        contents = json.dumps(contents)
+    path.write_text(contents)
+    return str(path)
+
+
+@pytest.fixture
+def bids_tree(tmp_path):
+    root = tmp_path / 'bids'
+    _touch(root, 'dataset_description.json', {'Name': 'test', 'BIDSVersion': '1.1.1'})
+    _touch(root, 'dwi.json', {'PhaseEncodingDirection': 'j', 'EchoTime': 0.1})
+    for sub in ('01', '02'):
+        for ses in ('1', '2'):
+            prefix = 'sub-%s/ses-%s/' % (sub, ses)
+            name = 'sub-%s_ses-%s_' % (sub, ses)
+            _touch(root, prefix + 'anat/' + name + 'T1w.nii.gz')
+            for run in ('1', '2'):
+                _touch(root, prefix + 'dwi/' + name + 'run-%s_dwi.nii.gz' % run)
+                _touch(root, prefix + 'dwi/' + name + 'run-%s_dwi.bval' % run)
+    _touch(root, 'sub-01/ses-1/dwi/sub-01_ses-1_run-2_dwi.json', {'EchoTime': 0.2})
+    _touch(root, 'sub-01/ses-1/fmap/sub-01_ses-1_dir-PA_epi.nii.gz')
+    _touch(root, 'sub-01/ses-1/fmap/sub-01_ses-1_dir-PA_epi.json',
+           {'IntendedFor': 'ses-1/dwi/sub-01_ses-1_run-1_dwi.nii.gz'})
+    # Not recognised by the BIDS validator
+    _touch(root, 'sub-01/ses-1/dwi/sub-01_ses-1_run-1_dwi_notes.nii.gz')
+    _touch(root, 'derivatives/sub-03/anat/sub-03_T1w.nii.gz')
+    return root
+
+
+def test_get(bids_tree):
+    index = BIDSIndex(bids_tree, index_dir='')
+    dwis = index.get(return_type='file', subject='01', suffix='dwi', extension='nii.gz')
+    assert [os.path.basename(fname) for fname in dwis] == [
+        'sub-01_ses-1_run-1_dwi.nii.gz', 'sub-01_ses-1_run-2_dwi.nii.gz',
+        'sub-01_ses-2_run-1_dwi.nii.gz', 'sub-01_ses-2_run-2_dwi.nii.gz']
+    assert all(os.path.isabs(fname) for fname in dwis)
+    assert index.get(return_type='file', subject='01', suffix='dwi', extension='nii.gz',
+                     absolute_paths=False)[0] == os.path.join(
+        'sub-01', 'ses-1', 'dwi', 'sub-01_ses-1_run-1_dwi.nii.gz')
+    assert len(index.get(datatype='dwi', run=['2'], extensions=['.bval'])) == 4
+    assert len(index.get(subject='0[12]', session='1', suffix='dwi',
+                         extension='nii.gz', regex_search=True)) == 4
+    assert not index.get(subject='0[12]', suffix='dwi')
+
+
+def test_get_ids(bids_tree):
+    index = BIDSIndex(bids_tree, index_dir='')
+    assert index.get(return_type='id', target='subject') == ['01', '02']
+    assert index.get_subjects() == ['01', '02']
+    assert index.get(return_type='id', target='run', subject='02', session='2') == ['1', '2']
+    assert index.get_sessions(subject='01', datatype='fmap') == ['1']
+    with pytest.raises(ValueError):
+        index.get(return_type='id')
+    with pytest.raises(ValueError):
+        index.get(scope='derivatives')
+
+
+def test_metadata_and_fieldmaps(bids_tree):
+    index = BIDSIndex(bids_tree, index_dir='')
+    dwi_dir = bids_tree / 'sub-01' / 'ses-1' / 'dwi'
+    assert index.get_metadata(str(dwi_dir / 'sub-01_ses-1_run-1_dwi.nii.gz')) == {
+        'PhaseEncodingDirection': 'j', 'EchoTime': 0.1}
+    assert index.get_metadata(str(dwi_dir / 'sub-01_ses-1_run-2_dwi.nii.gz')) == {
+        'PhaseEncodingDirection': 'j', 'EchoTime': 0.2}
+    fieldmap = index.get_fieldmap(str(dwi_dir / 'sub-01_ses-1_run-1_dwi.nii.gz'))
+    assert fieldmap['suffix'] == 'epi'
+    assert index.get_fieldmap(str(dwi_dir / 'sub-01_ses-1_run-2_dwi.nii.gz')) is None
+
+
+def test_validation(bids_tree):
+    notes = 'sub-01_ses-1_run-1_dwi_notes.nii.gz'
+    validated = BIDSIndex(bids_tree, index_dir='')
+    assert notes not in [fobj.filename for fobj in validated.get(subject='01')]
+    assert '03' not in validated.get_subjects()
+    unvalidated = BIDSIndex(bids_tree, index_dir='', validate=False)
+    assert notes in [fobj.filename for fobj in unvalidated.get(subject='01')]
+
+    os.remove(str(bids_tree / 'dataset_description.json'))
+    with pytest.raises(BIDSError):
+        BIDSIndex(bids_tree, index_dir='')
+    assert BIDSIndex(bids_tree, index_dir='', validate=False).get_subjects() == ['01', '02']
+
+
+def test_index_file_is_reused(bids_tree, tmp_path, monkeypatch):
+    monkeypatch.setenv('QSIPREP_BIDS_INDEX', str(tmp_path / 'index'))
+    index = BIDSIndex(bids_tree)
+    assert os.path.dirname(index.index_file) == str(tmp_path / 'index')
+    assert os.path.exists(index.index_file)
+
+    # Only the directories that changed are listed again
+    listed = []
+    scandir = os.scandir
+
+    def _recording_scandir(path):
+        listed.append(path)
+        return scandir(path)
+    monkeypatch.setattr(bids.os, 'scandir', _recording_scandir)
+    assert BIDSIndex(bids_tree).get_subjects() == ['01', '02']
+    assert not listed
+    _touch(bids_tree, 'sub-03/anat/sub-03_T1w.nii.gz')
+    assert BIDSIndex(bids_tree).get_subjects() == ['01', '02', '03']
+    assert sorted(os.path.relpath(path, str(bids_tree)) for path in listed) == [
+        '.', 'sub-03', os.path.join('sub-03', 'anat')]
+
+
+def test_in_memory_by_default(bids_tree, monkeypatch):
+    monkeypatch.delenv('QSIPREP_BIDS_INDEX', raising=False)
+    assert BIDSIndex(bids_tree).index_file is None
+
+
+def test_collect(bids_tree, monkeypatch):
+    monkeypatch.delenv('QSIPREP_BIDS_INDEX', raising=False)
+    monkeypatch.setattr(bids, '_BIDS_INDICES', {})
+    assert collect_participants(str(bids_tree)) == ['01', '02']
+    assert collect_participants(str(bids_tree), participant_label=['sub-02']) == ['02']
+    subj_data, layout = collect_data(str(bids_tree), '01')
+    assert layout is load_bids_index(str(bids_tree))
+    assert len(subj_data['dwi']) == 4
+    assert len(subj_data['t1w']) == 2
+    assert len(subj_data['fmap']) == 1
+    _, unvalidated = collect_data(str(bids_tree), '01', bids_validate=False)
+    assert unvalidated is not layout
@@ -0,0 +1,101 @@
+"""
+Test that the separable BSpline design matrix matches the knot-by-knot
+evaluation it replaces, and that the sparse fits match dense least squares.
+"""
+import numpy as np
+import nibabel as nb
+import pytest
+from qsiprep.interfaces.fmap import FieldEnhance
+from qsiprep.utils.bspline import compute_affine, get_ijk, tbspl_eval, sparse_lstsq
+
+
+def _bspl_reference(x):
+    """Univariate cubic bspline, one value at a time"""
+    x = abs(x)
+    if x <= 1.0:
+        return 2.0 / 3.0 - x ** 2 + 0.5 * x ** 3
+    if x < 2.0:
+        return (2.0 - x) ** 3 / 6.0
+    return 0.0
+
+
+def _tbspl_eval_reference(points, knots, zooms):
+    """The original point-by-point evaluation of tbspl_eval"""
+    design = np.zeros((len(points), len(knots)))
+    for point_num, point in enumerate(points):
+        u_vec = (knots - point[np.newaxis]) / zooms[np.newaxis]
+        design[point_num] = [np.prod([_bspl_reference(u) for u in knot_u]) for knot_u in u_vec]
+    return design
+
+
+def _knots(grid_shape, zooms):
+    grid = np.zeros(grid_shape)
+    ijk = get_ijk(grid)
+    aff = compute_affine(grid, zooms)
+    return aff[:3, :3].dot(ijk.T).T + aff[:3, 3]
+
+
+@pytest.mark.parametrize("zooms", [(40., 40., 18.), (24., 60., 4.)])
+def test_tbspl_eval_matches_reference(zooms):
+    zooms = np.array(zooms)
+    knots = _knots((5, 4, 6), zooms)
+    rng = np.random.RandomState(0)
+    # Points inside, on, and outside the knot grid
+    extent = knots.max(0) - knots.min(0)
+    points = knots.min(0) - zooms + rng.rand(200, 3) * (extent + 2 * zooms)
+    points[:10] = knots[rng.choice(len(knots), 10)]
+
+    design = tbspl_eval(points, knots, zooms)
+    np.testing.assert_allclose(design.toarray(), _tbspl_eval_reference(points, knots, zooms),
+                               atol=1e-12)
+
+
+def test_tbspl_eval_needs_a_regular_grid():
+    zooms = np.array([10., 10., 10.])
+    knots = _knots((3, 3, 3), zooms)
+    knots[4] += 1.
+    with pytest.raises(ValueError):
+        tbspl_eval(np.zeros((1, 3)), knots, zooms)
+
+
+def _design_and_values(seed=0):
+    zooms = np.array([10., 10., 10.])
+    knots = _knots((4, 4, 4), zooms)
+    rng = np.random.RandomState(seed)
+    points = knots.min(0) + rng.rand(500, 3) * (knots.max(0) - knots.min(0))
+    design = tbspl_eval(points, knots, zooms)
+    values = np.sin(points[:, 0] / 20.) + rng.randn(len(points)) * 0.1
+    return design, values
+
+
+@pytest.mark.parametrize("damp", [0., 0.5])
+def test_sparse_lstsq_matches_dense(damp):
+    design, values = _design_and_values()
+    dense = design.toarray()
+    # Damped least squares as an augmented ordinary least squares problem
+    augmented = np.vstack([dense, damp * np.eye(dense.shape[1])])
+    expected = np.linalg.lstsq(augmented, np.r_[values, np.zeros(dense.shape[1])],
+                               rcond=None)[0]
+    np.testing.assert_allclose(sparse_lstsq(design, values, damp=damp), expected,
+                               rtol=1e-6, atol=1e-8)
+
+
+def test_field_enhance_damping(tmp_path):
+    rng = np.random.RandomState(0)
+    coords = np.meshgrid(*[np.linspace(-1, 1, 12)] * 3, indexing='ij')
+    fmap = 50 * coords[0] * coords[1] + rng.randn(12, 12, 12)
+    in_file = str(tmp_path / 'fmap.nii.gz')
+    mask_file = str(tmp_path / 'mask.nii.gz')
+    affine = np.diag([4., 4., 4., 1.])
+    nb.Nifti1Image(fmap.astype(np.float32), affine).to_filename(in_file)
+    nb.Nifti1Image(np.ones(fmap.shape, dtype=np.uint8), affine).to_filename(mask_file)
+
+    smoothed = []
+    for damping in (0., 100.):
+        out_dir = tmp_path / ('damping%d' % damping)
+        out_dir.mkdir()
+        result = FieldEnhance(in_file=in_file, in_mask=mask_file, mask_erode=0, despike=False,
+                              bspline_damping=damping).run(cwd=str(out_dir))
+        smoothed.append(nb.load(result.outputs.out_file).get_fdata())
+    # Damping shrinks the bspline coefficients towards zero
+    assert np.abs(smoothed[1]).sum() < np.abs(smoothed[0]).sum()
@@ -0,0 +1,164 @@
+"""
+Test the in-process rotation of bvecs by head motion affines and by the
+Jacobians of displacement fields.
+"""
+import shutil
+import numpy as np
+import nibabel as nb
+import pytest
+from nipype.interfaces.base import Bunch
+from qsiprep.interfaces.gradients import (
+    RAS_TO_LPS, aattp_rotate_vec, bvec_rotation, local_bvec_rotation, warp_jacobian)
+from qsiprep.utils.transforms import write_itk_affine
+
+
+def _rotation(axis, angle):
+    axis = np.asarray(axis, dtype=float) / np.linalg.norm(axis)
+    cross = np.array([[0., -axis[2], axis[1]],
+                      [axis[2], 0., -axis[0]],
+                      [-axis[1], axis[0], 0.]])
+    return np.eye(3) + np.sin(angle) * cross + (1 - np.cos(angle)) * cross.dot(cross)
+
+
+@pytest.fixture
+def rotated_scheme(tmp_path):
+    rng = np.random.RandomState(0)
+    bvecs = rng.randn(5, 3)
+    bvecs /= np.linalg.norm(bvecs, axis=1)[:, np.newaxis]
+    bvecs[2] = 0
+    rotations = [_rotation(rng.randn(3), angle) for angle in np.deg2rad([0, 5, 10, 15, 20])]
+    transforms = []
+    for num, rotation in enumerate(rotations):
+        affine = np.eye(4)
+        # An isotropic scale only changes the length of the rotated vectors
+        affine[:3, :3] = 1.05 * rotation
+        affine[:3, 3] = rng.randn(3)
+        transforms.append(write_itk_affine(affine, str(tmp_path / ('motion%d.mat' % num))))
+    # The transforms map fixed points to moving points, so bvecs are rotated back
+    expected = np.array([rotation.T.dot(bvec) for rotation, bvec in zip(rotations, bvecs)])
+    return bvecs, transforms, expected
+
+
+def test_bvec_rotation(rotated_scheme, tmp_path):
+    bvecs, transforms, expected = rotated_scheme
+    out_file = str(tmp_path / 'rotated.bvec')
+    commands = bvec_rotation(bvecs, transforms, out_file, Bunch(cwd=str(tmp_path)))
+    assert len(commands) == len(bvecs)
+    rotated = np.loadtxt(out_file).T
+    np.testing.assert_allclose(rotated, expected, atol=1e-7)
+    # b=0 stays zero, the other vectors stay unit length
+    np.testing.assert_array_equal(rotated[2], 0)
+    np.testing.assert_allclose(np.linalg.norm(np.delete(rotated, 2, 0), axis=1), 1)
+
+
+@pytest.mark.skipif(shutil.which('antsApplyTransformsToPoints') is None,
+                    reason='ANTs is not installed')
+def test_bvec_rotation_matches_ants(rotated_scheme, tmp_path):
+    bvecs, transforms, expected = rotated_scheme
+    runtime = Bunch(cwd=str(tmp_path))
+    out_file = str(tmp_path / 'rotated.bvec')
+    commands = bvec_rotation(bvecs, transforms, out_file, runtime, check_with_ants=True)
+    assert len(commands) == len(bvecs)
+    np.testing.assert_allclose(np.loadtxt(out_file).T, expected, atol=1e-7)
+    ants_rotated = np.array([aattp_rotate_vec(bvec, transform, runtime)[0]
+                             for bvec, transform in zip(bvecs, transforms)])
+    np.testing.assert_allclose(ants_rotated, expected, atol=1e-4)
+
+
+AFFINE = np.array([[-2., 0., 0., 30.],
+                   [0., 2., 0., -40.],
+                   [0., 0., 2.5, -20.],
+                   [0., 0., 0., 1.]])
+
+
+def _write_displacements(displacement, shape, out_file):
+    """Write the ITK displacement field of ``x -> x + displacement(x)`` (LPS)."""
+    ijk = np.indices(shape).reshape(3, -1)
+    lps_points = RAS_TO_LPS.dot(AFFINE[:3, :3].dot(ijk) + AFFINE[:3, 3:])
+    data = displacement(lps_points).T.reshape(shape + (1, 3))
+    nb.Nifti1Image(data.astype(np.float32), AFFINE).to_filename(out_file)
+    return out_file
+
+
+@pytest.fixture
+def local_scheme(tmp_path):
+    shape = (5, 6, 4)
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[1:4, 1:5, 1:3] = 1
+    mask_file = str(tmp_path / 'mask.nii.gz')
+    nb.Nifti1Image(mask, AFFINE).to_filename(mask_file)
+    rng = np.random.RandomState(0)
+    bvecs = rng.randn(4, 3)
+    bvecs /= np.linalg.norm(bvecs, axis=1)[:, np.newaxis]
+    bvecs[1] = 0
+    return shape, mask > 0, mask_file, bvecs
+
+
+def _local_bvecs(bvecs, warps, mask_file, tmp_path, reorientation='PPD', affines=None):
+    out_file = str(tmp_path / ('local_bvecs_%s.nii' % reorientation))
+    commands = local_bvec_rotation(bvecs, warps, mask_file, Bunch(cwd=str(tmp_path)), out_file,
+                                   reorientation=reorientation, affine_transforms=affines)
+    assert len(commands) == len(bvecs)
+    return nb.load(out_file).get_fdata()[:, :, :, 0]
+
+
+@pytest.mark.parametrize('reorientation', ['PPD', 'FS'])
+def test_rotation_warp_matches_global_rotation(local_scheme, tmp_path, reorientation):
+    shape, mask, mask_file, bvecs = local_scheme
+    rotation = _rotation([1., 2., 3.], np.deg2rad(8))
+    warp_file = _write_displacements(
+        lambda points: rotation.dot(points) - points + np.array([[1.], [-2.], [0.5]]),
+        shape, str(tmp_path / 'rotation_warp.nii.gz'))
+    np.testing.assert_allclose(warp_jacobian(warp_file, mask),
+                               np.tile(rotation, (mask.sum(), 1, 1)), atol=1e-5)
+
+    affine = np.eye(4)
+    affine[:3, :3] = rotation
+    affine_file = write_itk_affine(affine, str(tmp_path / 'rotation.mat'))
+    global_file = str(tmp_path / 'global.bvec')
+    bvec_rotation(bvecs, [affine_file] * len(bvecs), global_file, Bunch(cwd=str(tmp_path)))
+    global_bvecs = np.loadtxt(global_file).T
+
+    local_bvecs = _local_bvecs(bvecs, [warp_file] * len(bvecs), mask_file, tmp_path,
+                               reorientation)
+    for volume_num, global_bvec in enumerate(global_bvecs):
+        np.testing.assert_allclose(local_bvecs[..., volume_num][mask],
+                                   np.tile(global_bvec, (mask.sum(), 1)), atol=1e-5)
+    # Voxels outside the mask and b=0 volumes are not rotated
+    assert not local_bvecs[~mask].any()
+    assert not local_bvecs[..., 1].any()
+
+
+def test_zero_warp_keeps_bvecs(local_scheme, tmp_path):
+    shape, mask, mask_file, bvecs = local_scheme
+    warp_file = _write_displacements(np.zeros_like, shape, str(tmp_path / 'zero_warp.nii.gz'))
+    for warps in ([warp_file] * len(bvecs), None):
+        local_bvecs = _local_bvecs(bvecs, warps, mask_file, tmp_path)
+        for volume_num, bvec in enumerate(bvecs):
+            np.testing.assert_allclose(local_bvecs[..., volume_num][mask],
+                                       np.tile(bvec, (mask.sum(), 1)), atol=1e-6)
+        assert not local_bvecs[~mask].any()
+
+
+def test_warp_then_affine(local_scheme, tmp_path):
+    shape, mask, mask_file, bvecs = local_scheme
+    rotation = _rotation([0., 1., 1.], np.deg2rad(12))
+    affine = np.eye(4)
+    affine[:3, :3] = rotation
+    affine_file = write_itk_affine(affine, str(tmp_path / 'rotation.mat'))
+    warp_file = _write_displacements(np.zeros_like, shape, str(tmp_path / 'zero_warp.nii.gz'))
+    local_bvecs = _local_bvecs(bvecs, [warp_file] * len(bvecs), mask_file, tmp_path,
+                               affines=[affine_file] * len(bvecs))
+    for volume_num, bvec in enumerate(bvecs):
+        if bvec.any():
+            np.testing.assert_allclose(local_bvecs[..., volume_num][mask],
+                                       np.tile(rotation.T.dot(bvec), (mask.sum(), 1)),
+                                       atol=1e-6)
+
+
+def test_warp_jacobian_needs_matching_mask(local_scheme, tmp_path):
+    shape, mask, _, _ = local_scheme
+    warp_file = _write_displacements(np.zeros_like, shape, str(tmp_path / 'zero_warp.nii.gz'))
+    with pytest.raises(ValueError):
+        warp_jacobian(warp_file, mask[:-1])
+    assert warp_jacobian(warp_file).shape == (np.prod(shape), 3, 3)
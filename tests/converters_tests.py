@@ -0,0 +1,150 @@
+"""
+Test the in-process ODF conversions against dipy and the MRtrix formats.
+"""
+import numpy as np
+import nibabel as nb
+import pytest
+from dipy.core.geometry import cart2sphere
+from dipy.core.sphere import HemiSphere
+from dipy.direction import peak_directions
+from dipy.reconst.shm import real_sh_tournier
+from scipy.io.matlab import loadmat
+from qsiprep.interfaces.converters import (
+    amplitudes_to_fibgz, amplitudes_to_sh_mif, find_peaks, get_dsi_studio_ODF_geometry,
+    odf_edges)
+from qsiprep.utils.mif import write_voxelwise_mif
+from qsiprep.utils.shm import max_order_for_directions, real_sym_sh_mrtrix3
+
+
+def _fiber_odfs(vertices, num_odfs, seed=0):
+    """ODFs of one to three crossing fibers, plus noise and ties"""
+    rng = np.random.RandomState(seed)
+    odfs = np.zeros((num_odfs, len(vertices)))
+    for odf in odfs:
+        for _ in range(rng.randint(1, 4)):
+            fiber = rng.randn(3)
+            fiber /= np.linalg.norm(fiber)
+            odf += rng.uniform(0.3, 1) * np.exp(-(1 - np.dot(vertices, fiber) ** 2) / 0.05)
+    odfs += rng.rand(*odfs.shape) * 0.05
+    # Flat and tied ODFs
+    odfs[0] = 0.5
+    odfs[1] = np.round(odfs[1], 1)
+    return odfs.astype(np.float32)
+
+
+@pytest.mark.parametrize("odf_key", ["odf4", "odf8"])
+def test_find_peaks_matches_dipy(odf_key):
+    odf_dirs, odf_faces = get_dsi_studio_ODF_geometry(odf_key)
+    hemisphere = odf_dirs.shape[0] // 2
+    vertices = odf_dirs[:hemisphere]
+    odfs = _fiber_odfs(vertices, 200)
+    num_fibers = 3
+    peak_vals, peak_indices = find_peaks(odfs, vertices, odf_edges(odf_faces, hemisphere),
+                                         num_fibers)
+
+    x, y, z = vertices.T
+    sphere = HemiSphere(x=x, y=y, z=z)
+    for odf, vals, indices in zip(odfs, peak_vals, peak_indices):
+        _, ref_vals, ref_indices = peak_directions(odf.astype(np.float64), sphere)
+        num_peaks = min(num_fibers, len(ref_indices))
+        np.testing.assert_array_equal(indices[:num_peaks], ref_indices[:num_peaks])
+        np.testing.assert_allclose(vals[:num_peaks], ref_vals[:num_peaks])
+        assert not vals[num_peaks:].any()
+        assert not indices[num_peaks:].any()
+
+
+def test_fibgz_chunks_and_threads(tmp_path):
+    odf_dirs, odf_faces = get_dsi_studio_ODF_geometry("odf8")
+    hemisphere = odf_dirs.shape[0] // 2
+    odfs = _fiber_odfs(odf_dirs[:hemisphere], 60).reshape(3, 4, 5, -1)
+    amplitudes_img = nb.Nifti1Image(np.concatenate([odfs, odfs], -1), np.eye(4))
+    mask = np.ones((3, 4, 5), dtype=np.uint8)
+    mask[0, 0] = 0
+    mask_img = nb.Nifti1Image(mask, np.eye(4))
+
+    fib_files = [str(tmp_path / ('%d.fib' % num_threads)) for num_threads in (1, 3)]
+    amplitudes_to_fibgz(amplitudes_img, odf_dirs, odf_faces, fib_files[0], mask_img)
+    amplitudes_to_fibgz(amplitudes_img, odf_dirs, odf_faces, fib_files[1], mask_img,
+                        num_threads=3, chunk_size=7)
+    serial, threaded = loadmat(fib_files[0]), loadmat(fib_files[1])
+    for key in ['fa0', 'fa1', 'index0', 'index1', 'odf0']:
+        np.testing.assert_array_equal(serial[key], threaded[key])
+
+
+@pytest.mark.parametrize("sh_order", [2, 8])
+def test_real_sym_sh_mrtrix3_matches_tournier07(sh_order):
+    rng = np.random.RandomState(0)
+    theta, phi = np.arccos(rng.uniform(-1, 1, 50)), rng.uniform(0, 2 * np.pi, 50)
+    basis, m, n = real_sym_sh_mrtrix3(sh_order, theta, phi)
+    ref_basis, ref_m, ref_n = real_sh_tournier(sh_order, theta, phi, legacy=False)
+    np.testing.assert_array_equal(m, ref_m)
+    np.testing.assert_array_equal(n, ref_n)
+    np.testing.assert_allclose(basis, ref_basis, atol=1e-12)
+
+
+def test_max_order_for_directions():
+    assert max_order_for_directions(5) == 0
+    assert max_order_for_directions(6) == 2
+    assert max_order_for_directions(44) == 6
+    assert max_order_for_directions(45) == 8
+    assert max_order_for_directions(300) == 8
+
+
+def _read_mif(mif_file):
+    """Header entries and (voxels, volumes) data of a 4D mif with a contiguous volume axis"""
+    with open(mif_file, 'rb') as fobj:
+        contents = fobj.read()
+    header = contents[:contents.index(b'\nEND\n')].decode('latin-1').split('\n')
+    assert header[0] == 'mrtrix image'
+    entries = {}
+    for line in header[1:]:
+        key, value = line.split(': ', 1)
+        entries.setdefault(key, []).append(value)
+    assert entries['layout'] == ['+1,+2,+3,+0']
+    assert entries['datatype'] == ['Float32LE']
+    shape = [int(dim) for dim in entries['dim'][0].split(',')]
+    offset = int(entries['file'][0].split()[1])
+    assert offset % 16 == 0
+    data = np.frombuffer(contents[offset:], dtype='<f4')
+    return entries, data.reshape(-1, shape[3])
+
+
+def test_write_voxelwise_mif(tmp_path):
+    affine = np.array([[-2., 0., 0., 20.], [0., 0., 2.5, -30.], [0., 2., 0., -10.],
+                       [0., 0., 0., 1.]])
+    data = np.arange(3 * 4 * 2 * 5, dtype=np.float32).reshape(-1, 5)
+    mif_file = write_voxelwise_mif(str(tmp_path / 'out.mif'), (3, 4, 2, 5), affine,
+                                   [data[:10], data[10:]])
+    entries, mif_data = _read_mif(mif_file)
+    np.testing.assert_array_equal(mif_data, data)
+    assert entries['dim'] == ['3,4,2,5']
+    assert entries['vox'] == ['2,2,2.5,nan']
+    transform = np.array([[float(val) for val in row.split(',')]
+                          for row in entries['transform']])
+    np.testing.assert_allclose(transform[:, :3] * [2., 2., 2.5], affine[:3, :3])
+    np.testing.assert_allclose(transform[:, 3], affine[:3, 3])
+    with pytest.raises(ValueError):
+        write_voxelwise_mif(str(tmp_path / 'short.mif'), (3, 4, 2, 5), affine, [data[:10]])
+
+
+def test_amplitudes_to_sh_mif_round_trip(tmp_path):
+    odf_dirs, _ = get_dsi_studio_ODF_geometry("odf8")
+    hemisphere = odf_dirs.shape[0] // 2
+    x, y, z = odf_dirs[:hemisphere].T
+    # The basis is sampled at the RAS versions of the (LPS) DSI Studio directions
+    _, theta, phi = cart2sphere(-x, -y, z)
+    basis, _, _ = real_sym_sh_mrtrix3(8, theta, phi)
+    rng = np.random.RandomState(0)
+    coeffs = rng.randn(2 * 3 * 4, basis.shape[1])
+    coeffs[5] = 0
+    amplitudes = np.dot(coeffs, basis.T)
+    amplitudes = np.concatenate([amplitudes, amplitudes], 1).reshape((2, 3, 4, -1), order='F')
+    amplitudes_img = nb.Nifti1Image(amplitudes.astype(np.float32), np.eye(4))
+    mask = np.ones((2, 3, 4), dtype=np.uint8)
+    mask[1, 1, 1] = 0
+    mif_file = str(tmp_path / 'sh.mif')
+    amplitudes_to_sh_mif(amplitudes_img, odf_dirs, mif_file,
+                         mask_img=nb.Nifti1Image(mask, np.eye(4)), chunk_size=5)
+    _, mif_data = _read_mif(mif_file)
+    expected = coeffs * mask.flatten(order='F')[:, np.newaxis]
+    np.testing.assert_allclose(mif_data, expected, atol=1e-4)
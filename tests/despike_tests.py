@@ -0,0 +1,80 @@
+"""
+Test that the vectorized despiking reproduces the original voxelwise loop.
+"""
+import numpy as np
+import pytest
+from qsiprep.interfaces.fmap import _despike2d, _despike3d
+
+
+def _despike2d_reference(data, thres, neigh=None):
+    """The original voxelwise implementation of _despike2d"""
+    if neigh is None:
+        neigh = [-1, 0, 1]
+    nslices = data.shape[-1]
+
+    for k in range(nslices):
+        data2d = data[..., k]
+
+        for i in range(data2d.shape[0]):
+            for j in range(data2d.shape[1]):
+                vals = []
+                thisval = data2d[i, j]
+                for ii in neigh:
+                    for jj in neigh:
+                        try:
+                            vals.append(data2d[i + ii, j + jj])
+                        except IndexError:
+                            pass
+                vals = np.array(vals)
+                patch_range = vals.max() - vals.min()
+                patch_med = np.median(vals)
+
+                if (patch_range > 1e-6 and
+                        (abs(thisval - patch_med) / patch_range) > thres):
+                    data[i, j, k] = patch_med
+    return data
+
+
+def _spiky_fieldmap(shape, seed=0):
+    rng = np.random.RandomState(seed)
+    coords = np.meshgrid(*[np.linspace(-1, 1, dim) for dim in shape], indexing='ij')
+    data = 100 * coords[0] * coords[1] + 20 * coords[2] + rng.randn(*shape)
+    # Isolated spikes, adjacent spikes and spikes on the edges of the slices
+    spikes = rng.rand(*shape) < 0.05
+    spikes[0, :, 1] = spikes[-1, :, 2] = spikes[:, 0, 3] = spikes[:, -1, 3] = True
+    spikes[5:8, 5:8, 4] = True
+    data[spikes] += rng.choice([-1, 1], spikes.sum()) * rng.uniform(50, 500, spikes.sum())
+    # Flat patches where the range is too small to despike
+    data[10:14, 10:14, 0] = 3.0
+    return data.astype(np.float32)
+
+
+@pytest.mark.parametrize("shape,thres,neigh", [
+    ((24, 20, 6), 0.2, None),
+    ((17, 23, 5), 0.4, None),
+    ((16, 16, 5), 0.2, [-2, -1, 0, 1, 2]),
+])
+def test_despike2d_matches_reference(shape, thres, neigh):
+    data = _spiky_fieldmap(shape)
+    reference = _despike2d_reference(data.copy(), thres, neigh)
+    despiked = _despike2d(data.copy(), thres, neigh)
+    assert despiked.dtype == reference.dtype
+    np.testing.assert_array_equal(despiked, reference)
+
+
+def test_despike3d_matches_voxelwise():
+    data = _spiky_fieldmap((10, 9, 8), seed=1)
+    expected = data.copy()
+    for i, j, k in np.ndindex(data.shape):
+        vals = data[max(i - 1, 0):i + 2, max(j - 1, 0):j + 2, max(k - 1, 0):k + 2]
+        patch_range = vals.max() - vals.min()
+        patch_med = np.median(vals)
+        if patch_range > 1e-6 and abs(data[i, j, k] - patch_med) / patch_range > 0.2:
+            expected[i, j, k] = patch_med
+    np.testing.assert_allclose(_despike3d(data.copy(), 0.2), expected, rtol=1e-6)
+
+    flat = np.full((8, 8, 8), 5.0, dtype=np.float32)
+    spiked = flat.copy()
+    spiked[4, 4, 4] = 100
+    spiked[0, 0, 0] = -100
+    np.testing.assert_array_equal(_despike3d(spiked, 0.2), flat)
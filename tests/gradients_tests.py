@@ -0,0 +1,160 @@
+"""
+Test the vectorized q-space and slice QC computations against the
+one-at-a-time implementations they replace.
+"""
+import numpy as np
+import nibabel as nb
+import pytest
+from qsiprep.interfaces.gradients import (RemoveDuplicates, SliceQC, _score_slices,
+                                          unique_qspace_samples)
+
+
+def _unique_qspace_samples_reference(scaled_bvecs, cutoff):
+    """The original greedy search, comparing each sample with all kept samples"""
+    ok_vecs = []
+    seen_vecs = []
+    for vec_num, vec in enumerate(scaled_bvecs):
+        if np.linalg.norm(vec) < cutoff:
+            ok_vecs.append(vec_num)
+        elif not seen_vecs or (
+                np.all(np.linalg.norm(np.row_stack(seen_vecs) - vec, axis=1) > cutoff) and
+                np.all(np.linalg.norm(np.row_stack(seen_vecs) + vec, axis=1) > cutoff)):
+            ok_vecs.append(vec_num)
+            seen_vecs.append(vec)
+    return ok_vecs
+
+
+def _repeated_scheme(seed):
+    """Shells with b=0s and jittered repeats, some of them flipped."""
+    rng = np.random.RandomState(seed)
+    bvecs = rng.randn(60, 3)
+    bvecs /= np.linalg.norm(bvecs, axis=1)[:, np.newaxis]
+    bvals = np.repeat([1000., 2000., 3000.], 20)
+    repeats = rng.choice(60, 30)
+    rep_bvecs = bvecs[repeats] * rng.choice([-1, 1], (30, 1)) + rng.randn(30, 3) * 0.02
+    rep_bvecs /= np.linalg.norm(rep_bvecs, axis=1)[:, np.newaxis]
+    bvecs = np.row_stack([np.zeros((3, 3)), bvecs, rep_bvecs])
+    bvals = np.r_[0., 0., 5., bvals, bvals[repeats]]
+    order = rng.permutation(len(bvals))
+    return bvals[order], bvecs[order]
+
+
+def _scaled(bvals, bvecs):
+    bvals = np.sqrt(bvals - bvals.min())
+    return (bvals / bvals.max() * 100)[:, np.newaxis] * bvecs
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("cutoff", [0.5, 2., 8.])
+def test_unique_qspace_samples_matches_reference(seed, cutoff):
+    scaled_bvecs = _scaled(*_repeated_scheme(seed))
+    assert unique_qspace_samples(scaled_bvecs, cutoff) == \
+        _unique_qspace_samples_reference(scaled_bvecs, cutoff)
+
+
+def test_remove_duplicates(tmp_path):
+    bvals, bvecs = _repeated_scheme(0)
+    data = np.arange(4 * 3 * 2 * len(bvals), dtype=np.int16).reshape((4, 3, 2, -1))
+    dwi_file = str(tmp_path / 'dwi.nii.gz')
+    nb.Nifti1Image(data, np.eye(4)).to_filename(dwi_file)
+    bval_file = str(tmp_path / 'dwi.bval')
+    bvec_file = str(tmp_path / 'dwi.bvec')
+    np.savetxt(bval_file, bvals[np.newaxis], fmt='%d')
+    np.savetxt(bvec_file, bvecs.T, fmt='%.8f')
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    result = RemoveDuplicates(dwi_file=dwi_file, bval_file=bval_file, bvec_file=bvec_file,
+                              distance_cutoff=2.).run(cwd=str(out_dir))
+
+    kept = _unique_qspace_samples_reference(_scaled(bvals, bvecs), 2.)
+    assert len(kept) < len(bvals)
+    np.testing.assert_array_equal(np.asanyarray(nb.load(result.outputs.dwi_file).dataobj),
+                                  data[..., kept])
+    np.testing.assert_allclose(np.loadtxt(result.outputs.bval_file), bvals[kept])
+    np.testing.assert_allclose(np.loadtxt(result.outputs.bvec_file).T, bvecs[kept], atol=1e-7)
+
+
+def _crosscor(vec1, vec2):
+    v1bar = vec1 - vec1.mean()
+    v2bar = vec2 - vec2.mean()
+    return np.inner(v1bar, v2bar)**2 / (np.inner(v1bar, v1bar) * np.inner(v2bar, v2bar))
+
+
+def _score_slices_reference(ideal_image, input_image, masked_slices, valid_slices):
+    """The original scoring of one pair of images, one slice at a time"""
+    ideal_data = nb.load(ideal_image).get_fdata()
+    input_data = nb.load(input_image).get_fdata()
+    slice_scores = np.array([_crosscor(ideal_data[masked_slices == slicenum],
+                                       input_data[masked_slices == slicenum])
+                             for slicenum in valid_slices])
+    wb_ideal = ideal_data[masked_slices > 0]
+    wb_input = input_data[masked_slices > 0]
+    # sklearn's r2_score(wb_input, wb_ideal)
+    global_r2 = 1 - ((wb_input - wb_ideal) ** 2).sum() / ((wb_input - wb_input.mean()) ** 2).sum()
+    return slice_scores, _crosscor(wb_input, wb_ideal), global_r2
+
+
+@pytest.fixture
+def slice_qc_data(tmp_path):
+    """Model-based and observed volumes, with a signal dropout in one slice."""
+    rng = np.random.RandomState(0)
+    shape = (12, 10, 8)
+    affine = np.diag([2., 2., 2., 1.])
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[2:10, 2:8, 1:7] = 1
+    mask[5:7, 4:6, 7] = 1
+    mask_file = str(tmp_path / 'mask.nii.gz')
+    nb.Nifti1Image(mask, affine).to_filename(mask_file)
+
+    ideal_files, input_files = [], []
+    for volume_num in range(6):
+        ideal = 100 + 50 * rng.rand(*shape)
+        observed = ideal + rng.randn(*shape) * 5
+        if volume_num == 3:
+            observed[..., 4] = rng.rand(*shape[:2]) * 150
+        for files, data, name in ((ideal_files, ideal, 'ideal'),
+                                  (input_files, observed, 'dwi')):
+            files.append(str(tmp_path / ('%s%d.nii.gz' % (name, volume_num))))
+            nb.Nifti1Image(data.astype(np.float32), affine).to_filename(files[-1])
+    return ideal_files, input_files, mask_file
+
+
+def test_score_slices_matches_reference(slice_qc_data):
+    ideal_files, input_files, mask_file = slice_qc_data
+    mask = nb.load(mask_file).get_fdata() > 0
+    masked_slices = (mask * np.arange(mask.shape[2])[np.newaxis, np.newaxis, :]).astype(int)
+    valid_slices = np.array([1, 2, 4, 6])
+
+    slice_scores, wb_xcorrs, wb_r2s = _score_slices(ideal_files, input_files, masked_slices,
+                                                    valid_slices)
+    for volume_num, (ideal_file, input_file) in enumerate(zip(ideal_files, input_files)):
+        ref_scores, ref_xcorr, ref_r2 = _score_slices_reference(
+            ideal_file, input_file, masked_slices, valid_slices)
+        np.testing.assert_allclose(slice_scores[volume_num], ref_scores, rtol=1e-10)
+        assert wb_xcorrs[volume_num] == pytest.approx(ref_xcorr, rel=1e-10)
+        assert wb_r2s[volume_num] == pytest.approx(ref_r2, rel=1e-10)
+
+
+def test_slice_qc_imputes_outlier_slices(slice_qc_data, tmp_path):
+    ideal_files, input_files, mask_file = slice_qc_data
+    out_dir = tmp_path / 'qc'
+    out_dir.mkdir()
+    result = SliceQC(uncorrected_dwi_files=input_files, ideal_image_files=ideal_files,
+                     mask_image=mask_file, impute_slice_threshold=3.).run(cwd=str(out_dir))
+    stats = np.load(result.outputs.slice_stats)
+    # The small top slice is left out
+    assert 7 not in stats['valid_slices']
+    bad_volumes, bad_slices = np.nonzero(stats['imputed_slices'])
+    assert bad_volumes.tolist() == [3]
+    assert stats['valid_slices'][bad_slices].tolist() == [4]
+
+    imputed = result.outputs.imputed_images
+    assert imputed[:3] + imputed[4:] == input_files[:3] + input_files[4:]
+    imputed_data = nb.load(imputed[3]).get_fdata()
+    input_data = nb.load(input_files[3]).get_fdata()
+    ideal_data = nb.load(ideal_files[3]).get_fdata()
+    mask = nb.load(mask_file).get_fdata() > 0
+    slice_mask = mask.copy()
+    slice_mask[..., :4] = slice_mask[..., 5:] = False
+    np.testing.assert_allclose(imputed_data[slice_mask], ideal_data[slice_mask], rtol=1e-6)
+    np.testing.assert_array_equal(imputed_data[~slice_mask], input_data[~slice_mask])
@@ -0,0 +1,81 @@
+"""
+Test the streaming NIfTI concatenation and volume extraction.
+"""
+import numpy as np
+import nibabel as nb
+import pytest
+from qsiprep.utils.nifti import concat_niftis, extract_volumes
+
+AFFINE = np.array([[-2., 0., 0., 30.],
+                   [0., 2., 0., -40.],
+                   [0., 0., 2.5, -20.],
+                   [0., 0., 0., 1.]])
+
+
+def _write_image(fname, data, tr=3.2, slope=None):
+    img = nb.Nifti1Image(data, AFFINE)
+    img.header.set_qform(AFFINE, code=1)
+    img.header.set_sform(AFFINE, code=1)
+    img.header.set_xyzt_units('mm', 'sec')
+    if data.ndim > 3:
+        img.header.set_zooms((2., 2., 2.5, tr))
+    if slope is not None:
+        img.header.set_slope_inter(slope, 0.)
+    img.to_filename(fname)
+    return fname
+
+
+@pytest.fixture
+def int16_images(tmp_path):
+    rng = np.random.RandomState(0)
+    data = [rng.randint(-100, 1000, size=(5, 6, 4) + shape).astype(np.int16)
+            for shape in [(3,), (), (2,)]]
+    return [_write_image(str(tmp_path / ('img%d.nii.gz' % num)), volumes)
+            for num, volumes in enumerate(data)], data
+
+
+def _as_4d(data):
+    return [volumes if volumes.ndim > 3 else volumes[..., np.newaxis] for volumes in data]
+
+
+@pytest.mark.parametrize("out_name", ["merged.nii", "merged.nii.gz"])
+def test_concat_keeps_header(int16_images, tmp_path, out_name):
+    in_files, data = int16_images
+    out_img = nb.load(concat_niftis(in_files, str(tmp_path / out_name)))
+
+    np.testing.assert_array_equal(np.asanyarray(out_img.dataobj),
+                                  np.concatenate(_as_4d(data), -1))
+    assert out_img.get_data_dtype() == np.int16
+    np.testing.assert_allclose(out_img.affine, AFFINE)
+    assert int(out_img.header['qform_code']) == 1
+    assert int(out_img.header['sform_code']) == 1
+    assert out_img.header.get_xyzt_units() == ('mm', 'sec')
+    np.testing.assert_allclose(out_img.header.get_zooms(), (2., 2., 2.5, 3.2))
+
+
+def test_concat_abs_values(tmp_path):
+    data = np.full((3, 3, 3, 2), -7, dtype=np.int16)
+    data[0, 0, 0] = np.iinfo(np.int16).min
+    in_file = _write_image(str(tmp_path / 'negative.nii.gz'), data)
+    out_data = np.asanyarray(nb.load(concat_niftis(
+        [in_file], str(tmp_path / 'abs.nii.gz'), abs_values=True)).dataobj)
+    assert out_data.dtype == np.int16
+    assert out_data[0, 0, 0, 0] == np.iinfo(np.int16).max
+    assert (out_data[1:] == 7).all()
+
+
+def test_concat_scaled_inputs(int16_images, tmp_path):
+    in_files, data = int16_images
+    scaled = _write_image(str(tmp_path / 'scaled.nii.gz'), data[0], slope=0.5)
+    out_img = nb.load(concat_niftis([scaled] + in_files[1:], str(tmp_path / 'merged.nii')))
+    assert out_img.get_data_dtype() == np.float32
+    expected = _as_4d([data[0] * 0.5] + data[1:])
+    np.testing.assert_allclose(out_img.get_fdata(), np.concatenate(expected, -1))
+
+
+def test_extract_volumes(int16_images, tmp_path):
+    in_files, data = int16_images
+    out_img = nb.load(extract_volumes(in_files[0], [2, 0], str(tmp_path / 'some.nii.gz')))
+    np.testing.assert_array_equal(np.asanyarray(out_img.dataobj), data[0][..., [2, 0]])
+    assert int(out_img.header['sform_code']) == 1
+    np.testing.assert_allclose(out_img.header.get_zooms(), (2., 2., 2.5, 3.2))
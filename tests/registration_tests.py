@@ -0,0 +1,116 @@
+"""
+Test that the in-process registration recovers known motion.
+"""
+import numpy as np
+import nibabel as nb
+import pytest
+from pkg_resources import resource_filename as pkgrf
+from scipy.ndimage import map_coordinates
+from qsiprep.interfaces.shoreline import RegisterToPredicted
+from qsiprep.utils import registration
+from qsiprep.utils.registration import (crop_to_mask, register_affine, registration_stages,
+                                        winsorize)
+from qsiprep.utils.transforms import LPS_TO_RAS, apply_affine, read_itk_affine
+
+AFFINE = np.array([[-2., 0., 0., 30.],
+                   [0., 2., 0., -36.],
+                   [0., 0., 2., -24.],
+                   [0., 0., 0., 1.]])
+SHAPE = (30, 36, 24)
+# RAS mm
+SHIFT = np.array([1.4, -2.2, 0.8])
+
+
+def _blobs():
+    """A smooth, asymmetric head-like volume"""
+    coords = np.meshgrid(*[np.linspace(-1, 1, dim) for dim in SHAPE], indexing='ij')
+    volume = np.zeros(SHAPE)
+    for centre, width, weight in [((0., 0., 0.), 0.35, 600.), ((0.3, -0.2, 0.1), 0.06, 400.),
+                                  ((-0.25, 0.3, -0.2), 0.04, 300.),
+                                  ((0.1, 0.35, 0.3), 0.03, 200.)]:
+        volume += weight * np.exp(-sum((coord - offset) ** 2 for coord, offset in
+                                       zip(coords, centre)) / width)
+    return volume
+
+
+def _shifted(volume, shift_ras):
+    """``volume`` moved by ``shift_ras`` mm: moved(x) = volume(x - shift)"""
+    ijk = np.indices(SHAPE, dtype=float).reshape(3, -1)
+    voxel_shift = np.linalg.solve(AFFINE[:3, :3], shift_ras)
+    return map_coordinates(volume, ijk - voxel_shift[:, np.newaxis], order=3,
+                           mode='nearest').reshape(SHAPE)
+
+
+def _mask():
+    mask = np.zeros(SHAPE, dtype=np.int32)
+    mask[4:-4, 4:-4, 3:-3] = 1
+    return mask
+
+
+@pytest.fixture
+def stages():
+    settings = pkgrf('qsiprep', 'data/shoreline_precise_Rigid.json')
+    return registration_stages(settings, (2., 2., 2.))[0]
+
+
+def test_registration_stages(stages):
+    assert len(stages) == 1
+    assert stages[0]['transform'] == 'Rigid'
+    assert stages[0]['factors'] == [2, 1]
+    # 8 and 2 mm
+    assert stages[0]['sigmas'] == [4., 1.]
+    assert stages[0]['winsorize'] == (0.002, 0.998)
+
+
+@pytest.mark.parametrize("mask_in_dipy", [True, False])
+def test_register_affine_recovers_shift(stages, monkeypatch, mask_in_dipy):
+    monkeypatch.setattr(registration, 'OPTIMIZE_TAKES_MASK',
+                        registration.OPTIMIZE_TAKES_MASK and mask_in_dipy)
+    fixed = _blobs()
+    moving = _shifted(fixed, SHIFT)
+    affine = register_affine(fixed, AFFINE, moving, AFFINE, stages, fixed_mask=_mask())
+    # Fixed points map to moving points SHIFT away
+    np.testing.assert_allclose(affine[:3, 3], SHIFT, atol=0.15)
+    np.testing.assert_allclose(affine[:3, :3], np.eye(3), atol=0.01)
+
+
+def test_crop_to_mask():
+    data = np.arange(np.prod(SHAPE)).reshape(SHAPE)
+    cropped, cropped_affine = crop_to_mask(data, AFFINE, _mask())
+    assert cropped.shape == (22, 28, 18)
+    assert cropped[0, 0, 0] == data[4, 4, 3]
+    np.testing.assert_allclose(apply_affine(cropped_affine, np.zeros((3, 1))),
+                               apply_affine(AFFINE, np.array([[4.], [4.], [3.]])))
+    with pytest.raises(ValueError):
+        crop_to_mask(data, AFFINE, np.zeros(SHAPE))
+
+
+def test_winsorize():
+    data = np.arange(1001.)
+    np.testing.assert_allclose(winsorize(data, 0.01, 0.99)[[0, 500, 1000]], [10., 500., 990.])
+    assert winsorize(data, 0., 1.) is data
+
+
+def test_register_to_predicted(tmp_path):
+    fixed = _blobs()
+    files = {}
+    for name, data in (('fixed', fixed), ('moving0', _shifted(fixed, SHIFT)),
+                       ('moving1', _shifted(fixed, -SHIFT)), ('mask', _mask())):
+        files[name] = str(tmp_path / (name + '.nii.gz'))
+        nb.Nifti1Image(data.astype(np.float32), AFFINE).to_filename(files[name])
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    result = RegisterToPredicted(
+        moving_images=[files['moving0'], files['moving1']],
+        fixed_images=[files['fixed'], files['fixed']], fixed_image_mask=files['mask'],
+        ants_settings=pkgrf('qsiprep', 'data/shoreline_precise_Rigid.json'), num_threads=2
+    ).run(cwd=str(out_dir))
+
+    inside = _mask() > 0
+    for transforms, warped_file, shift in zip(result.outputs.forward_transforms,
+                                              result.outputs.warped_images, [SHIFT, -SHIFT]):
+        # ITK transforms map LPS fixed points to LPS moving points
+        itk_affine = read_itk_affine(transforms[0])
+        np.testing.assert_allclose(itk_affine[:3, 3], LPS_TO_RAS[:3, :3].dot(shift), atol=0.15)
+        warped = nb.load(warped_file).get_fdata()
+        assert np.abs(warped - fixed)[inside].max() < 0.05 * fixed.max()
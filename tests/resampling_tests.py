@@ -0,0 +1,110 @@
+"""
+Test the in-process resampling of DWI series against shifts with a known
+result and against antsApplyTransforms.
+"""
+import os.path as op
+import shutil
+import subprocess
+import numpy as np
+import nibabel as nb
+import pytest
+from qsiprep.interfaces.itk import MultiVolumeResample
+from qsiprep.utils.nifti import concat_niftis
+from qsiprep.utils.transforms import write_itk_affine
+
+AFFINE = np.array([[-2., 0., 0., 30.],
+                   [0., 2., 0., -40.],
+                   [0., 0., 2., -20.],
+                   [0., 0., 0., 1.]])
+
+
+def _smooth_volume(shape=(24, 28, 20), seed=0):
+    coords = np.meshgrid(*[np.linspace(-1, 1, dim) for dim in shape], indexing='ij')
+    rng = np.random.RandomState(seed)
+    centre = rng.rand(3) * 0.4 - 0.2
+    return 1000. * np.exp(-sum((coord - offset) ** 2 for coord, offset in
+                               zip(coords, centre)) / 0.3)
+
+
+def _translation(shift_mm):
+    # ITK affines map LPS output points to LPS input points
+    affine = np.eye(4)
+    affine[:3, 3] = shift_mm
+    return affine
+
+
+@pytest.fixture
+def shifted_series(tmp_path):
+    """Volumes, the ITK affines that shift them by whole voxels, and the expected output."""
+    base = _smooth_volume()
+    shifts = [(0, 0, 0), (1, 0, 0), (0, -2, 1)]
+    volume_files = []
+    transform_files = []
+    expected = []
+    for num, shift in enumerate(shifts):
+        volume_file = str(tmp_path / ('vol%d.nii.gz' % num))
+        nb.Nifti1Image(base.astype(np.float32), AFFINE).to_filename(volume_file)
+        volume_files.append(volume_file)
+        # LPS shift of one voxel along each axis: x is flipped twice, y once
+        shift_lps = np.array(shift) * 2. * np.array([1., -1., 1.])
+        transform_files.append(write_itk_affine(_translation(shift_lps),
+                                                str(tmp_path / ('motion%d.mat' % num))))
+        moved = np.zeros_like(base)
+        src = tuple(slice(max(0, step), base.shape[axis] + min(0, step))
+                    for axis, step in enumerate(shift))
+        dst = tuple(slice(max(0, -step), base.shape[axis] + min(0, -step))
+                    for axis, step in enumerate(shift))
+        moved[dst] = base[src]
+        expected.append(moved)
+    return volume_files, transform_files, np.stack(expected, -1)
+
+
+def _resample(input_images, transforms, reference, out_dir, interpolation='Linear'):
+    out_dir.mkdir()
+    result = MultiVolumeResample(input_images=input_images, transforms=transforms,
+                                 reference_image=reference,
+                                 interpolation=interpolation).run(cwd=str(out_dir))
+    return nb.load(result.outputs.out_file).get_fdata()
+
+
+def test_whole_voxel_shifts(shifted_series, tmp_path):
+    volume_files, transform_files, expected = shifted_series
+    resampled = _resample(volume_files, [[tfm] for tfm in transform_files], volume_files[0],
+                          tmp_path / 'out')
+    np.testing.assert_allclose(resampled, expected, atol=1e-2)
+
+
+def test_series_matches_volumes(shifted_series, tmp_path):
+    volume_files, transform_files, _ = shifted_series
+    shared = write_itk_affine(_translation([0.5, 1.2, -0.7]), str(tmp_path / 'shared.mat'))
+    transforms = [[shared, tfm] for tfm in transform_files]
+    series_file = concat_niftis(volume_files, str(tmp_path / 'series.nii'))
+    from_volumes = _resample(volume_files, transforms, volume_files[0], tmp_path / 'volumes',
+                             'BSpline')
+    from_series = _resample([series_file], transforms, volume_files[0], tmp_path / 'series',
+                            'BSpline')
+    np.testing.assert_array_equal(from_volumes, from_series)
+
+
+@pytest.mark.skipif(shutil.which('antsApplyTransforms') is None,
+                    reason='ANTs is not installed')
+@pytest.mark.parametrize("interpolation", ['Linear', 'LanczosWindowedSinc'])
+def test_matches_ants(shifted_series, tmp_path, interpolation):
+    volume_files, _, _ = shifted_series
+    motion = np.eye(4)
+    angle = 0.05
+    motion[:2, :2] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+    motion[:3, 3] = [0.7, -1.3, 0.4]
+    transform_file = write_itk_affine(motion, str(tmp_path / 'motion.mat'))
+    resampled = _resample(volume_files[:1], [[transform_file]], volume_files[0],
+                          tmp_path / 'out', interpolation)[..., 0]
+
+    ants_file = str(tmp_path / 'ants.nii.gz')
+    subprocess.check_call(['antsApplyTransforms', '-d', '3', '-i', volume_files[0], '-r',
+                           volume_files[0], '-o', ants_file, '-n', interpolation, '-t',
+                           transform_file])
+    ants = np.abs(nb.load(ants_file).get_fdata())
+    assert op.exists(ants_file)
+    # Cubic splines replace the windowed sinc, so only compare closely for Linear
+    tolerance = 1e-3 if interpolation == 'Linear' else 2e-2
+    assert np.abs(resampled - ants).max() < tolerance * ants.max()
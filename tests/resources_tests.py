@@ -0,0 +1,93 @@
+"""
+Test the resource estimates computed from NIfTI headers.
+"""
+import json
+import numpy as np
+import nibabel as nb
+import pytest
+from qsiprep.utils import resources
+from qsiprep.utils.resources import (
+    BRAIN_FRACTION, GB, COST_MODELS, calibrate_cost_models, estimate_resources, mask_fraction,
+    resample_geometry, series_gb, series_geometry, volume_gb)
+
+
+def _write_series(fname, shape, dtype=np.int16, zooms=(2., 2., 2.)):
+    img = nb.Nifti1Image(np.zeros(shape, dtype=dtype), np.diag(zooms + (1.,)))
+    img.to_filename(fname)
+    return fname
+
+
+@pytest.fixture
+def dwi_files(tmp_path):
+    return [_write_series(str(tmp_path / 'dwi1.nii.gz'), (10, 12, 8, 5)),
+            _write_series(str(tmp_path / 'dwi2.nii.gz'), (10, 12, 8, 3), dtype=np.float32)]
+
+
+def test_series_geometry(dwi_files):
+    geometry = series_geometry(dwi_files)
+    assert geometry.shape == (10, 12, 8)
+    assert geometry.num_volumes == 8
+    assert geometry.itemsize == 4
+    assert geometry.zooms == (2., 2., 2.)
+    assert series_geometry(dwi_files[0]).num_volumes == 5
+    assert series_geometry(['/does/not/exist.nii.gz']) is None
+
+    assert volume_gb(geometry) == 10 * 12 * 8 * 4 / GB
+    assert series_gb(geometry, 8) == 10 * 12 * 8 * 8 * 8 / GB
+    resampled = resample_geometry(geometry, 1.5)
+    assert resampled.shape == (14, 16, 11)
+    assert resampled.zooms == (1.5, 1.5, 1.5)
+
+
+def test_estimate_resources(dwi_files):
+    geometry = series_geometry(dwi_files)
+    model = COST_MODELS['SignalPrediction']
+    mem_gb, n_procs = estimate_resources('SignalPrediction', geometry, omp_nthreads=8,
+                                         mask_fraction=0.25, calibration={})
+    expected = model.base + model.masked * series_gb(geometry, 8) * 0.25 + \
+        model.volume * volume_gb(geometry)
+    assert mem_gb == pytest.approx(expected)
+    assert n_procs == 1
+
+    # Volume-wise models scale with the number of volumes on time series
+    volume_mem, _ = estimate_resources('ApplyTransforms', geometry, calibration={})
+    series_mem, _ = estimate_resources('ApplyTransforms', geometry, time_series=True,
+                                       calibration={})
+    base = COST_MODELS['ApplyTransforms'].base
+    assert series_mem - base == pytest.approx((volume_mem - base) * geometry.num_volumes)
+
+    assert estimate_resources('ExtendedEddy', geometry, omp_nthreads=8)[1] == 8
+    assert estimate_resources('ApplyTransforms', geometry, omp_nthreads=8)[1] == 1
+    scaled, _ = estimate_resources('SignalPrediction', geometry, omp_nthreads=8,
+                                   mask_fraction=0.25, calibration={'SignalPrediction': 2.})
+    assert scaled == pytest.approx(2 * mem_gb)
+
+
+def test_mask_fraction(tmp_path):
+    mask = np.zeros((10, 10, 10), dtype=np.uint8)
+    mask[:5, :4] = 1
+    mask_file = str(tmp_path / 'mask.nii.gz')
+    nb.Nifti1Image(mask, np.eye(4)).to_filename(mask_file)
+    assert mask_fraction(mask_file) == pytest.approx(0.2)
+    assert mask_fraction(None) == BRAIN_FRACTION
+    assert mask_fraction(str(tmp_path / 'missing.nii.gz'), default=0.3) == 0.3
+
+
+def test_calibrate_cost_models(dwi_files, tmp_path):
+    geometry = series_geometry(dwi_files)
+    estimate, _ = estimate_resources('DWIDenoise', geometry, calibration={})
+    monitor_file = str(tmp_path / 'resource_monitor.json')
+    with open(monitor_file, 'w') as monitor_json:
+        json.dump({'name': ['denoise', 'denoise', 'merge', 'other'],
+                   'mapnode': [0, 0, 0, 0],
+                   'interface': ['DWIDenoise', 'DWIDenoise', 'Merge', 'Function'],
+                   'rss_GiB': [estimate * 1.5, estimate, None, 100.]}, monitor_json)
+    out_file = str(tmp_path / 'calibration.json')
+    calibration = calibrate_cost_models(monitor_file, dwi_files, out_file=out_file, margin=1.)
+    assert calibration == {'DWIDenoise': pytest.approx(1.5)}
+    with open(out_file) as calibration_json:
+        assert json.load(calibration_json) == calibration
+
+    resources.load_calibration.cache_clear()
+    assert resources.load_calibration(out_file) == calibration
+    resources.load_calibration.cache_clear()
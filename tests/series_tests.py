@@ -0,0 +1,134 @@
+"""
+Test the memory-mapped DWI series and splitting series into volumes.
+"""
+import os
+import os.path as op
+import numpy as np
+import nibabel as nb
+import pytest
+from qsiprep.interfaces.images import SplitDWIs
+from qsiprep.utils.series import (
+    DWISeries, is_series, iter_image_volumes, load_volumes, series_sidecars, split_volumes)
+
+AFFINE = np.array([[-2., 0., 0., 30.],
+                   [0., 2., 0., -40.],
+                   [0., 0., 2.5, -20.],
+                   [0., 0., 0., 1.]])
+BVALS = np.array([0., 1000., 1000., 0., 2000.])
+
+
+@pytest.fixture
+def dwi_data(tmp_path):
+    rng = np.random.RandomState(0)
+    data = rng.rand(6, 7, 8, len(BVALS)).astype(np.float32)
+    bvecs = rng.randn(len(BVALS), 3)
+    bvecs /= np.linalg.norm(bvecs, axis=1)[:, np.newaxis]
+    bvecs[BVALS == 0] = 0
+    dwi_file = str(tmp_path / 'dwi.nii.gz')
+    nb.Nifti1Image(data, AFFINE).to_filename(dwi_file)
+    bval_file = str(tmp_path / 'dwi.bval')
+    bvec_file = str(tmp_path / 'dwi.bvec')
+    np.savetxt(bval_file, BVALS[np.newaxis], fmt='%.6g')
+    np.savetxt(bvec_file, bvecs.T, fmt='%.8f')
+    volume_files = []
+    for index in range(len(BVALS)):
+        volume_files.append(str(tmp_path / ('dwi_%02d.nii.gz' % index)))
+        nb.Nifti1Image(data[..., index], AFFINE).to_filename(volume_files[-1])
+    return data, bvecs, dwi_file, bval_file, bvec_file, volume_files
+
+
+def test_create_from_volumes(dwi_data, tmp_path):
+    data, bvecs, _, bval_file, bvec_file, volume_files = dwi_data
+    series_file = str(tmp_path / 'series.nii')
+    series = DWISeries.create(series_file, volume_files, bval_file, bvec_file)
+    assert len(series) == len(BVALS)
+    assert series.shape == data.shape
+    np.testing.assert_array_equal(series.affine, AFFINE)
+    assert isinstance(series.data, np.memmap)
+    np.testing.assert_array_equal(series.volume(2), data[..., 2])
+    np.testing.assert_allclose(series.bvals, BVALS)
+    np.testing.assert_allclose(series.bvecs, bvecs, atol=1e-7)
+    np.testing.assert_array_equal(series.b0_indices, [0, 3])
+    assert all(op.exists(sidecar) for sidecar in series_sidecars(series_file))
+
+
+def test_create_needs_uncompressed_output(dwi_data, tmp_path):
+    with pytest.raises(ValueError):
+        DWISeries.create(str(tmp_path / 'series.nii.gz'), dwi_data[2])
+
+
+def test_missing_gradients(dwi_data, tmp_path):
+    series = DWISeries.create(str(tmp_path / 'series.nii'), dwi_data[2])
+    with pytest.raises(ValueError):
+        series.bvals
+
+
+def test_volumes(dwi_data, tmp_path):
+    data = dwi_data[0]
+    series = DWISeries.create(str(tmp_path / 'series.nii'), dwi_data[2])
+    mask = data[..., 0] > 0.5
+    np.testing.assert_array_equal(series.volumes([1, 4]), data[..., [1, 4]])
+    np.testing.assert_array_equal(series.volumes(mask=mask), data[mask])
+
+
+def test_volume_files_are_written_on_request(dwi_data, tmp_path):
+    data, _, dwi_file, bval_file, bvec_file, _ = dwi_data
+    series = DWISeries.create(str(tmp_path / 'series.nii'), dwi_file, bval_file, bvec_file)
+    out_dir = str(tmp_path / 'volumes')
+    volume_files = series.volume_files(out_dir, indices=[1, 3])
+    assert sorted(os.listdir(out_dir)) == ['vol0001.nii.gz', 'vol0003.nii.gz']
+    np.testing.assert_array_equal(nb.load(volume_files[1]).get_fdata(), data[..., 3])
+    assert nb.load(volume_files[1]).shape == data.shape[:3]
+
+    # Existing files are not written again
+    mtime = os.stat(volume_files[0]).st_mtime_ns
+    assert series.volume_file(1, out_dir) == volume_files[0]
+    assert os.stat(volume_files[0]).st_mtime_ns == mtime
+
+    bval_files, bvec_files = series.gradient_files(out_dir)
+    assert len(bval_files) == len(bvec_files) == len(BVALS)
+    np.testing.assert_allclose(np.loadtxt(bval_files[4]), BVALS[4])
+    np.testing.assert_allclose(np.loadtxt(bvec_files[4]), series.bvecs[4])
+
+
+def test_load_volumes_mixes_series_and_volumes(dwi_data, tmp_path):
+    data, _, _, _, _, volume_files = dwi_data
+    series_file = DWISeries.create(str(tmp_path / 'series.nii'), volume_files[:3]).series_file
+    image_files = [series_file] + volume_files[3:]
+    assert is_series(series_file)
+    assert is_series([series_file])
+    assert not is_series(volume_files)
+
+    np.testing.assert_array_equal(load_volumes(image_files), data)
+    mask = data[..., 0] > 0.5
+    np.testing.assert_array_equal(load_volumes(image_files, mask=mask), data[mask])
+    assert len(list(iter_image_volumes(image_files))) == len(BVALS)
+
+
+def test_split_volumes(dwi_data, tmp_path):
+    data, _, dwi_file = dwi_data[:3]
+    out_dir = tmp_path / 'split'
+    out_dir.mkdir()
+    split_files = split_volumes(dwi_file, str(out_dir))
+    assert [op.basename(fname) for fname in split_files] == [
+        'vol%04d.nii.gz' % index for index in range(len(BVALS))]
+    for index, split_file in enumerate(split_files):
+        img = nb.load(split_file)
+        np.testing.assert_array_equal(img.affine, AFFINE)
+        np.testing.assert_array_equal(img.get_fdata(), data[..., index])
+
+
+def test_split_dwis(dwi_data, tmp_path):
+    data, bvecs, dwi_file, bval_file, bvec_file, _ = dwi_data
+    out_dir = tmp_path / 'split_dwis'
+    out_dir.mkdir()
+    outputs = SplitDWIs(dwi_file=dwi_file, bval_file=bval_file, bvec_file=bvec_file).run(
+        cwd=str(out_dir)).outputs
+    assert len(outputs.dwi_files) == len(BVALS)
+    assert outputs.b0_indices == [0, 3]
+    assert outputs.b0_images == [outputs.dwi_files[0], outputs.dwi_files[3]]
+    np.testing.assert_array_equal(nb.load(outputs.dwi_files[4]).get_fdata(), data[..., 4])
+    np.testing.assert_allclose(np.loadtxt(outputs.bvec_files[1]), bvecs[1], atol=1e-7)
+    # Only the single-volume images are written, no extra copy of the series
+    images = [fname for fname in os.listdir(str(out_dir)) if '.nii' in fname]
+    assert sorted(images) == [op.basename(fname) for fname in outputs.dwi_files]
@@ -0,0 +1,111 @@
+"""
+Test that the multi-voxel BrainSuite SHORE fits match the per-voxel fits and
+that the SHORE matrix store returns the matrices it is asked for.
+"""
+import numpy as np
+import pytest
+from dipy.core.gradients import gradient_table
+from qsiprep.utils import brainsuite_shore
+from qsiprep.utils.brainsuite_shore import (
+    BrainSuiteShoreModel, brainsuite_shore_basis, cached_shore_basis, shore_cache_key)
+
+
+def _shell_gtab(seed=0):
+    rng = np.random.RandomState(seed)
+    bvals = np.r_[0, np.repeat([1000, 2000, 3000], 20)]
+    bvecs = rng.randn(bvals.size, 3)
+    bvecs /= np.linalg.norm(bvecs, axis=1)[:, np.newaxis]
+    bvecs[0] = 0
+    return gradient_table(bvals, bvecs)
+
+
+def _tensor_signal(gtab, num_voxels, noise=2., seed=0):
+    rng = np.random.RandomState(seed)
+    fiber = rng.randn(num_voxels, 3)
+    fiber /= np.linalg.norm(fiber, axis=1)[:, np.newaxis]
+    cos2 = np.dot(fiber, gtab.bvecs.T) ** 2
+    signal = 100 * np.exp(-gtab.bvals * 1e-3 * (0.4 + 1.2 * cos2))
+    return signal + rng.randn(*signal.shape) * noise
+
+
+@pytest.mark.parametrize("chunk_size", [5, 1000])
+def test_l2_multi_voxel_matches_voxelwise(chunk_size):
+    gtab = _shell_gtab()
+    data = _tensor_signal(gtab, 24).reshape(2, 3, 4, -1)
+    mask = np.random.RandomState(1).rand(*data.shape[:3]) > 0.3
+    model = BrainSuiteShoreModel(gtab, regularization="L2")
+    multi_fit = model._fit_l2_multi_voxel(data, mask, chunk_size=chunk_size)
+    coefs = multi_fit.shore_coeff
+    fitted = multi_fit.fitted_signal()
+    assert coefs.shape == data.shape[:3] + (model.n_coefs,)
+    assert fitted.shape == data.shape
+
+    for index in zip(*np.nonzero(mask)):
+        voxel_fit = model._fit_voxel(data[index])
+        np.testing.assert_allclose(coefs[index], voxel_fit.shore_coeff, rtol=1e-7, atol=1e-10)
+        np.testing.assert_allclose(fitted[index], voxel_fit.fitted_signal(), rtol=1e-7,
+                                   atol=1e-8)
+    assert not coefs[~mask].any()
+    assert not fitted[~mask].any()
+
+    # fit() takes the multi-voxel path for L2
+    np.testing.assert_allclose(model.fit(data, mask).shore_coeff, coefs)
+
+
+def _lasso_objective(M, data, coef, alpha):
+    return ((data - np.dot(M, coef)) ** 2).sum() / (2 * M.shape[0]) + alpha * np.abs(coef).sum()
+
+
+@pytest.mark.parametrize("weighting", ["CV", "fixed"])
+def test_l1_multi_voxel_matches_voxelwise(weighting):
+    gtab = _shell_gtab()
+    data = _tensor_signal(gtab, 12).reshape(3, 4, -1)
+    model = BrainSuiteShoreModel(gtab, regularization="L1", regularization_weighting=weighting,
+                                 l1_alpha=0.01, l1_cv=3, l1_num_threads=1)
+    multi_fit = model.fit(data)
+    M, _ = model._shore_matrices()
+
+    for voxel_data, coef, alpha in zip(data.reshape(-1, data.shape[-1]),
+                                       multi_fit.shore_coeff.reshape(-1, M.shape[1]),
+                                       multi_fit.alpha.ravel()):
+        voxel_fit = model._fit_voxel(voxel_data)
+        # Same alpha grid and folds, so the same alpha is selected
+        assert alpha == pytest.approx(voxel_fit.alpha)
+        # Warm starts only change where coordinate descent stops
+        assert _lasso_objective(M, voxel_data, coef, alpha) == pytest.approx(
+            _lasso_objective(M, voxel_data, voxel_fit.shore_coeff, alpha), rel=1e-3)
+
+
+def test_shore_cache_key_depends_on_format(monkeypatch):
+    key = shore_cache_key(np.arange(3.), 6, 700)
+    assert key == shore_cache_key(np.arange(3.), 6, 700)
+    assert key != shore_cache_key(np.arange(3.), 6, 701)
+    monkeypatch.setattr(brainsuite_shore, "SHORE_CACHE_FORMAT",
+                        brainsuite_shore.SHORE_CACHE_FORMAT + 1)
+    assert key != shore_cache_key(np.arange(3.), 6, 700)
+
+
+def test_shore_cache_in_memory_by_default(monkeypatch, tmp_path):
+    monkeypatch.delenv("QSIPREP_SHORE_CACHE", raising=False)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(brainsuite_shore, "_SHORE_MATRIX_CACHE", brainsuite_shore.OrderedDict())
+    gtab = _shell_gtab()
+    basis = cached_shore_basis(6, 700, gtab)
+    np.testing.assert_array_equal(basis, brainsuite_shore_basis(6, 700, gtab))
+    assert cached_shore_basis(6, 700, gtab) is basis
+    assert not list(tmp_path.iterdir())
+
+
+def test_shore_cache_on_disk(monkeypatch, tmp_path):
+    monkeypatch.setenv("QSIPREP_SHORE_CACHE", str(tmp_path))
+    monkeypatch.setattr(brainsuite_shore, "_SHORE_MATRIX_CACHE", brainsuite_shore.OrderedDict())
+    gtab = _shell_gtab()
+    basis = cached_shore_basis(6, 700, gtab)
+    cache_files = list(tmp_path.glob("basis-*.npy"))
+    assert len(cache_files) == 1
+    np.testing.assert_array_equal(np.load(str(cache_files[0])), basis)
+
+    # A new process finds the matrix on disk
+    monkeypatch.setattr(brainsuite_shore, "_SHORE_MATRIX_CACHE", brainsuite_shore.OrderedDict())
+    monkeypatch.setattr(brainsuite_shore, "brainsuite_shore_basis", None)
+    np.testing.assert_array_equal(cached_shore_basis(6, 700, gtab), basis)
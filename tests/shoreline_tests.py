@@ -0,0 +1,198 @@
+"""
+Test the SHORELine iteration controls, its report and its streamed statistics.
+"""
+import imageio
+import nibabel as nb
+import numpy as np
+import pandas as pd
+import pytest
+from traits.api import TraitError
+from qsiprep.interfaces.shoreline import (
+    B0Mean, CalculateCNR, RunningMoments, SHORELine, SHORELineReport, SignalPrediction,
+    SignalPredictionAll, motion_deltas, _render_frames, scaled_mips, series_length,
+    series_mips)
+
+MOTION_COLUMNS = ['shiftX', 'shiftY', 'shiftZ', 'rotateX', 'rotateY', 'rotateZ']
+
+
+def test_shoreline_needs_an_iteration():
+    assert SHORELine().inputs.num_iterations == 2
+    with pytest.raises(TraitError):
+        SHORELine(num_iterations=0)
+
+
+def test_motion_deltas(tmp_path):
+    previous = np.zeros((3, 6))
+    current = previous.copy()
+    current[1, 1] = -0.3
+    current[2, 4] = np.deg2rad(0.5)
+    motion_files = []
+    for name, params in (('previous', previous), ('current', current)):
+        motion_files.append(str(tmp_path / (name + '.csv')))
+        pd.DataFrame(params, columns=MOTION_COLUMNS).to_csv(motion_files[-1], index=False)
+    shift_deltas, rotate_deltas = motion_deltas(*motion_files)
+    np.testing.assert_allclose(shift_deltas, [0., 0.3, 0.])
+    np.testing.assert_allclose(rotate_deltas, [0., 0., 0.5])
+
+
+def _reference_scaled_mip(img1, img2, img3, axis):
+    mip1 = img1.max(axis=axis).T
+    mip2 = img2.max(axis=axis).T
+    mip3 = img3.max(axis=axis).T
+    vmax = 0.98 * max(mip1.max(), mip2.max(), mip3.max())
+    return (np.clip(mip1, 0, vmax) / vmax,
+            np.clip(mip2, 0, vmax) / vmax,
+            np.clip(mip3, 0, vmax) / vmax)
+
+
+def _write_volumes(data, out_dir, prefix):
+    series_file = str(out_dir / (prefix + '_series.nii'))
+    nb.Nifti1Image(data, np.eye(4)).to_filename(series_file)
+    volume_files = []
+    for volume_num in range(data.shape[3]):
+        volume_files.append(str(out_dir / ('%s_%02d.nii.gz' % (prefix, volume_num))))
+        nb.Nifti1Image(data[..., volume_num], np.eye(4)).to_filename(volume_files[-1])
+    return series_file, volume_files
+
+
+def test_series_mips(tmp_path):
+    data = np.random.RandomState(0).rand(6, 7, 8, 5).astype(np.float32)
+    series_file, volume_files = _write_volumes(data, tmp_path, 'dwi')
+    assert series_length([series_file]) == series_length(volume_files) == 5
+
+    volume_nums = np.array([0, 2, 4])
+    series = series_mips([series_file], volume_nums)
+    volumes = series_mips(volume_files, volume_nums)
+    assert series.shape == (3, 8, 7)
+    np.testing.assert_array_equal(series, volumes)
+    for mip, volume_num in zip(series, volume_nums):
+        np.testing.assert_array_equal(mip, data[..., volume_num].max(0).T)
+
+
+def test_scaled_mips():
+    rng = np.random.RandomState(0)
+    stacks = [rng.rand(4, 5, 6, 3).astype(np.float32) * (stack_num + 1)
+              for stack_num in range(3)]
+    scaled = scaled_mips(*[np.stack([volume.max(0).T for volume in np.moveaxis(stack, -1, 0)])
+                           for stack in stacks])
+    for volume_num in range(3):
+        expected = _reference_scaled_mip(*[stack[..., volume_num] for stack in stacks], 0)
+        for stack_num in range(3):
+            np.testing.assert_allclose(scaled[stack_num][volume_num], expected[stack_num],
+                                       rtol=1e-6)
+
+
+def test_render_frames_parallel_matches_serial():
+    rng = np.random.RandomState(0)
+    mips = scaled_mips(*[rng.rand(3, 8, 8).astype(np.float32) for _ in range(3)])
+    frame_args = list(zip(mips[0], mips[1], mips[2], range(3)))
+    serial = list(_render_frames(frame_args, 1))
+    parallel = list(_render_frames(frame_args, 2))
+    assert len(serial) == len(parallel) == 3
+    for serial_frames, parallel_frames in zip(serial, parallel):
+        for serial_frame, parallel_frame in zip(serial_frames, parallel_frames):
+            np.testing.assert_array_equal(serial_frame, parallel_frame)
+
+
+def test_shoreline_report_max_volumes(tmp_path):
+    rng = np.random.RandomState(0)
+    image_lists = []
+    for prefix in ('original', 'registered', 'predicted'):
+        image_lists.append(_write_volumes(rng.rand(6, 7, 8, 5).astype(np.float32),
+                                          tmp_path, prefix)[1])
+    report = SHORELineReport(original_images=image_lists[0],
+                             registered_images=image_lists[1],
+                             model_predicted_images=image_lists[2],
+                             max_volumes=3)
+    plot_file = report.run(cwd=str(tmp_path)).outputs.plot_file
+    # Before and after frames for volumes 0, 2 and 4
+    assert len(imageio.mimread(plot_file)) == 6
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_running_moments(dtype):
+    # A large offset is where raw sums of squares lose precision in float32
+    values = 1000. + np.random.RandomState(0).randn(50, 20)
+    moments = RunningMoments(20, dtype)
+    for row in values:
+        moments.update(row.astype(dtype))
+    assert moments.count == 50
+    np.testing.assert_allclose(moments.mean, values.mean(0), rtol=1e-6)
+    np.testing.assert_allclose(moments.variance, values.var(0),
+                               rtol=1e-3 if dtype is np.float32 else 1e-10)
+
+
+@pytest.mark.parametrize('accumulate_float64', [False, True])
+def test_b0_mean(tmp_path, accumulate_float64):
+    data = 100. * np.random.RandomState(0).rand(6, 7, 8, 4).astype(np.float32)
+    series_file, volume_files = _write_volumes(data, tmp_path, 'b0')
+    expected = np.stack([nb.load(fname).get_fdata() for fname in volume_files], -1).mean(3)
+    for b0_images in (volume_files, [series_file]):
+        mean_file = B0Mean(b0_images=b0_images, accumulate_float64=accumulate_float64).run(
+            cwd=str(tmp_path)).outputs.average_image
+        np.testing.assert_allclose(nb.load(mean_file).get_fdata(), expected, rtol=1e-5)
+
+
+@pytest.mark.parametrize('accumulate_float64', [False, True])
+def test_calculate_cnr(tmp_path, accumulate_float64):
+    rng = np.random.RandomState(0)
+    predicted = 100. + 50. * rng.rand(6, 7, 8, 5).astype(np.float32)
+    observed = (predicted + rng.randn(*predicted.shape)).astype(np.float32)
+    mask = np.zeros(predicted.shape[:3], dtype=np.uint8)
+    mask[1:5, 1:6, 1:7] = 1
+    mask_file = str(tmp_path / 'mask.nii.gz')
+    nb.Nifti1Image(mask, np.eye(4)).to_filename(mask_file)
+    predicted_files = _write_volumes(predicted, tmp_path, 'predicted')[1]
+    observed_files = _write_volumes(observed, tmp_path, 'observed')[1]
+
+    # The whole-series computation that the streamed one replaced
+    in_mask = mask > 0
+    signal_vals = predicted[in_mask]
+    b0 = signal_vals[:, 0][:, np.newaxis]
+    signal_vals = signal_vals / b0
+    expected = np.zeros(mask.shape)
+    expected[in_mask] = np.var(signal_vals, 1) / np.var(signal_vals - observed[in_mask] / b0, 1)
+
+    cnr_file = CalculateCNR(hmc_warped_images=observed_files, predicted_images=predicted_files,
+                            mask_image=mask_file, accumulate_float64=accumulate_float64).run(
+        cwd=str(tmp_path)).outputs.cnr_image
+    np.testing.assert_allclose(nb.load(cnr_file).get_fdata(), expected, rtol=1e-4)
+
+
+@pytest.mark.parametrize('minimal_q_distance', [2.0, 30.0])
+def test_leave_out_predictions_match_separate_fits(tmp_path, minimal_q_distance):
+    rng = np.random.RandomState(0)
+    # b=0 images are predicted too, from fits that leave out every b=0 image
+    bvals = np.r_[0, np.repeat(1000., 8), 0, np.repeat(2500., 8)]
+    bvecs = rng.randn(len(bvals), 3)
+    bvecs /= np.linalg.norm(bvecs, axis=1)[:, np.newaxis]
+    bvecs[bvals == 0] = 0
+    fiber = rng.randn(18, 3)
+    fiber /= np.linalg.norm(fiber, axis=1)[:, np.newaxis]
+    signal = 100 * np.exp(-bvals * 1e-3 * (0.4 + 1.2 * np.dot(fiber, bvecs.T) ** 2))
+    data = (signal + rng.randn(*signal.shape)).reshape(3, 3, 2, -1).astype(np.float32)
+    dwi_files = _write_volumes(data, tmp_path, 'dwi')[1]
+    b0_mean = str(tmp_path / 'b0_mean.nii.gz')
+    nb.Nifti1Image(data[..., bvals == 0].mean(3), np.eye(4)).to_filename(b0_mean)
+    mask = np.ones(data.shape[:3], dtype=np.uint8)
+    mask[0, 0, 0] = 0
+    mask_file = str(tmp_path / 'mask.nii.gz')
+    nb.Nifti1Image(mask, np.eye(4)).to_filename(mask_file)
+    inputs = dict(aligned_dwis=dwi_files, aligned_bvecs=bvecs, bvals=bvals,
+                  aligned_mask=mask_file, aligned_b0_mean=b0_mean,
+                  minimal_q_distance=minimal_q_distance)
+
+    all_dir = tmp_path / 'all'
+    all_dir.mkdir()
+    predicted_images = SignalPredictionAll(**inputs).run(
+        cwd=str(all_dir)).outputs.predicted_images
+    assert len(predicted_images) == len(bvals)
+    for image_num, predicted_image in enumerate(predicted_images):
+        image_dir = tmp_path / ('volume%02d' % image_num)
+        image_dir.mkdir()
+        expected = nb.load(SignalPrediction(
+            bvec_to_predict=bvecs[image_num], bval_to_predict=bvals[image_num], **inputs).run(
+                cwd=str(image_dir)).outputs.predicted_image).get_fdata()
+        predicted = nb.load(predicted_image).get_fdata()
+        np.testing.assert_allclose(predicted, expected, rtol=1e-4, atol=1e-3)
+        assert predicted[0, 0, 0] == 0
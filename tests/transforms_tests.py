@@ -0,0 +1,241 @@
+"""
+Test the affine transform algebra against the conventions of ANTs.
+"""
+import os.path as op
+import shutil
+import subprocess
+import numpy as np
+import nibabel as nb
+import pytest
+from qsiprep.interfaces.gradients import _compose_affine_series
+from qsiprep.utils.transforms import (
+    LPS_TO_RAS, apply_affine, compose_affines, compose_displacement_field, decompose_affines,
+    fsl_center_of_gravity, fsl_motion_params, itk_to_fsl, map_points, read_itk_affine,
+    write_itk_affine)
+
+
+def _random_affine(seed):
+    rng = np.random.RandomState(seed)
+    affine = np.eye(4)
+    angle = rng.rand() * 0.3
+    affine[:2, :2] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+    affine[:3, :3] *= 1 + rng.rand(3) * 0.1
+    affine[:3, 3] = rng.randn(3) * 5
+    return affine
+
+
+def _points(num_points=10, seed=0):
+    return np.random.RandomState(seed).randn(3, num_points) * 20
+
+
+@pytest.mark.parametrize("extension", [".mat", ".txt"])
+def test_itk_affine_round_trip(tmp_path, extension):
+    affine = _random_affine(0)
+    transform_file = write_itk_affine(affine, str(tmp_path / ("affine" + extension)))
+    np.testing.assert_allclose(read_itk_affine(transform_file), affine)
+
+
+def test_compose_affines_applies_the_first_transform_first():
+    first, second = _random_affine(0), _random_affine(1)
+    points = _points()
+    np.testing.assert_allclose(
+        apply_affine(compose_affines([first, second]), points),
+        apply_affine(second, apply_affine(first, points)))
+
+
+def test_compose_affines_broadcasts_stacks():
+    stack = np.array([_random_affine(seed) for seed in range(3)])
+    shared = _random_affine(10)
+    composed = compose_affines([shared, stack])
+    for affine, expected in zip(composed, stack):
+        np.testing.assert_allclose(affine, np.dot(expected, shared))
+    np.testing.assert_array_equal(compose_affines([]), np.eye(4))
+
+
+@pytest.mark.skipif(shutil.which('antsApplyTransformsToPoints') is None,
+                    reason='ANTs is not installed')
+def test_two_transform_chain_matches_ants(tmp_path):
+    transform_files = [write_itk_affine(_random_affine(seed), str(tmp_path / ('%d.mat' % seed)))
+                       for seed in range(2)]
+    points = _points()
+    in_csv = str(tmp_path / 'points.csv')
+    out_csv = str(tmp_path / 'mapped.csv')
+    np.savetxt(in_csv, np.column_stack([points.T, np.zeros(points.shape[1])]), delimiter=',',
+               header='x,y,z,t', comments='')
+    cmd = ['antsApplyTransformsToPoints', '-d', '3', '-i', in_csv, '-o', out_csv]
+    for transform_file in transform_files:
+        cmd += ['-t', transform_file]
+    subprocess.check_call(cmd)
+    ants_points = np.loadtxt(out_csv, delimiter=',', skiprows=1)[:, :3].T
+
+    composed = compose_affines([read_itk_affine(fname) for fname in transform_files])
+    np.testing.assert_allclose(apply_affine(composed, points), ants_points, atol=1e-4)
+    np.testing.assert_allclose(map_points(points, transform_files), ants_points, atol=1e-4)
+
+
+def test_compose_affine_series(tmp_path):
+    shared = write_itk_affine(_random_affine(10), str(tmp_path / 'shared.mat'))
+    motion = [write_itk_affine(_random_affine(seed), str(tmp_path / ('motion%d.mat' % seed)))
+              for seed in range(3)]
+    in_files = [str(tmp_path / ('dwi%d.nii.gz' % num)) for num in range(3)]
+    results = _compose_affine_series(
+        in_files, [[shared, 'warp.nii.gz', motion_file] for motion_file in motion], None,
+        str(tmp_path))
+    for (out_affine, _), motion_file in zip(results, motion):
+        assert op.exists(out_affine)
+        np.testing.assert_allclose(
+            read_itk_affine(out_affine),
+            np.dot(read_itk_affine(motion_file), read_itk_affine(shared)))
+
+    assert _compose_affine_series([], [], None, str(tmp_path)) == []
+    with pytest.raises(ValueError):
+        _compose_affine_series(in_files[:2], [[shared, motion[0]], [motion[1]]], None,
+                               str(tmp_path))
+
+
+def test_compose_displacement_field(tmp_path):
+    ref_affine = np.array([[-2., 0., 0., 20.], [0., 2., 0., -30.], [0., 0., 2.5, -10.],
+                           [0., 0., 0., 1.]])
+    ref_img = nb.Nifti1Image(np.zeros((6, 7, 5), dtype=np.int16), ref_affine)
+    ref_img.header.set_qform(ref_affine, code=1)
+    ref_img.header.set_sform(ref_affine, code=1)
+    ref_img.header.set_xyzt_units('mm', 'sec')
+    reference = str(tmp_path / 'ref.nii.gz')
+    ref_img.to_filename(reference)
+    transforms = [write_itk_affine(_random_affine(seed), str(tmp_path / ('%d.mat' % seed)))
+                  for seed in range(2)]
+
+    warp_img = nb.load(compose_displacement_field(transforms, reference,
+                                                  str(tmp_path / 'warp.nii.gz')))
+    assert warp_img.shape == (6, 7, 5, 1, 3)
+    assert warp_img.get_data_dtype() == np.float32
+    assert warp_img.header.get_intent()[0] == 'vector'
+    assert int(warp_img.header['qform_code']) == 1
+    assert int(warp_img.header['sform_code']) == 1
+    assert warp_img.header.get_xyzt_units() == ('mm', 'sec')
+    np.testing.assert_allclose(warp_img.header.get_zooms()[:3], [2., 2., 2.5])
+
+    points = apply_affine(LPS_TO_RAS.dot(ref_affine),
+                          np.indices((6, 7, 5)).reshape(3, -1).astype(float))
+    composed = compose_affines([read_itk_affine(fname) for fname in transforms])
+    displacements = warp_img.get_fdata().reshape(-1, 3).T
+    np.testing.assert_allclose(displacements, apply_affine(composed, points) - points,
+                               atol=1e-3)
+
+
+# Neurological orientation: FSL flips the first axis of these images
+NEURO_AFFINE = np.array([[2., 0., 0., -40.],
+                         [0., 2., 0., -50.],
+                         [0., 0., 2.5, -30.],
+                         [0., 0., 0., 1.]])
+
+
+def _axis_rotation(axis, angle):
+    """Right-handed rotation about an axis."""
+    rotation = np.eye(3)
+    first, second = (axis + 1) % 3, (axis + 2) % 3
+    rotation[[first, first, second, second], [first, second, first, second]] = [
+        np.cos(angle), -np.sin(angle), np.sin(angle), np.cos(angle)]
+    return rotation
+
+
+@pytest.fixture
+def neuro_image(tmp_path):
+    shape = (20, 24, 16)
+    ijk = np.indices(shape).astype(float)
+    # An off-centre blob, so the centre of gravity is not the centre of the grid
+    data = 100 * np.exp(-((ijk[0] - 7) ** 2 + (ijk[1] - 14) ** 2 + (ijk[2] - 9) ** 2) / 20.)
+    img = nb.Nifti1Image(data.astype(np.float32), NEURO_AFFINE)
+    img.header.set_qform(NEURO_AFFINE, code=1)
+    img.header.set_sform(NEURO_AFFINE, code=1)
+    image_file = str(tmp_path / 'neuro.nii.gz')
+    img.to_filename(image_file)
+    weights = data - data.min()
+    voxel_cog = (ijk * weights).reshape(3, -1).sum(1) / weights.sum()
+    return image_file, voxel_cog
+
+
+def test_fsl_center_of_gravity(neuro_image):
+    image_file, voxel_cog = neuro_image
+    img = nb.load(image_file)
+    # FSL scaled mm coordinates of a neurological image run along -x
+    expected = voxel_cog * [-2., 2., 2.5] + [2. * (img.shape[0] - 1), 0., 0.]
+    np.testing.assert_allclose(fsl_center_of_gravity(img), expected, atol=1e-4)
+
+
+def test_decompose_affines():
+    # avscale normalizes the shears by the x and y scales, so those are kept at 1
+    scale = np.diag([1., 1., 1.2])
+    shear = np.array([[1., 0.05, -0.02], [0., 1., 0.03], [0., 0., 1.]])
+    # avscale's angles are of clockwise rotations, applied about z, then y, then x
+    angles = np.array([0.1, -0.2, 0.15])
+    rotation = np.linalg.multi_dot([_axis_rotation(axis, -angle)
+                                    for axis, angle in enumerate(angles)])
+    affine = np.eye(4)
+    affine[:3, :3] = np.linalg.multi_dot([rotation, shear, scale])
+    affine[:3, 3] = [3., -4., 5.]
+    center = np.array([10., 20., 30.])
+    params = decompose_affines(affine, center)
+    np.testing.assert_allclose(params[:3], np.diag(scale))
+    np.testing.assert_allclose(params[3:6], [0.05, -0.02, 0.03], atol=1e-12)
+    np.testing.assert_allclose(params[6:9], angles)
+    np.testing.assert_allclose(params[9:], affine[:3, :3].dot(center) + affine[:3, 3] - center)
+    # Stacks decompose matrix by matrix
+    np.testing.assert_allclose(decompose_affines(np.array([affine, np.eye(4)]), center),
+                               [params, [1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0]], atol=1e-12)
+
+
+@pytest.mark.parametrize("axis, sign", [(0, -1), (1, -1), (2, 1)])
+def test_fsl_motion_params_of_rigid_motion(neuro_image, tmp_path, axis, sign):
+    image_file, voxel_cog = neuro_image
+    angle = np.deg2rad(4)
+    rotation = _axis_rotation(axis, angle)
+    shift = np.array([1.5, -2., 0.7])
+    # Rotate (in LPS) about the centre of gravity of the image, then shift
+    center = LPS_TO_RAS[:3, :3].dot(apply_affine(NEURO_AFFINE, voxel_cog[:, np.newaxis])[:, 0])
+    itk_affine = np.eye(4)
+    itk_affine[:3, :3] = rotation
+    itk_affine[:3, 3] = center + shift - rotation.dot(center)
+    itk_file = write_itk_affine(itk_affine, str(tmp_path / 'motion.mat'))
+
+    img = nb.load(image_file)
+    fsl_affine = itk_to_fsl(itk_affine, img, img)
+    np.testing.assert_allclose(fsl_affine[:3, :3].dot(fsl_affine[:3, :3].T), np.eye(3),
+                               atol=1e-12)
+
+    params = fsl_motion_params([itk_file], [image_file], image_file)
+    assert params.shape == (1, 12)
+    np.testing.assert_allclose(params[0, :3], 1)
+    np.testing.assert_allclose(params[0, 3:6], 0, atol=1e-12)
+    # Only the rotated axis moves, with the sign of the LPS flip
+    expected_angles = np.zeros(3)
+    expected_angles[axis] = sign * angle
+    np.testing.assert_allclose(params[0, 6:9], expected_angles, atol=1e-12)
+    # The centre of gravity moves back by the shift, then x and y are flipped to LPS
+    np.testing.assert_allclose(params[0, 9:], [-1, -1, 1] * rotation.T.dot(shift), atol=1e-4)
+
+
+@pytest.mark.skipif(shutil.which('c3d_affine_tool') is None or shutil.which('avscale') is None,
+                    reason='c3d and FSL are not installed')
+def test_fsl_motion_params_match_avscale(neuro_image, tmp_path):
+    image_file = neuro_image[0]
+    itk_affine = _random_affine(3)
+    itk_affine[:3, :3] = _axis_rotation(0, 0.05).dot(_axis_rotation(2, -0.08))
+    itk_file = write_itk_affine(itk_affine, str(tmp_path / 'motion.mat'))
+    fsl_file = str(tmp_path / 'motion_FSL.xfm')
+    subprocess.check_call(['c3d_affine_tool', '-ref', image_file, '-src', image_file,
+                           '-itk', itk_file, '-ras2fsl', '-o', fsl_file])
+    np.testing.assert_allclose(itk_to_fsl(itk_affine, nb.load(image_file), nb.load(image_file)),
+                               np.loadtxt(fsl_file), atol=1e-4)
+
+    lines = subprocess.check_output(['avscale', '--allparams', fsl_file, image_file]).decode(
+        'utf-8').split('\n')
+
+    def get_measures(line):
+        return np.array([float(num) for num in line.strip().split()[-3:]])
+
+    flip = np.array([1, -1, -1])
+    expected = np.concatenate([get_measures(lines[10]), get_measures(lines[12]),
+                               get_measures(lines[6]) * flip, get_measures(lines[8]) * flip])
+    params = fsl_motion_params([itk_file], [image_file], image_file)[0]
+    np.testing.assert_allclose(params, expected, atol=1e-3)